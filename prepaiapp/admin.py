@@ -15,15 +15,29 @@ from .models import (
     RoleplaySession,
     RolePlayShare,
     MyInvitedRolePlayShare,
-    CreditShare
+    CreditShare,
+    CreditLedgerEntry,
 )
 @admin.register(CreditShare)
 class CreditShareAdmin(admin.ModelAdmin):
     pass
 
+
+@admin.register(CreditLedgerEntry)
+class CreditLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ("user", "amount", "kind", "reference", "created_at")
+    list_filter = ("kind",)
+    search_fields = ("user__username", "reference")
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 @admin.register(RoleplaySession)
 class RolePlaySessionAdmin(admin.ModelAdmin):
-    pass
+    readonly_fields = ("transcript_text",)
 
 
 @admin.register(MyInvitedRolePlayShare)
@@ -64,7 +78,7 @@ class InterviewTemplateAdmin(admin.ModelAdmin):
 
 @admin.register(InterviewSession)
 class InterviewSessionAdmin(admin.ModelAdmin):
-    pass
+    readonly_fields = ("transcript_text",)
 
 
 @admin.register(Course)
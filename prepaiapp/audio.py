@@ -0,0 +1,547 @@
+# pylint: disable=all
+"""Audio wire-format helpers shared by the voice agent consumers."""
+
+import logging
+import struct
+from collections import deque, namedtuple
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Binary audio frames exchanged with roleplay_session.html.
+#
+# Every binary WebSocket frame starts with a fixed 12 byte little-endian
+# header followed by the raw audio payload:
+#
+#   u8  version       AUDIO_FRAME_VERSION
+#   u8  frame type    AUDIO_FRAME_OUTPUT / AUDIO_FRAME_INPUT
+#   u16 content index (output) or flags (input)
+#   u32 item index (output) or sequence number (input)
+#   u32 sequence number (output) or capture timestamp in ms (input)
+#
+# 12 bytes keeps the PCM16 payload 2-byte aligned so the browser can view it
+# directly as an Int16Array without copying.
+AUDIO_FRAME_HEADER = struct.Struct("<BBHII")
+AUDIO_FRAME_HEADER_SIZE = AUDIO_FRAME_HEADER.size
+AUDIO_FRAME_VERSION = 1
+AUDIO_FRAME_OUTPUT = 1
+AUDIO_FRAME_INPUT = 2
+
+
+def pack_output_audio_frame(item_index, content_index, seq, audio_bytes):
+    """Build a binary frame carrying assistant audio for the client"""
+    header = AUDIO_FRAME_HEADER.pack(
+        AUDIO_FRAME_VERSION,
+        AUDIO_FRAME_OUTPUT,
+        content_index & 0xFFFF,
+        item_index & 0xFFFFFFFF,
+        seq & 0xFFFFFFFF,
+    )
+    # Single copy of the payload: the WebSocket layer needs a bytes object
+    return header + audio_bytes
+
+
+def unpack_input_audio_frame(frame):
+    """Split a binary client frame into (seq, capture_ms, payload view)"""
+    if len(frame) < AUDIO_FRAME_HEADER_SIZE:
+        raise ValueError(f"Audio frame too short: {len(frame)} bytes")
+    version, frame_type, _flags, seq, capture_ms = AUDIO_FRAME_HEADER.unpack_from(frame)
+    if version != AUDIO_FRAME_VERSION or frame_type != AUDIO_FRAME_INPUT:
+        raise ValueError(
+            f"Unsupported audio frame: version={version}, type={frame_type}"
+        )
+    return seq, capture_ms, memoryview(frame)[AUDIO_FRAME_HEADER_SIZE:]
+
+
+class UplinkAudioStats:
+    """
+    Sequence and timing bookkeeping for framed client audio.
+
+    Capture timestamps come from the client clock, so delay is measured
+    relative to the fastest frame seen so far (queueing delay on the uplink)
+    rather than as absolute one-way latency.
+    """
+
+    def __init__(self):
+        self.expected_seq = None
+        self.frames = 0
+        self.lost_frames = 0
+        self.late_frames = 0
+        self.min_offset_ms = None
+        self.last_delay_ms = 0
+        self.max_delay_ms = 0
+        self.total_delay_ms = 0
+
+    def observe(self, seq, capture_ms, arrival_ms):
+        """Record a frame; returns False for late or duplicate frames"""
+        if self.expected_seq is not None:
+            gap = (seq - self.expected_seq) & 0xFFFFFFFF
+            if gap >= 0x80000000:
+                # Arrived after a newer frame was already forwarded
+                self.late_frames += 1
+                if self.lost_frames:
+                    self.lost_frames -= 1
+                return False
+            self.lost_frames += gap
+        self.expected_seq = (seq + 1) & 0xFFFFFFFF
+        self.frames += 1
+
+        offset_ms = arrival_ms - capture_ms
+        if self.min_offset_ms is None or offset_ms < self.min_offset_ms:
+            self.min_offset_ms = offset_ms
+        self.last_delay_ms = offset_ms - self.min_offset_ms
+        self.max_delay_ms = max(self.max_delay_ms, self.last_delay_ms)
+        self.total_delay_ms += self.last_delay_ms
+        return True
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "lost_frames": self.lost_frames,
+            "late_frames": self.late_frames,
+            "last_delay_ms": round(self.last_delay_ms, 1),
+            "max_delay_ms": round(self.max_delay_ms, 1),
+            "avg_delay_ms": (
+                round(self.total_delay_ms / self.frames, 1) if self.frames else 0
+            ),
+        }
+
+
+AudioFrame = namedtuple("AudioFrame", ["item_id", "content_index", "data"])
+
+
+class AudioFrameCoalescer:
+    """
+    Collects small audio deltas into fixed size frames.
+
+    Frames never span two (item_id, content_index) pairs; switching to a new
+    pair flushes whatever is buffered for the previous one.
+
+    Frame data is a memoryview. Whole frames inside a delta are sliced out of
+    it without copying; only the bytes that straddle deltas are copied, into a
+    frame-sized buffer that is handed off with the frame rather than copied
+    again.
+    """
+
+    def __init__(self, frame_bytes):
+        self.frame_bytes = frame_bytes
+        self.key = None
+        self.buffer = None
+        self.filled = 0
+        self.pending_since = None
+
+    def push(self, item_id, content_index, data, now):
+        """Add a delta and return the frames that are now complete"""
+        frames = []
+        key = (item_id, content_index)
+        if key != self.key:
+            frame = self.flush()
+            if frame:
+                frames.append(frame)
+            self.key = key
+
+        data = memoryview(data)
+        offset = 0
+        if self.filled:
+            # Top up the partial frame first
+            offset = min(len(data), self.frame_bytes - self.filled)
+            self.buffer[self.filled : self.filled + offset] = data[:offset]
+            self.filled += offset
+            if self.filled == self.frame_bytes:
+                frames.append(self._take_buffer())
+
+        while len(data) - offset >= self.frame_bytes:
+            end = offset + self.frame_bytes
+            frames.append(AudioFrame(item_id, content_index, data[offset:end]))
+            offset = end
+
+        if offset < len(data):
+            if self.buffer is None:
+                self.buffer = bytearray(self.frame_bytes)
+            rest = len(data) - offset
+            self.buffer[:rest] = data[offset:]
+            self.filled = rest
+
+        if not self.filled:
+            self.pending_since = None
+        elif self.pending_since is None or frames:
+            self.pending_since = now
+        return frames
+
+    def flush(self):
+        """Return the buffered remainder as a short frame, if any"""
+        if not self.filled:
+            return None
+        return self._take_buffer()
+
+    def clear(self):
+        self.key = None
+        self.filled = 0
+        self.pending_since = None
+
+    def _take_buffer(self):
+        frame = AudioFrame(
+            self.key[0], self.key[1], memoryview(self.buffer)[: self.filled]
+        )
+        # The frame now owns the buffer; the next partial frame gets a new one
+        self.buffer = None
+        self.filled = 0
+        self.pending_since = None
+        return frame
+
+
+# Audio formats a connection can negotiate; names match the realtime API
+AUDIO_FORMATS = ("pcm16", "g711_ulaw", "g711_alaw")
+G711_SAMPLE_RATE = 8000
+
+
+def audio_format_rate(audio_format):
+    """Native sample rate of an audio format"""
+    return 24000 if audio_format == "pcm16" else G711_SAMPLE_RATE
+
+
+def audio_format_bytes_per_second(audio_format):
+    """Wire bytes per second of mono audio in the given format"""
+    sample_bytes = 2 if audio_format == "pcm16" else 1
+    return audio_format_rate(audio_format) * sample_bytes
+
+
+@lru_cache(maxsize=None)
+def g711_tables(audio_format):
+    """
+    (encode, decode) lookup tables for a G.711 law.
+
+    encode maps every PCM16 value, viewed as uint16, to its code byte;
+    decode maps each of the 256 code bytes back to PCM16. Built once with the
+    reference segment search from the ITU/Sun implementation.
+    """
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)
+    codes = np.arange(256, dtype=np.int32)
+    if audio_format == "g711_ulaw":
+        bias = 0x84
+        value = pcm >> 2
+        mask = np.where(value < 0, 0x7F, 0xFF)
+        value = np.minimum(np.abs(value), 8159) + (bias >> 2)
+        seg = np.searchsorted(
+            np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), value
+        )
+        encode = np.where(seg >= 8, 0x7F, (seg << 4) | ((value >> (seg + 1)) & 0x0F))
+        encode ^= mask
+
+        inverted = ~codes & 0xFF
+        magnitude = (((inverted & 0x0F) << 3) + bias) << ((inverted & 0x70) >> 4)
+        decode = np.where(inverted & 0x80, bias - magnitude, magnitude - bias)
+    elif audio_format == "g711_alaw":
+        value = pcm >> 3
+        mask = np.where(value >= 0, 0xD5, 0x55)
+        value = np.where(value >= 0, value, -value - 1)
+        seg = np.searchsorted(
+            np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF]), value
+        )
+        quant = np.where(seg < 2, value >> 1, value >> np.maximum(seg, 1)) & 0x0F
+        encode = np.where(seg >= 8, 0x7F, (seg << 4) | quant)
+        encode ^= mask
+
+        toggled = codes ^ 0x55
+        seg = (toggled & 0x70) >> 4
+        magnitude = ((toggled & 0x0F) << 4) + np.where(seg == 0, 8, 0x108)
+        magnitude <<= np.maximum(seg - 1, 0)
+        decode = np.where(toggled & 0x80, magnitude, -magnitude)
+    else:
+        raise ValueError(f"Not a G.711 format: {audio_format}")
+
+    encode = encode.astype(np.uint8)
+    decode = decode.astype(np.int16)
+    encode.flags.writeable = False
+    decode.flags.writeable = False
+    return encode, decode
+
+
+def g711_encode(pcm16_bytes, audio_format):
+    """Encode PCM16 bytes as G.711 code bytes"""
+    encode, _ = g711_tables(audio_format)
+    return encode[np.frombuffer(pcm16_bytes, dtype=np.uint16)].tobytes()
+
+
+def g711_decode(g711_bytes, audio_format):
+    """Decode G.711 code bytes to PCM16 bytes"""
+    _, decode = g711_tables(audio_format)
+    return decode[np.frombuffer(g711_bytes, dtype=np.uint8)].tobytes()
+
+
+# Client sample rates accepted for resampling to the session rate
+MIN_INPUT_SAMPLE_RATE = 8000
+MAX_INPUT_SAMPLE_RATE = 96000
+MAX_INPUT_CHANNELS = 2
+
+# Taps per polyphase branch; the prototype filter has up * RESAMPLER_TAPS taps
+RESAMPLER_TAPS = 24
+RESAMPLER_ROLLOFF = 0.9
+RESAMPLER_KAISER_BETA = 8.0
+
+
+@lru_cache(maxsize=32)
+def resampler_taps(src_rate, dst_rate):
+    """
+    Polyphase filter bank for converting src_rate to dst_rate.
+
+    Returns (up, down, taps) where taps has shape (up, RESAMPLER_TAPS) and row
+    p holds branch p of a Kaiser-windowed sinc low-pass, already reversed so
+    it can be applied to a window of input samples with a single dot product.
+    Cached per rate pair since every connection at a rate shares the bank.
+    """
+    divisor = gcd(src_rate, dst_rate)
+    up, down = dst_rate // divisor, src_rate // divisor
+    length = up * RESAMPLER_TAPS
+    cutoff = RESAMPLER_ROLLOFF * 0.5 / max(up, down)
+    n = np.arange(length) - (length - 1) / 2
+    prototype = (
+        2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, RESAMPLER_KAISER_BETA)
+    )
+    prototype *= up / prototype.sum()
+    # Branch p uses prototype[p + j * up] against input sample k - j
+    taps = prototype.reshape(RESAMPLER_TAPS, up).T[:, ::-1]
+    taps = np.ascontiguousarray(taps, dtype=np.float32)
+    taps.flags.writeable = False
+    return up, down, taps
+
+
+class AudioResampler:
+    """
+    Streaming PCM16 converter from client audio to the session format.
+
+    Downmixes interleaved multi-channel input to mono and resamples it with
+    a polyphase FIR. Filter history, output phase and any partial sample left
+    at the end of a chunk carry over to the next call, so audio split across
+    WebSocket frames comes out the same as if it had been converted at once.
+    """
+
+    def __init__(self, src_rate, dst_rate, channels=1):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        self.up, self.down, self.taps = resampler_taps(src_rate, dst_rate)
+        self.history = np.zeros(self.taps.shape[1] - 1, dtype=np.float32)
+        # Position of the next output sample within the next chunk, in units
+        # of 1 / up input samples
+        self.phase = 0
+        self.remainder = b""
+        self.window = np.arange(self.taps.shape[1])
+
+    @property
+    def passthrough(self):
+        return self.src_rate == self.dst_rate and self.channels == 1
+
+    def process(self, audio_bytes):
+        """Convert a chunk of PCM16 and return the mono PCM16 produced so far"""
+        if self.passthrough and not self.remainder and not len(audio_bytes) % 2:
+            return audio_bytes
+        if self.remainder:
+            audio_bytes = self.remainder + audio_bytes
+        usable = len(audio_bytes) - len(audio_bytes) % self.frame_bytes
+        self.remainder = bytes(audio_bytes[usable:])
+        samples = np.frombuffer(audio_bytes, dtype=np.int16, count=usable // 2)
+        if self.passthrough:
+            return samples.tobytes()
+
+        if self.channels > 1:
+            mono = samples.reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        else:
+            mono = samples.astype(np.float32)
+        return self._resample(mono)
+
+    def _resample(self, mono):
+        count = len(mono)
+        if self.up == self.down:
+            out = mono
+        else:
+            end = count * self.up
+            positions = np.arange(self.phase, end, self.down)
+            buffer = np.concatenate((self.history, mono))
+            history_len = len(self.history)
+            if len(positions):
+                # Newest input sample used by each output, indexed into buffer
+                newest = positions // self.up + history_len
+                windows = buffer[newest[:, None] - history_len + self.window]
+                out = np.einsum("ij,ij->i", windows, self.taps[positions % self.up])
+                self.phase = int(positions[-1]) + self.down - end
+            else:
+                out = np.empty(0, dtype=np.float32)
+                self.phase -= end
+            self.history = buffer[len(buffer) - history_len :]
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16).tobytes()
+
+
+class AudioConverter:
+    """
+    Streaming conversion between two audio formats.
+
+    G.711 input is expanded to PCM16, resampled/downmixed with AudioResampler
+    and compressed again if the target is G.711. Identical formats at the same
+    rate pass through untouched.
+    """
+
+    def __init__(self, src_format, src_rate, channels, dst_format, dst_rate):
+        self.src_format = src_format
+        self.dst_format = dst_format
+        self.resampler = AudioResampler(src_rate, dst_rate, channels)
+
+    @property
+    def src_rate(self):
+        return self.resampler.src_rate
+
+    @property
+    def channels(self):
+        return self.resampler.channels
+
+    @property
+    def passthrough(self):
+        return self.src_format == self.dst_format and self.resampler.passthrough
+
+    def process(self, audio_bytes):
+        if self.passthrough:
+            return audio_bytes
+        if self.src_format != "pcm16":
+            audio_bytes = g711_decode(audio_bytes, self.src_format)
+        audio_bytes = self.resampler.process(audio_bytes)
+        if self.dst_format != "pcm16":
+            audio_bytes = g711_encode(audio_bytes, self.dst_format)
+        return audio_bytes
+
+
+class EnergyVAD:
+    """
+    Energy / zero-crossing voice activity gate for uplink audio.
+
+    Audio is judged in frame_ms frames: a frame is speech when its RMS level
+    is above threshold_db (dBFS) and its zero-crossing rate is below max_zcr,
+    which rejects broadband hiss that is merely loud. Once speech starts the
+    last preroll_ms of audio is released ahead of it, and the gate stays open
+    for hangover_ms after the last speech frame so word endings and the pause
+    the upstream turn detector listens for are kept. Everything else is
+    suppressed.
+    """
+
+    DEFAULTS = {
+        "enabled": False,
+        "frame_ms": 20,
+        "threshold_db": -45.0,
+        "max_zcr": 0.4,
+        "hangover_ms": 800,
+        "preroll_ms": 300,
+    }
+
+    def __init__(
+        self,
+        audio_format="pcm16",
+        frame_ms=20,
+        threshold_db=-45.0,
+        max_zcr=0.4,
+        hangover_ms=800,
+        preroll_ms=300,
+    ):
+        self.audio_format = audio_format
+        self.bytes_per_second = audio_format_bytes_per_second(audio_format)
+        self.frame_samples = audio_format_rate(audio_format) * frame_ms // 1000
+        self.frame_bytes = self.bytes_per_second * frame_ms // 1000
+        # Mean square of a full-scale PCM16 sine is 0.5 * 32768 ** 2
+        self.threshold = 0.5 * 32768**2 * 10 ** (threshold_db / 10)
+        self.max_zcr = max_zcr
+        self.hangover_frames = hangover_ms // frame_ms
+        self.preroll = deque(maxlen=preroll_ms // frame_ms)
+        self.remainder = b""
+        self.active = False
+        self.hangover_left = 0
+        self.forwarded_bytes = 0
+        self.suppressed_bytes = 0
+
+    @classmethod
+    def from_config(cls, config, audio_format="pcm16"):
+        """Build a gate from a bot's "vad" settings, or None when disabled"""
+        options = {**cls.DEFAULTS, **(config or {})}
+        if not options.pop("enabled"):
+            return None
+        options = {
+            key: type(default)(options[key])
+            for key, default in cls.DEFAULTS.items()
+            if key in options
+        }
+        frame_ms = options["frame_ms"]
+        if frame_ms <= 0 or audio_format_rate(audio_format) * frame_ms // 1000 < 1:
+            logger.error(
+                f"VAD left disabled: {frame_ms}ms frames hold no {audio_format} samples"
+            )
+            return None
+        return cls(audio_format=audio_format, **options)
+
+    def process(self, audio_bytes):
+        """Return the part of audio_bytes (plus released pre-roll) to forward"""
+        if self.remainder:
+            audio_bytes = self.remainder + audio_bytes
+        audio_bytes = memoryview(audio_bytes)
+        count = len(audio_bytes) // self.frame_bytes
+        usable = count * self.frame_bytes
+        self.remainder = bytes(audio_bytes[usable:])
+        if not count:
+            return b""
+
+        voiced = self.classify(audio_bytes[:usable], count)
+        if self.active and voiced.all():
+            # Mid-utterance: forward the chunk without copying it
+            self.hangover_left = self.hangover_frames
+            self.forwarded_bytes += usable
+            return audio_bytes[:usable]
+
+        out = bytearray()
+        for index, is_speech in enumerate(voiced):
+            frame = audio_bytes[
+                index * self.frame_bytes : (index + 1) * self.frame_bytes
+            ]
+            if is_speech:
+                if not self.active:
+                    self.active = True
+                    for held in self.preroll:
+                        out += held
+                    self.preroll.clear()
+                self.hangover_left = self.hangover_frames
+                out += frame
+            elif self.active and self.hangover_left > 0:
+                self.hangover_left -= 1
+                out += frame
+            else:
+                self.active = False
+                if len(self.preroll) == self.preroll.maxlen:
+                    self.suppressed_bytes += self.frame_bytes
+                if self.preroll.maxlen:
+                    self.preroll.append(frame)
+                else:
+                    self.suppressed_bytes += self.frame_bytes
+        self.forwarded_bytes += len(out)
+        return out
+
+    def classify(self, audio_bytes, count):
+        """Speech decision for each of the count frames in audio_bytes"""
+        if self.audio_format == "pcm16":
+            samples = np.frombuffer(audio_bytes, dtype=np.int16)
+        else:
+            samples = np.frombuffer(
+                g711_decode(audio_bytes, self.audio_format), np.int16
+            )
+        frames = samples.reshape(count, self.frame_samples).astype(np.float32)
+        energy = np.mean(frames * frames, axis=1)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (
+            self.frame_samples - 1
+        )
+        return (energy >= self.threshold) & (zcr <= self.max_zcr)
+
+    def stats(self):
+        suppressed = self.suppressed_bytes + sum(len(frame) for frame in self.preroll)
+        return {
+            "forwarded_ms": round(self.forwarded_bytes * 1000 / self.bytes_per_second),
+            "suppressed_ms": round(suppressed * 1000 / self.bytes_per_second),
+        }
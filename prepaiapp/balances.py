@@ -0,0 +1,250 @@
+# pylint: disable=all
+"""Hot cache of credit balances in front of Profile.credits."""
+
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Returned by take() when the cached balance does not cover the amount
+INSUFFICIENT = -1
+
+# Both leave a missing key missing: a balance is only ever cached as a
+# whole, read from the database, never rebuilt from deltas. Both bump the
+# user's generation even then, so a balance read from the database before
+# the change cannot be cached after it (see FILL_SCRIPT)
+TAKE_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+local balance = redis.call('GET', KEYS[1])
+if not balance then return false end
+if tonumber(balance) < tonumber(ARGV[1]) then return -1 end
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+ADD_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+# Caches a balance only if no change has happened since the generation was
+# read, before the balance was; NX: one cached meanwhile is as fresh
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then return 0 end
+if redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3], 'NX') then return 1 end
+return 0
+"""
+FORGET_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return redis.call('DEL', KEYS[1])
+"""
+
+
+def balance_key(user_id):
+    return f"credits:{user_id}"
+
+
+def generation_key(user_id):
+    return f"credits-generation:{user_id}"
+
+
+class RedisBalanceCache:
+    """Balances in Redis, changed only by the guarded scripts above"""
+
+    def __init__(self, url, ttl, timeout=None):
+        # An unreachable Redis must fail fast for get_balance() to fall back
+        # to the database rather than hang the request
+        self.client = redis.Redis.from_url(
+            url, socket_connect_timeout=timeout, socket_timeout=timeout
+        )
+        self.ttl = ttl
+        self.take_script = self.client.register_script(TAKE_SCRIPT)
+        self.add_script = self.client.register_script(ADD_SCRIPT)
+        self.fill_script = self.client.register_script(FILL_SCRIPT)
+        self.forget_script = self.client.register_script(FORGET_SCRIPT)
+
+    def keys(self, user_id):
+        return [balance_key(user_id), generation_key(user_id)]
+
+    def get(self, user_id):
+        balance = self.client.get(balance_key(user_id))
+        return None if balance is None else int(balance)
+
+    def generation(self, user_id):
+        """To read before the balance that is then passed to fill()"""
+        generation = self.client.get(generation_key(user_id))
+        return 0 if generation is None else int(generation)
+
+    def fill(self, user_id, credits, generation):
+        self.fill_script(keys=self.keys(user_id), args=[credits, generation, self.ttl])
+
+    def take(self, user_id, amount):
+        """The new balance, None if not cached or INSUFFICIENT"""
+        return self.take_script(keys=self.keys(user_id), args=[amount, self.ttl])
+
+    def add(self, user_id, amount):
+        """The new balance, or None if not cached"""
+        return self.add_script(keys=self.keys(user_id), args=[amount, self.ttl])
+
+    def forget(self, user_id):
+        self.forget_script(keys=self.keys(user_id), args=[self.ttl])
+
+
+class LocalBalanceCache:
+    """In-process stand-in for RedisBalanceCache, for tests and development"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.balances = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def _get(self, user_id):
+        entry = self.balances.get(user_id)
+        if entry and entry[1] <= time.monotonic():
+            del self.balances[user_id]
+            return None
+        return entry
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self._get(user_id)
+            return entry[0] if entry else None
+
+    def generation(self, user_id):
+        with self.lock:
+            return self.generations.get(user_id, 0)
+
+    def fill(self, user_id, credits, generation):
+        with self.lock:
+            if self.generations.get(user_id, 0) != generation:
+                return
+            if not self._get(user_id):
+                self.balances[user_id] = (credits, time.monotonic() + self.ttl)
+
+    def _changed(self, user_id):
+        self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    def take(self, user_id, amount):
+        with self.lock:
+            self._changed(user_id)
+            entry = self._get(user_id)
+            if not entry:
+                return None
+            if entry[0] < amount:
+                return INSUFFICIENT
+            self.balances[user_id] = (entry[0] - amount, entry[1])
+            return entry[0] - amount
+
+    def add(self, user_id, amount):
+        with self.lock:
+            self._changed(user_id)
+            entry = self._get(user_id)
+            if not entry:
+                return None
+            self.balances[user_id] = (entry[0] + amount, entry[1])
+            return entry[0] + amount
+
+    def forget(self, user_id):
+        with self.lock:
+            self._changed(user_id)
+            self.balances.pop(user_id, None)
+
+
+_caches = {}
+
+
+def get_balance_cache():
+    """The configured balance cache, or None when CREDIT_BALANCE_CACHE is off"""
+    backend = getattr(settings, "CREDIT_BALANCE_CACHE", "")
+    if backend not in ("redis", "local"):
+        return None
+    ttl = getattr(settings, "CREDIT_BALANCE_CACHE_TTL", 300)
+    location = getattr(settings, "CREDIT_BALANCE_CACHE_URL", "")
+    balance_cache = _caches.get((backend, location, ttl))
+    if balance_cache is None:
+        if backend == "redis":
+            balance_cache = RedisBalanceCache(
+                location, ttl, getattr(settings, "CREDIT_BALANCE_CACHE_TIMEOUT", 0.25)
+            )
+        else:
+            balance_cache = LocalBalanceCache(ttl)
+        _caches[(backend, location, ttl)] = balance_cache
+    return balance_cache
+
+
+def get_balance(user_id):
+    """A user's credits, from the cache when it has them"""
+    from .models import Profile
+
+    balance_cache = get_balance_cache()
+    if balance_cache:
+        try:
+            balance = balance_cache.get(user_id)
+            if balance is not None:
+                return balance
+            # Read before the database, so a change committed in between
+            # keeps this read out of the cache
+            generation = balance_cache.generation(user_id)
+        except Exception as e:
+            logger.error(f"Error reading cached balance of user {user_id}: {e}")
+            balance_cache = None
+
+    balance = (
+        Profile.objects.filter(user_id=user_id)
+        .values_list("credits", flat=True)
+        .first()
+    ) or 0
+    if balance_cache:
+        try:
+            balance_cache.fill(user_id, balance, generation)
+        except Exception as e:
+            logger.error(f"Error caching balance of user {user_id}: {e}")
+    return balance
+
+
+def balance_changed(user_id, delta):
+    """
+    Apply a change of Profile.credits to the cached balance once it commits.
+
+    Guarded so the cached balance can never go below zero: if it does not
+    cover a deduction the database made, it was stale and is dropped, as
+    it is whenever Redis cannot be reached.
+    """
+    balance_cache = get_balance_cache()
+    if not balance_cache or not delta:
+        return
+
+    def apply():
+        try:
+            if delta < 0:
+                if balance_cache.take(user_id, -delta) == INSUFFICIENT:
+                    balance_cache.forget(user_id)
+            else:
+                balance_cache.add(user_id, delta)
+        except Exception as e:
+            logger.error(f"Error updating cached balance of user {user_id}: {e}")
+            try:
+                balance_cache.forget(user_id)
+            except Exception:
+                pass
+
+    transaction.on_commit(apply)
+
+
+def forget_balances(user_ids):
+    """Drop cached balances set aside by a direct write to Profile.credits"""
+    balance_cache = get_balance_cache()
+    if not balance_cache:
+        return
+    for user_id in user_ids:
+        try:
+            balance_cache.forget(user_id)
+        except Exception as e:
+            logger.error(f"Error dropping cached balance of user {user_id}: {e}")
@@ -0,0 +1,341 @@
+# pylint: disable=all
+"""Per-second metering of live roleplay sessions, settled once per session."""
+
+import asyncio
+import logging
+import math
+import time
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def meter_cache_key(session_id):
+    return f"roleplay-meter:{session_id}"
+
+
+def session_charge(seconds, per_minute):
+    """Credits owed for seconds of a session, rounded up to a whole credit"""
+    return math.ceil(seconds * per_minute / 60)
+
+
+class BillableSession:
+    """A live session metered by the second while it is registered"""
+
+    def __init__(
+        self,
+        channel_name,
+        user_id,
+        bot_id,
+        rates,
+        creator_id=None,
+        sharer_id=None,
+        share_id=None,
+        session_id=None,
+        budget=None,
+    ):
+        self.channel_name = channel_name
+        self.user_id = user_id
+        self.bot_id = bot_id
+        self.rates = rates
+        self.creator_id = creator_id
+        self.sharer_id = sharer_id
+        self.share_id = share_id
+        self.session_id = session_id
+        # Credits the user had when the session started; None for no limit
+        self.budget = budget
+        self.started_at = None
+        self.stopped_at = None
+        # Credits charged at settlement
+        self.charged = 0
+
+    def seconds(self, now=None):
+        if self.started_at is None:
+            return 0
+        end = self.stopped_at or now or time.monotonic()
+        return int(end - self.started_at)
+
+    def accrued(self, now=None):
+        return session_charge(self.seconds(now), self.rates["per_minute"])
+
+    def state(self, now=None):
+        """What settle_session() needs, as checkpointed to the cache"""
+        return {
+            "session": str(self.session_id),
+            "claim": self.channel_name,
+            "user": self.user_id,
+            "bot": str(self.bot_id),
+            "rates": self.rates,
+            "creator": self.creator_id,
+            "sharer": self.sharer_id,
+            "share": str(self.share_id) if self.share_id else None,
+            "seconds": self.seconds(now),
+            "checkpointed_at": time.time(),
+        }
+
+
+def closed_status(status):
+    """The status a session settles into: an in-progress one ends as status"""
+    return Case(When(status="in_progress", then=Value(status)), default=F("status"))
+
+
+def settle_session(state, status="disconnected"):
+    """
+    Charge a session's metered seconds and pay out its revenue shares.
+
+    Runs once per session: the session row is settled with a conditional
+    UPDATE on settled_at and on the claim of the consumer that metered it,
+    so a consumer and the crash-recovery sweep cannot both settle it. The
+    charge is capped at the user's balance, and a session still in progress
+    ends with the given status in the same UPDATE. Returns the credits charged,
+    or None if the session was settled already or claimed by another
+    consumer.
+    """
+    from .credits import take_credits
+    from .models import CreditShare, RoleplaySession
+
+    rates = state["rates"]
+    owed = session_charge(state["seconds"], rates["per_minute"])
+    with transaction.atomic():
+        charged = take_credits(state["user"], owed, "session_charge", state["session"])
+        if not RoleplaySession.objects.filter(
+            id=state["session"], settled_at__isnull=True, claimed_by=state["claim"]
+        ).update(
+            settled_at=timezone.now(),
+            status=closed_status(status),
+            billed_seconds=state["seconds"],
+            credits_used=charged,
+        ):
+            transaction.set_rollback(True)
+            return None
+        payouts = [
+            ("referral_share", state["sharer"], rates["sharer"]),
+            ("creator_share", state["creator"], rates["creator"]),
+        ]
+        CreditShare.objects.bulk_create(
+            CreditShare(
+                credit=charged * rate // rates["per_minute"],
+                share_id=state["share"],
+                bot_id=state["bot"],
+                session_id=state["session"],
+                credited_to_id=beneficiary_id,
+                credited_from_id=state["user"],
+                credit_reason=reason,
+            )
+            for reason, beneficiary_id, rate in payouts
+            if beneficiary_id and charged * rate // rates["per_minute"]
+        )
+    return charged
+
+
+def sweep_unsettled_sessions(stale_after, chunk_size=500, max_session=None):
+    """
+    Settle sessions whose consumer went away without settling them.
+
+    A session is abandoned once it started more than stale_after seconds
+    ago and its cache checkpoint has not been refreshed for as long; it
+    is settled from the checkpoint. A session without one may still be
+    live in a process whose checkpoint is missing, so it is only marked
+    settled, with nothing to charge, once it is older than the longest a
+    session can run (max_session) plus stale_after. Returns the number of
+    sessions settled and of those only marked.
+    """
+    from .models import RoleplaySession
+
+    if max_session is None:
+        max_session = getattr(settings, "VOICE_AGENT_MAX_SESSION_S", 10800)
+    now = time.time()
+    expired_before = timezone.now() - timedelta(seconds=max_session + stale_after)
+    candidates = (
+        RoleplaySession.objects.filter(
+            settled_at__isnull=True,
+            started_at__lt=timezone.now() - timedelta(seconds=stale_after),
+        )
+        .order_by("started_at")
+        .values_list("id", "started_at")
+    )
+    settled = closed = 0
+    for chunk in chunked(candidates.iterator(chunk_size=chunk_size), chunk_size):
+        checkpoints = cache.get_many([meter_cache_key(id) for id, _ in chunk])
+        for session_id, started_at in chunk:
+            key = meter_cache_key(session_id)
+            state = checkpoints.get(key)
+            if state is None:
+                if started_at >= expired_before:
+                    continue
+                closed += RoleplaySession.objects.filter(
+                    id=session_id, settled_at__isnull=True
+                ).update(
+                    settled_at=timezone.now(), status=closed_status("disconnected")
+                )
+                continue
+            if now - state["checkpointed_at"] < stale_after:
+                # Still metered by a live consumer
+                continue
+            if settle_session(state) is not None:
+                settled += 1
+                RoleplaySession.objects.filter(id=session_id).update(
+                    duration_seconds=state["seconds"]
+                )
+            cache.delete(key)
+    return settled, closed
+
+
+def meters_are_shared():
+    """Whether meter checkpoints in the cache are seen by other processes"""
+    from django.core.cache import caches
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+
+    return not isinstance(caches["default"], (DummyCache, LocMemCache))
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BillingTicker:
+    """
+    Meters every registered session of this process from one task.
+
+    Accrual is arithmetic on the monotonic clock; the database is not
+    touched until a session settles. Each tick tells the consumers of
+    sessions that have used up their budget over the channel layer, as a
+    "billing.insufficient" message, or that have run for max_seconds, as a
+    "billing.expired" one, and every checkpoint interval the
+    accrued seconds of all sessions go to the cache in one round trip,
+    for sweep_unsettled_sessions() should this process die.
+    """
+
+    def __init__(self, tick, checkpoint_interval, max_seconds=None):
+        self.tick = tick
+        self.checkpoint_interval = checkpoint_interval
+        self.max_seconds = max_seconds
+        self.sessions = set()
+        # Registered since the last checkpoint
+        self.fresh = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.loop = None
+        self.next_checkpoint = 0
+        self.checkpoints = 0
+        self.cutoffs = 0
+        self.failures = 0
+
+    def register(self, session):
+        session.started_at = time.monotonic()
+        self.sessions.add(session)
+        self.fresh.add(session)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+
+    def unregister(self, session):
+        """Stop metering a session; its seconds are final from here on"""
+        if session in self.sessions:
+            session.stopped_at = time.monotonic()
+            self.sessions.discard(session)
+            self.fresh.discard(session)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "checkpoints": self.checkpoints,
+            "cutoffs": self.cutoffs,
+            "failures": self.failures,
+        }
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.sessions:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                now = time.monotonic()
+                await self.cut_off_exhausted(now)
+                if now >= self.next_checkpoint:
+                    self.next_checkpoint = now + self.checkpoint_interval
+                    await self.checkpoint(now, self.sessions)
+                elif self.fresh:
+                    # New sessions are on record for the sweep from their
+                    # first tick, not just from the next checkpoint
+                    await self.checkpoint(now, self.fresh)
+                await asyncio.sleep(self.tick)
+        except asyncio.CancelledError:
+            pass
+
+    async def cut_off_exhausted(self, now):
+        channel_layer = get_channel_layer()
+        for session in list(self.sessions):
+            if self.max_seconds and session.seconds(now) >= self.max_seconds:
+                message = "billing.expired"
+            elif session.budget is not None and session.accrued(now) >= session.budget:
+                message = "billing.insufficient"
+            else:
+                continue
+            self.cutoffs += 1
+            self.unregister(session)
+            await channel_layer.send(session.channel_name, {"type": message})
+
+    async def checkpoint(self, now, sessions):
+        sessions = list(sessions)
+        if not sessions:
+            return
+        try:
+            await cache.aset_many(
+                {
+                    meter_cache_key(session.session_id): session.state(now)
+                    for session in sessions
+                },
+                timeout=getattr(settings, "VOICE_AGENT_METER_CACHE_TTL", 86400),
+            )
+            self.checkpoints += 1
+            self.fresh.difference_update(sessions)
+        except Exception as e:
+            # The next checkpoint covers these seconds as well
+            self.failures += 1
+            logger.error(f"Error checkpointing {len(sessions)} meters: {e}")
+
+
+_ticker = None
+
+
+def get_billing_ticker():
+    """The process-wide billing ticker for the running event loop"""
+    global _ticker
+    loop = asyncio.get_running_loop()
+    if _ticker is None or _ticker.loop is not loop:
+        _ticker = BillingTicker(
+            getattr(settings, "VOICE_AGENT_BILLING_TICK", 1),
+            getattr(settings, "VOICE_AGENT_METER_CHECKPOINT", 15),
+            getattr(settings, "VOICE_AGENT_MAX_SESSION_S", 10800),
+        )
+        _ticker.loop = loop
+    return _ticker
+
+
+def billing_stats():
+    return _ticker.stats() if _ticker else None
@@ -14,11 +14,15 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 import asyncio
 import json
 from typing import Any, Dict, Optional
+from urllib.parse import parse_qs
 import base64
 import logging
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 import numpy as np
 from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
 
 from agents.realtime import (
     RealtimeAgent,
@@ -28,10 +32,68 @@ from agents.realtime import (
     RealtimeSessionEvent,
 )
 from agents.realtime.model import RealtimeModelConfig
+from agents.realtime.model_inputs import (
+    RealtimeModelSendRawMessage,
+    RealtimeModelSendSessionUpdate,
+)
+from agents.realtime.openai_realtime import get_server_event_type_adapter
 from agents import function_tool
 
+from .audio import (
+    AUDIO_FORMATS,
+    AUDIO_FRAME_HEADER_SIZE,
+    MAX_INPUT_CHANNELS,
+    MAX_INPUT_SAMPLE_RATE,
+    MIN_INPUT_SAMPLE_RATE,
+    AudioConverter,
+    AudioFrameCoalescer,
+    EnergyVAD,
+    UplinkAudioStats,
+    audio_format_bytes_per_second,
+    audio_format_rate,
+    pack_output_audio_frame,
+    unpack_input_audio_frame,
+)
+from .billing import (
+    BillableSession,
+    get_billing_ticker,
+    meter_cache_key,
+    settle_session,
+)
+from .greetings import (
+    Greeting,
+    GreetingRecorder,
+    get_greeting_store,
+    greeting_key,
+    prompt_hash,
+)
+from .handoff import (
+    PROMPT_CACHE_TIMEOUT,
+    prompt_cache_key,
+    read_handoff_token,
+    roleplay_billing_rates,
+)
+from .metrics import VoiceLatencyTracker
+from .realtime import (
+    create_realtime_model,
+    default_agent,
+    get_session_pool,
+    realtime_model_settings,
+)
+from .streams import InboundAudioBuffer, OutboundQueue
+from .transcripts import (
+    TranscriptIngestor,
+    TranscriptStore,
+    get_transcript_checkpointer,
+    render_transcript,
+)
+
 logger = logging.getLogger(__name__)
 
+# The SDK builds its server event schema on the first RealtimeRunner, which
+# would hold the event loop for ~150ms inside somebody's connect
+get_server_event_type_adapter()
+
 # Audio configuration
 SAMPLE_RATE = 24000
 FORMAT = np.int16
@@ -40,29 +102,128 @@ CHANNELS = 1
 
 
 class VoiceAgentConsumer(AsyncWebsocketConsumer):
+    # Outbound audio is coalesced into frames of this length before sending
+    output_frame_ms = getattr(settings, "VOICE_AGENT_OUTPUT_FRAME_MS", 60)
+    # A partial frame is flushed once its oldest byte has waited this long
+    output_flush_ms = getattr(settings, "VOICE_AGENT_OUTPUT_FLUSH_MS", 40)
+    # How far ahead of real-time playback the sender may run
+    output_lead_ms = getattr(settings, "VOICE_AGENT_OUTPUT_LEAD_MS", 300)
+    # Audio that falls this far behind schedule (slow client) is skipped
+    output_latency_budget_ms = getattr(
+        settings, "VOICE_AGENT_OUTPUT_LATENCY_BUDGET_MS", 500
+    )
+    # Hard cap on queued outbound audio per connection
+    output_max_queue_ms = getattr(settings, "VOICE_AGENT_OUTPUT_MAX_QUEUE_MS", 60000)
+    # Client audio is forwarded upstream in chunks of this length
+    input_chunk_ms = getattr(settings, "VOICE_AGENT_INPUT_CHUNK_MS", 100)
+    # A partial chunk is forwarded once its oldest byte has waited this long
+    input_flush_ms = getattr(settings, "VOICE_AGENT_INPUT_FLUSH_MS", 40)
+    # Capacity of the inbound buffer; the oldest audio is dropped beyond it
+    input_buffer_ms = getattr(settings, "VOICE_AGENT_INPUT_BUFFER_MS", 2000)
+    # Minimum interval between overload notices sent to the client
+    input_notice_interval = 5
+    # Run the realtime session in the client's G.711 format instead of
+    # transcoding to and from PCM16 here
+    session_g711 = getattr(settings, "VOICE_AGENT_SESSION_G711", True)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session: Optional[RealtimeSession] = None
         self.runner: Optional[RealtimeRunner] = None
         self.playback_tracker = RealtimePlaybackTracker()
         self.processed_items = []
-        self.agent = RealtimeAgent(
-            name="Assistant",
-            instructions=(
-                "You are a helpful AI assistant. "
-                "Always respond strictly in English. "
-                "Do not translate, detect, or switch to any other language. "
-                "If the user speaks in another language, politely respond in English only."
-            ),
-            tools=[],
-        )
+        self.agent = default_agent()
         self.session_task: Optional[asyncio.Task] = None
         self.connected = False
+        # Started here so subclasses' pre-accept work counts towards connect
+        self.latency = VoiceLatencyTracker()
+        # Negotiated with the client through an "audio_config" message
+        self.binary_audio_output = False
+        self.binary_audio_input = False
+        self.uplink_stats = UplinkAudioStats()
+        # Converts client audio to the session format when it arrives otherwise
+        self.input_converter: Optional[AudioConverter] = None
+        self.output_audio_seq = 0
+        self.output_item_indexes: Dict[str, int] = {}
+        # Items whose audio was produced here, not streamed by the session
+        self.local_audio_items = set()
+        # Everything sent to the client goes through the outbound queue and is
+        # drained by a per-connection sender task, so a slow client never
+        # blocks the realtime session loop
+        self.sender_task: Optional[asyncio.Task] = None
+        self.playout_deadline = 0.0
+        self.audio_frames_sent = 0
+        self.audio_bytes_sent = 0
+        # Client audio is buffered here and forwarded by the input pump task,
+        # so receive() never waits on the realtime session
+        self.input_pump_task: Optional[asyncio.Task] = None
+        self.input_chunks_sent = 0
+        self.input_send_errors = 0
+        self.input_dropped_notified = 0
+        self.input_overload_notified_at = None
+        self.input_error_notified = False
+        # Optional server-side gate that drops silence before it goes upstream
+        self.input_vad: Optional[EnergyVAD] = None
+        self.configure_audio_format("pcm16")
+
+    def configure_audio_format(self, audio_format: str):
+        """Select the client audio format and size the audio buffers for it"""
+        self.audio_format = audio_format
+        self.session_audio_format = (
+            audio_format if audio_format == "pcm16" or self.session_g711 else "pcm16"
+        )
+        session_rate = audio_format_rate(self.session_audio_format)
+        bytes_per_second = audio_format_bytes_per_second(self.session_audio_format)
+        self.session_bytes_per_second = bytes_per_second
+        self.input_converter = None
+        self.output_converter: Optional[AudioConverter] = None
+        if self.session_audio_format != audio_format:
+            self.output_converter = AudioConverter(
+                self.session_audio_format,
+                session_rate,
+                CHANNELS,
+                audio_format,
+                audio_format_rate(audio_format),
+            )
+
+        frame_bytes = int(bytes_per_second * self.output_frame_ms / 1000) & ~1
+        self.audio_coalescer = AudioFrameCoalescer(frame_bytes)
+        self.outbound = OutboundQueue(bytes_per_second, self.output_max_queue_ms)
+        self.input_chunk_bytes = int(bytes_per_second * self.input_chunk_ms / 1000) & ~1
+        self.input_audio = InboundAudioBuffer(
+            int(bytes_per_second * self.input_buffer_ms / 1000), bytes_per_second
+        )
+
+    def configure_input_vad(self, vad_config: Optional[dict]):
+        """Set up the uplink silence gate from a "vad" settings dict"""
+        try:
+            self.input_vad = EnergyVAD.from_config(
+                vad_config, self.session_audio_format
+            )
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid VAD configuration: {e}")
+
+    def requested_audio_format(self) -> str:
+        """Audio format asked for with the ?codec= query parameter"""
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        audio_format = query.get("codec", ["pcm16"])[0]
+        if audio_format not in AUDIO_FORMATS:
+            logger.warning(f"Unsupported codec requested: {audio_format}")
+            return "pcm16"
+        return audio_format
 
     async def connect(self, config: dict={}):
+        # The codec must be known before the realtime session is configured
+        audio_format = self.requested_audio_format()
+        if audio_format != self.audio_format:
+            self.configure_audio_format(audio_format)
+        self.configure_input_vad(config.get("vad"))
         await self.accept()
+        self.latency.mark_accepted()
         self.connected = True
         logger.info("WebSocket connection established")
+        self.sender_task = asyncio.create_task(self._sender_loop())
+        self.input_pump_task = asyncio.create_task(self._input_pump_loop())
 
         # Start the realtime session
         await self.start_realtime_session(config)
@@ -83,11 +244,14 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
                 data = json.loads(text_data)
                 await self.handle_message(data)
             elif bytes_data:
-                # Handle raw audio data
-                await self.handle_audio_data(bytes_data)
+                if self.binary_audio_input:
+                    await self.handle_audio_frame(bytes_data)
+                else:
+                    # Handle raw audio data
+                    await self.handle_audio_data(bytes_data)
         except Exception as e:
             logger.error(f"Error processing received data: {e}")
-            await self.send(text_data=json.dumps({"type": "error", "message": str(e)}))
+            await self.send_message({"type": "error", "message": str(e)})
 
     async def handle_message(self, data: Dict[str, Any]):
         """Handle JSON messages from client"""
@@ -97,7 +261,7 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
             # Handle base64 encoded audio
             audio_b64 = data.get("audio")
             audio_format = data.get("format", "unknown")
-            sample_rate = data.get("sample_rate", SAMPLE_RATE)
+            sample_rate = data.get("sample_rate", audio_format_rate(audio_format))
             channels = data.get("channels", 1)
 
             if audio_b64:
@@ -105,68 +269,60 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
                     audio_bytes = base64.b64decode(audio_b64)
 
                     # Validate audio format
-                    if (
-                        audio_format == "pcm16"
-                        and sample_rate == SAMPLE_RATE
-                        and channels == 1
-                    ):
-                        await self.handle_audio_data(audio_bytes)
+                    error = self.configure_input_audio(
+                        audio_format, sample_rate, channels
+                    )
+                    if error is None:
+                        await self.handle_audio_data(
+                            self.input_converter.process(audio_bytes)
+                        )
                     else:
                         logger.warning(
                             f"Invalid audio format: {audio_format}, SR: {sample_rate}, Channels: {channels}"
                         )
-                        await self.send(
-                            text_data=json.dumps(
-                                {
-                                    "type": "error",
-                                    "message": f"Invalid audio format. Expected PCM16, 24kHz, mono. Got: {audio_format}, {sample_rate}Hz, {channels}ch",
-                                }
-                            )
-                        )
+                        await self.send_message({"type": "error", "message": error})
 
                 except Exception as e:
                     logger.error(f"Error decoding audio data: {e}")
-                    await self.send(
-                        text_data=json.dumps(
-                            {
-                                "type": "error",
-                                "message": f"Audio decode error: {str(e)}",
-                            }
-                        )
+                    await self.send_message(
+                        {
+                            "type": "error",
+                            "message": f"Audio decode error: {str(e)}",
+                        }
                     )
 
+        elif message_type == "audio_config":
+            await self.handle_audio_config(data)
+
         elif message_type == "start_recording":
             logger.info("Recording started by client")
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "recording_started",
-                        "message": "Voice agent is ready. You can start speaking.",
-                    }
-                )
+            await self.send_message(
+                {
+                    "type": "recording_started",
+                    "message": "Voice agent is ready. You can start speaking.",
+                }
             )
 
         elif message_type == "stop_recording":
             logger.info("Recording stopped by client")
-            await self.send(text_data=json.dumps({"type": "recording_stopped"}))
+            await self.send_message({"type": "recording_stopped"})
 
         elif message_type == "interrupt":
             logger.info("Interrupt requested by client")
             # Clear current response tracking
             self.current_response_id = None
             self.processed_items.clear()
+            self.clear_audio_output()
 
             # Send interrupt to session if available
             if self.session:
                 try:
                     # If there's a way to cancel current response in the session
-                    await self.send(
-                        text_data=json.dumps(
-                            {
-                                "type": "interrupting",
-                                "message": "Interrupting current response...",
-                            }
-                        )
+                    await self.send_message(
+                        {
+                            "type": "interrupting",
+                            "message": "Interrupting current response...",
+                        }
                     )
                 except Exception as e:
                     logger.error(f"Error sending interrupt: {e}")
@@ -176,38 +332,328 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
             # Reset session state
             self.current_response_id = None
             self.processed_items.clear()
+            await self.send_message(
+                {"type": "session_cleared", "message": "Session state cleared"}
+            )
+
+    async def handle_audio_config(self, data: Dict[str, Any]):
+        """Negotiate the audio transport used for this connection"""
+        self.binary_audio_output = bool(data.get("binary_output", False))
+        ack = {
+            "type": "audio_config_ack",
+            "binary_output": self.binary_audio_output,
+            "header_size": AUDIO_FRAME_HEADER_SIZE,
+            "format": self.audio_format,
+            "sample_rate": audio_format_rate(self.audio_format),
+            "channels": CHANNELS,
+        }
+
+        if data.get("binary_input"):
+            # Input format is fixed once here instead of on every chunk
+            audio_format = data.get("input_format", self.audio_format)
+            sample_rate = data.get("sample_rate", audio_format_rate(audio_format))
+            channels = data.get("channels", 1)
+            error = self.configure_input_audio(audio_format, sample_rate, channels)
+            if error is None:
+                self.binary_audio_input = True
+                self.uplink_stats = UplinkAudioStats()
+            else:
+                ack["error"] = error
+        ack["binary_input"] = self.binary_audio_input
+
+        logger.info(
+            f"Audio config negotiated: binary_output={self.binary_audio_output}, binary_input={self.binary_audio_input}"
+        )
+        await self.send_message(ack)
+
+    def configure_input_audio(self, audio_format, sample_rate, channels):
+        """Prepare conversion of client audio; returns an error message if unsupported"""
+        if (
+            audio_format not in AUDIO_FORMATS
+            or not isinstance(sample_rate, int)
+            or not MIN_INPUT_SAMPLE_RATE <= sample_rate <= MAX_INPUT_SAMPLE_RATE
+            or channels not in range(1, MAX_INPUT_CHANNELS + 1)
+        ):
+            return (
+                f"Invalid audio format. Expected {'/'.join(AUDIO_FORMATS)}, "
+                f"{MIN_INPUT_SAMPLE_RATE}-{MAX_INPUT_SAMPLE_RATE}Hz, 1-{MAX_INPUT_CHANNELS}ch. "
+                f"Got: {audio_format}, {sample_rate}Hz, {channels}ch"
+            )
+        converter = self.input_converter
+        if converter is None or (
+            converter.src_format,
+            converter.src_rate,
+            converter.channels,
+        ) != (audio_format, sample_rate, channels):
+            session_rate = audio_format_rate(self.session_audio_format)
+            self.input_converter = AudioConverter(
+                audio_format,
+                sample_rate,
+                channels,
+                self.session_audio_format,
+                session_rate,
+            )
+            if not self.input_converter.passthrough:
+                logger.info(
+                    f"Converting client audio from {audio_format} {sample_rate}Hz, {channels}ch "
+                    f"to {self.session_audio_format} {session_rate}Hz mono"
+                )
+        return None
+
+    async def handle_audio_frame(self, frame: bytes):
+        """Handle a framed binary audio chunk negotiated via audio_config"""
+        seq, capture_ms, payload = unpack_input_audio_frame(frame)
+        if not self.uplink_stats.observe(seq, capture_ms, time.monotonic() * 1000):
+            # Late or duplicate frame; newer audio was already forwarded
+            return
+        await self.handle_audio_data(self.input_converter.process(payload))
+
+    async def send_audio_frame(
+        self, item_id: str, content_index: int, audio_bytes: bytes
+    ):
+        """Send a frame of assistant audio in the negotiated transport"""
+        if self.output_converter:
+            audio_bytes = self.output_converter.process(audio_bytes)
+        if not self.binary_audio_output:
+            audio_b64 = base64.b64encode(audio_bytes).decode("utf-8")
             await self.send(
                 text_data=json.dumps(
-                    {"type": "session_cleared", "message": "Session state cleared"}
+                    {
+                        "type": "audio",
+                        "audio": audio_b64,
+                        "item_id": item_id,
+                        "content_index": content_index,
+                        "format": self.audio_format,
+                        "sample_rate": audio_format_rate(self.audio_format),
+                        "channels": CHANNELS,
+                    }
                 )
             )
+            return
+
+        item_index = self.output_item_indexes.get(item_id)
+        if item_index is None:
+            # Announce the item once so binary frames only carry a small index
+            item_index = len(self.output_item_indexes)
+            self.output_item_indexes[item_id] = item_index
+            await self.send(
+                text_data=json.dumps(
+                    {"type": "audio_item", "item_index": item_index, "item_id": item_id}
+                )
+            )
+
+        frame = pack_output_audio_frame(
+            item_index, content_index, self.output_audio_seq, audio_bytes
+        )
+        self.output_audio_seq += 1
+        await self.send(bytes_data=frame)
+
+    async def send_message(
+        self, message: Dict[str, Any], priority: int = OutboundQueue.CONTROL
+    ):
+        """Queue a JSON message for the client"""
+        self.outbound.put(json.dumps(message), priority)
+
+    def queue_audio_output(self, frame):
+        """Queue a coalesced audio frame for the sender task"""
+        self.outbound.put_audio(frame, time.monotonic())
+
+    def queue_local_audio(self, item_id: str, audio: bytes):
+        """Queue a complete clip of session-format audio as an assistant item"""
+        self.latency.mark_audio()
+        self.local_audio_items.add(item_id)
+        for frame in self.audio_coalescer.push(item_id, 0, audio, time.monotonic()):
+            self.queue_audio_output(frame)
+        frame = self.audio_coalescer.flush()
+        if frame:
+            self.queue_audio_output(frame)
+        self.outbound.put(json.dumps({"type": "audio_end"}), OutboundQueue.AUDIO)
+
+    def clear_audio_output(self):
+        """Drop audio that has not been sent yet"""
+        self.audio_coalescer.clear()
+        self.outbound.clear_audio()
+        self.playout_deadline = 0.0
+
+    async def _sender_loop(self):
+        """Drain the outbound queue; audio is paced and skipped once stale"""
+        try:
+            while self.connected:
+                now = time.monotonic()
+                flush_at = None
+                if self.audio_coalescer.pending_since is not None:
+                    flush_at = (
+                        self.audio_coalescer.pending_since + self.output_flush_ms / 1000
+                    )
+                    if now >= flush_at:
+                        # Partial frame waited long enough; send it short
+                        self.queue_audio_output(self.audio_coalescer.flush())
+                        flush_at = None
+
+                message = self.outbound.pop_message()
+                if message is not None:
+                    await self.send(text_data=message)
+                    continue
+
+                timeout = None
+                entry = self.outbound.audio_head()
+                if isinstance(entry, str):
+                    # Stream markers such as audio_end stay ordered after the audio
+                    self.outbound.pop_audio()
+                    await self.send(text_data=entry)
+                    continue
+                if entry is not None:
+                    timeout = await self._send_audio_entry(entry, now)
+                    if timeout is None:
+                        continue
+
+                if flush_at is not None:
+                    flush_in = flush_at - now
+                    timeout = flush_in if timeout is None else min(timeout, flush_in)
+                await self.outbound.wait(timeout)
+
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in outbound sender loop: {e}")
+
+    async def _send_audio_entry(self, entry, now: float):
+        """Send, skip or hold back the audio frame at the head of the queue.
+
+        Returns how long to wait before the frame is due, or None once the
+        frame has been consumed.
+        """
+        queued_at, frame = entry
+        duration = len(frame.data) / self.session_bytes_per_second
+        # Keep the client at most output_lead_ms ahead of real-time playback
+        due = max(queued_at, self.playout_deadline - self.output_lead_ms / 1000)
+        if due > now:
+            return due - now
+
+        if now - due > self.output_latency_budget_ms / 1000:
+            # The client fell behind; skip stale audio instead of piling up latency
+            self.outbound.drop_audio_head()
+            self.playout_deadline = max(self.playout_deadline, queued_at) + duration
+            return None
+
+        self.outbound.pop_audio()
+        self.playout_deadline = max(self.playout_deadline, now) + duration
+        await self.send_audio_frame(frame.item_id, frame.content_index, frame.data)
+        self.audio_frames_sent += 1
+        self.audio_bytes_sent += len(frame.data)
+
+        if frame.item_id in self.local_audio_items:
+            # The upstream session has no audio to track for this item
+            return None
+
+        # Update playback tracker
+        try:
+            self.playback_tracker.on_play_bytes(
+                item_id=frame.item_id,
+                item_content_index=frame.content_index,
+                bytes=frame.data,
+            )
+        except Exception as e:
+            logger.error(f"Playback tracker error: {e}")
+        return None
 
     async def handle_audio_data(self, audio_bytes: bytes):
-        """Send audio data to the realtime session"""
-        if self.session and self.connected:
-            try:
-                await self.session.send_audio(audio_bytes)
-            except Exception as e:
-                logger.error(f"Error sending audio to session: {e}")
+        """Queue client audio for the realtime session"""
+        if not (audio_bytes and self.session and self.connected):
+            return
+        if self.input_vad:
+            audio_bytes = self.input_vad.process(audio_bytes)
+            if not audio_bytes:
+                return
+        now = time.monotonic()
+        self.input_audio.write(audio_bytes, now)
+        if self.input_audio.dropped_bytes > self.input_dropped_notified:
+            await self.notify_input_overload(now)
+
+    async def notify_input_overload(self, now: float):
+        """Tell the client (at most every input_notice_interval) that audio was dropped"""
+        if (
+            self.input_overload_notified_at is not None
+            and now - self.input_overload_notified_at < self.input_notice_interval
+        ):
+            return
+        dropped_ms = (
+            (self.input_audio.dropped_bytes - self.input_dropped_notified)
+            * 1000
+            / self.input_audio.bytes_per_second
+        )
+        self.input_dropped_notified = self.input_audio.dropped_bytes
+        self.input_overload_notified_at = now
+        logger.warning(f"Inbound audio overloaded, dropped {dropped_ms:.0f} ms")
+        await self.send_message(
+            {
+                "type": "audio_input_overload",
+                "dropped_ms": round(dropped_ms),
+                "message": "Your audio is arriving faster than it can be processed; some of it was skipped.",
+            }
+        )
+
+    async def _input_pump_loop(self):
+        """Forward buffered client audio to the realtime session in chunks"""
+        try:
+            while self.connected:
+                buffered = self.input_audio
+                if buffered.size < self.input_chunk_bytes:
+                    timeout = None
+                    if buffered.pending_since is not None:
+                        timeout = (
+                            buffered.pending_since
+                            + self.input_flush_ms / 1000
+                            - time.monotonic()
+                        )
+                    if timeout is None or timeout > 0:
+                        await buffered.wait(timeout)
+                        continue
+
+                chunk = buffered.read(self.input_chunk_bytes)
+                session = self.session
+                if not session:
+                    continue
+                try:
+                    await session.send_audio(chunk)
+                    self.input_chunks_sent += 1
+                    self.input_error_notified = False
+                except Exception as e:
+                    self.input_send_errors += 1
+                    if not self.input_error_notified:
+                        # Report once per failure streak rather than per chunk
+                        self.input_error_notified = True
+                        logger.error(f"Error sending audio to session: {e}")
+                        await self.send_message(
+                            {
+                                "type": "error",
+                                "code": "audio_upstream",
+                                "message": "Your audio could not be delivered to the assistant.",
+                            }
+                        )
+
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in inbound audio pump: {e}")
 
     async def start_realtime_session(self, config: dict={}):
         """Initialize and start the realtime session"""
         try:
-            self.runner = RealtimeRunner(self.agent)
+            self.runner = RealtimeRunner(self.agent, model=create_realtime_model())
+            self.model_settings = realtime_model_settings(
+                self.session_audio_format, config.get("voice", "alloy")
+            )
+            # What the upstream session is running with; see sync_session()
+            self.session_agent = self.agent
+            self.session_base_settings = dict(self.model_settings)
+            self.session_settings = dict(self.model_settings)
+            self.session_pool = get_session_pool()
             model_config: RealtimeModelConfig = {
                 # "model" : "gpt-4o-mini-audio-preview",
                 "playback_tracker": self.playback_tracker,
                 
-                "initial_model_settings": {
-                    "voice": config.get("voice", "alloy"),
-                    "turn_detection": {
-                        "type": "semantic_vad",
-                        "interrupt_response": True,
-                        "create_response": True,
-                    },
-                    "input_audio_transcription": {"model": "whisper-1"},
-                    "output_audio_transcription": {"model": "whisper-1"},
-                },
+                "initial_model_settings": dict(self.model_settings),
             }
 
             # Start the session in a background task
@@ -215,30 +661,43 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
 
         except Exception as e:
             logger.error(f"Error starting realtime session: {e}")
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "error",
-                        "message": f"Failed to start voice agent: {str(e)}",
-                    }
-                )
+            await self.send_message(
+                {
+                    "type": "error",
+                    "message": f"Failed to start voice agent: {str(e)}",
+                }
             )
 
     async def _run_session(self, model_config: RealtimeModelConfig):
         """Run the realtime session and handle events"""
         try:
-            async with await self.runner.run(model_config=model_config) as session:
+            pooled = self.session_pool.checkout() if self.session_pool else None
+            if pooled:
+                # Already connected with the pool's placeholder agent and
+                # default settings; sync_session() below replaces both
+                self.playback_tracker = pooled.playback_tracker
+                self.session_agent = pooled.agent
+                self.session_base_settings = pooled.model_settings
+                self.session_settings = dict(pooled.model_settings)
+                session_context = pooled
+            else:
+                session_context = await self.runner.run(model_config=model_config)
+
+            async with session_context as session:
+                await self.prepare_session(session)
+                await self.sync_session(session)
                 self.session = session
-                logger.info("Realtime session started")
+                logger.info(
+                    f"Realtime session started ({'pooled' if pooled else 'cold'})"
+                )
 
-                await self.send(
-                    text_data=json.dumps(
-                        {
-                            "type": "session_ready",
-                            "message": "Voice agent connected and ready",
-                        }
-                    )
+                await self.send_message(
+                    {
+                        "type": "session_ready",
+                        "message": "Voice agent connected and ready",
+                    }
                 )
+                self.latency.mark_session_ready()
 
                 # Process session events
                 async for event in session:
@@ -249,91 +708,111 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Session error: {e}")
             if self.connected:
-                await self.send(
-                    text_data=json.dumps(
-                        {"type": "error", "message": f"Session error: {str(e)}"}
-                    )
+                await self.send_message(
+                    {"type": "error", "message": f"Session error: {str(e)}"}
                 )
 
+    async def prepare_session(self, session: RealtimeSession):
+        """Hook run once the upstream session is connected.
+
+        Runs before sync_session() applies self.agent and self.model_settings
+        to the session. Client audio is not forwarded and session_ready is not
+        sent until it returns; raising aborts the session.
+        """
+
+    async def sync_session(self, session: RealtimeSession):
+        """Bring the upstream session in line with self.agent and self.model_settings
+
+        Only valid before the session has produced audio, as the voice cannot
+        change after that.
+        """
+        if self.agent is not self.session_agent:
+            # update_agent() resends the settings the session was opened with
+            await session.update_agent(self.agent)
+            self.session_agent = self.agent
+            self.session_settings = dict(self.session_base_settings)
+        if self.session_settings != self.model_settings:
+            # A session.update replaces every setting, so send the agent's too
+            await session.model.send_event(
+                RealtimeModelSendSessionUpdate(
+                    session_settings={
+                        **self.model_settings,
+                        "instructions": self.agent.instructions,
+                        "tools": self.agent.tools,
+                        "handoffs": self.agent.handoffs,
+                    }
+                )
+            )
+            self.session_settings = dict(self.model_settings)
+
     async def _handle_session_event(self, event: RealtimeSessionEvent):
         """Handle events from the realtime session"""
         try:
             if event.type == "agent_start":
-                await self.send(
-                    text_data=json.dumps(
-                        {"type": "agent_start", "agent_name": event.agent.name}
-                    )
+                await self.send_message(
+                    {"type": "agent_start", "agent_name": event.agent.name}
                 )
 
             elif event.type == "agent_end":
-                await self.send(
-                    text_data=json.dumps(
-                        {"type": "agent_end", "agent_name": event.agent.name}
-                    )
+                await self.send_message(
+                    {"type": "agent_end", "agent_name": event.agent.name}
                 )
 
             elif event.type == "tool_start":
-                await self.send(
-                    text_data=json.dumps(
-                        {"type": "tool_start", "tool_name": event.tool.name}
-                    )
+                await self.send_message(
+                    {"type": "tool_start", "tool_name": event.tool.name}
                 )
 
             elif event.type == "tool_end":
-                await self.send(
-                    text_data=json.dumps(
-                        {
-                            "type": "tool_end",
-                            "tool_name": event.tool.name,
-                            "output": str(event.output),
-                        }
-                    )
+                await self.send_message(
+                    {
+                        "type": "tool_end",
+                        "tool_name": event.tool.name,
+                        "output": str(event.output),
+                    }
                 )
 
             elif event.type == "audio":
-                # Send audio data back to client
-                np_audio = np.frombuffer(event.audio.data, dtype=np.int16)
-                audio_b64 = base64.b64encode(np_audio.tobytes()).decode("utf-8")
-
-                await self.send(
-                    text_data=json.dumps(
-                        {
-                            "type": "audio",
-                            "audio": audio_b64,
-                            "item_id": event.item_id,
-                            "content_index": event.content_index,
-                            "sample_rate": SAMPLE_RATE,
-                            "channels": CHANNELS,
-                        }
-                    )
+                self.latency.mark_audio()
+                # Coalesce deltas; the sender task delivers the frames
+                frames = self.audio_coalescer.push(
+                    event.item_id,
+                    event.content_index,
+                    event.audio.data,
+                    time.monotonic(),
                 )
-
-                # Update playback tracker
-                try:
-                    self.playback_tracker.on_play_bytes(
-                        item_id=event.item_id,
-                        item_content_index=event.content_index,
-                        bytes=np_audio.tobytes(),
-                    )
-                except Exception as e:
-                    logger.error(f"Playback tracker error: {e}")
+                for frame in frames:
+                    self.queue_audio_output(frame)
+                if self.audio_coalescer.pending_since is not None:
+                    self.outbound.notify()
 
             elif event.type == "audio_end":
-                await self.send(text_data=json.dumps({"type": "audio_end"}))
+                frame = self.audio_coalescer.flush()
+                if frame:
+                    self.queue_audio_output(frame)
+                self.outbound.put(
+                    json.dumps({"type": "audio_end"}), OutboundQueue.AUDIO
+                )
 
             elif event.type == "audio_interrupted":
-                await self.send(text_data=json.dumps({"type": "audio_interrupted"}))
+                self.clear_audio_output()
+                await self.send_message({"type": "audio_interrupted"})
 
             elif event.type == "error":
-                await self.send(
-                    text_data=json.dumps({"type": "error", "message": str(event.error)})
-                )
+                await self.send_message({"type": "error", "message": str(event.error)})
 
             elif event.type in ["history_updated", "history_added"]:
                 # Skip frequent events to reduce noise
                 pass
 
             elif event.type == "raw_model_event":
+                raw = getattr(event.data, "data", None)
+                if (
+                    isinstance(raw, dict)
+                    and raw.get("type") == "input_audio_buffer.speech_stopped"
+                ):
+                    # Upstream turn detection saw the end of the user's speech
+                    self.latency.mark_speech_stopped()
                 # Optionally log or handle raw model events
                 logger.debug(f"Raw model event: {str(event.data)[:200]}")
 
@@ -343,6 +822,20 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
     async def cleanup_session(self):
         """Clean up the realtime session"""
         try:
+            if self.sender_task and not self.sender_task.done():
+                self.sender_task.cancel()
+                try:
+                    await self.sender_task
+                except asyncio.CancelledError:
+                    pass
+
+            if self.input_pump_task and not self.input_pump_task.done():
+                self.input_pump_task.cancel()
+                try:
+                    await self.input_pump_task
+                except asyncio.CancelledError:
+                    pass
+
             if self.session_task and not self.session_task.done():
                 self.session_task.cancel()
                 try:
@@ -352,6 +845,17 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
 
             self.session = None
             self.runner = None
+            if self.binary_audio_input:
+                logger.info(f"Uplink audio stats: {self.uplink_stats.as_dict()}")
+            logger.info(
+                f"Outbound audio: {self.audio_frames_sent} frames, {self.audio_bytes_sent} bytes, queue: {self.outbound.stats()}"
+            )
+            logger.info(
+                f"Inbound audio: {self.input_chunks_sent} chunks, {self.input_send_errors} send errors, buffer: {self.input_audio.stats()}"
+            )
+            if self.input_vad:
+                logger.info(f"Inbound VAD: {self.input_vad.stats()}")
+            logger.info(f"Latency: {self.latency.as_dict()}")
             logger.info("Session cleaned up")
 
         except Exception as e:
@@ -362,32 +866,78 @@ class VoiceAgentConsumer(AsyncWebsocketConsumer):
 
 
 class RoleplayConsumer(VoiceAgentConsumer):
+    # Conversation item id of a greeting replayed from the cache
+    greeting_item_id = "greeting"
+    # Longest greeting worth caching
+    greeting_max_ms = 30000
+    # The transcript follows item events; a history snapshot is folded in
+    # at most this often to catch anything they missed
+    transcript_reconcile_s = getattr(settings, "VOICE_AGENT_TRANSCRIPT_RECONCILE_S", 30)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.roleplay_bot = None
         self.roleplay_session = None
-        self.current_transcript = []  # Store the complete transcript
-        self.last_processed_item_count = 0  # Track processed items to avoid duplicates
+        # Transcript turns by item_id, kept up to date from item events and
+        # appended to the session's TranscriptSegment rows as they change
+        self.current_transcript = TranscriptStore()
+        self.transcript_ingestor = TranscriptIngestor(
+            self.current_transcript, self.format_turn, self.checkpoint_turn
+        )
+        self.transcript_reconciled_at = time.monotonic()
         self.session_start_time = None
-        self.credit_deduction_task = None
-        self.credits_deducted = 0
+        # Metered by the process billing ticker while the roleplay runs and
+        # settled once when it ends
+        self.billing = None
+        self.billable = None
+        self.billing_budget = None
+        self.billing_settled = False
+        self.context_task = None
         self.roleplay_ended = False
         self.share_data = None
         self.bot_creator = None  # To store the creator of the bot
         self.bot_shared_by = None  # To store who shared the bot, if applicable
+        self.billing_rates = None
+        # Opening greeting, replayed from the greeting cache when there is one
+        self.greeting_store = None
+        self.greeting_task = None
+        self.greeting = None
+        self.greeting_recorder = None
+        self.greeting_ends_at = None
         
 
 
     async def connect(self):
         # Get bot ID from URL
         self.session_id = self.scope["url_route"]["kwargs"]["session_id"]
-        # Load roleplay bot and create session
-        await self.load_roleplay_context()
-        time.sleep(5)  # Simulate delay for testing
+        self.session_start_time = timezone.now()
 
-        if not self.roleplay_bot:
+        # Accept right away and start the upstream session with a placeholder
+        # agent; the bot is loaded from the DB meanwhile and applied to the
+        # session once both are ready, before any audio flows
+        await super().connect()
+        await self.send_connect_progress("accepted", "Connecting...")
+        self.context_task = asyncio.create_task(self.prepare_roleplay_context())
+
+    async def send_connect_progress(self, stage: str, message: str):
+        await self.send_message(
+            {"type": "connect_progress", "stage": stage, "message": message}
+        )
+
+    async def prepare_roleplay_context(self) -> bool:
+        """Load the bot and session record and build the roleplay agent"""
+        loaded = await self.load_handoff_context() or await self.load_roleplay_context()
+        if loaded and self.roleplay_bot and not await self.claim_session():
+            logger.warning(
+                f"Roleplay session {self.session_id} is settled or live elsewhere"
+            )
+            loaded = False
+        if not loaded or not self.roleplay_bot:
+            await self.send_message(
+                {"type": "error", "message": "Roleplay session could not be loaded"}
+            )
             await self.close()
-            return
+            return False
 
         # Create agent with dynamic instructions from bot
         self.agent = RealtimeAgent(
@@ -395,122 +945,324 @@ class RoleplayConsumer(VoiceAgentConsumer):
             instructions=self.get_roleplay_instructions(),
             tools=[],  # Add roleplay-specific tools if needed
         )
-        config = {
-            "voice": self.roleplay_bot.voice if self.roleplay_bot.voice else "alloy"
-        }
-        
-        if self.roleplay_bot:
-            self.credit_deduction_task = asyncio.create_task(self.credit_deduction_loop())
+        custom_configuration = self.roleplay_bot.custom_configuration or {}
+        # e.g. {"vad": {"enabled": true, "threshold_db": -45, "hangover_ms": 800}}
+        self.configure_input_vad(custom_configuration.get("vad"))
+        self.greeting_store = get_greeting_store()
+        if self.greeting_store and custom_configuration.get("greeting", True):
+            # Plays while the upstream session is still connecting
+            self.greeting_task = asyncio.create_task(self.play_cached_greeting())
+        self.start_billing()
+        await self.send_connect_progress(
+            "context_loaded", f"Preparing {self.roleplay_bot.name}..."
+        )
+        return True
+
+    async def prepare_session(self, session: RealtimeSession):
+        """Wait for the bot so sync_session() applies it to the upstream session"""
+        if not await self.context_task:
+            raise RuntimeError("Roleplay context unavailable")
+        self.model_settings["voice"] = self.roleplay_bot.voice or "alloy"
+
+    async def sync_session(self, session: RealtimeSession):
+        """Apply the bot, then start or account for its greeting"""
+        await super().sync_session(session)
+        if not self.greeting_task:
+            return
+        await self.greeting_task
+        if self.greeting:
+            # Already playing from the cache; the model only needs its text
+            await session.model.send_event(
+                RealtimeModelSendRawMessage(
+                    message={
+                        "type": "conversation.item.create",
+                        "other_data": {
+                            "item": {
+                                "id": self.greeting_item_id,
+                                "type": "message",
+                                "role": "assistant",
+                                "content": [
+                                    {
+                                        "type": "output_text",
+                                        "text": self.greeting.transcript,
+                                    }
+                                ],
+                            }
+                        },
+                    }
+                )
+            )
+        elif self.greeting_recorder:
+            # Nothing cached yet; greet live and keep the recording
+            await session.model.send_event(
+                RealtimeModelSendRawMessage(message={"type": "response.create"})
+            )
 
-        self.session_start_time = timezone.now()
-        await super().connect(config)
-    async def credit_deduction_loop(self):
-        """Deduct credits every minute during active session"""
+    def current_greeting_key(self) -> str:
+        bot = self.roleplay_bot
+        return greeting_key(
+            bot.id, bot.voice or "alloy", bot.system_prompt, self.session_audio_format
+        )
+
+    async def play_cached_greeting(self):
+        """Stream the bot's cached greeting, or arrange for it to be recorded"""
+        key = self.current_greeting_key()
         try:
-            while self.connected and not self.roleplay_ended:
-                await asyncio.sleep(60)  # Wait 1 minute
-                
-                if self.connected and not self.roleplay_ended:
-                    success = await self.deduct_user_credit()
-                    if not success:
-                        # If credit deduction fails, end the session
-                        await self.handle_insufficient_credits()
-                        break
-                        
-        except asyncio.CancelledError:
-            logger.info("Credit deduction task cancelled")
+            greeting = await sync_to_async(
+                self.greeting_store.get, thread_sensitive=False
+            )(key)
+        except Exception as e:
+            logger.error(f"Error loading cached greeting {key}: {e}")
+            return
+        if greeting is None:
+            max_bytes = int(self.session_bytes_per_second * self.greeting_max_ms / 1000)
+            self.greeting_recorder = GreetingRecorder(key, max_bytes)
+            return
+        self.greeting = greeting
+        self.queue_local_audio(self.greeting_item_id, greeting.audio)
+        self.greeting_ends_at = (
+            time.monotonic() + len(greeting.audio) / self.session_bytes_per_second
+        )
+
+    async def record_greeting(self, event: RealtimeSessionEvent):
+        """Feed the live greeting's audio to the recorder"""
+        recorder = self.greeting_recorder
+        if event.type == "audio":
+            recorder.add_audio(event.item_id, event.audio.data)
+        elif event.type == "audio_end":
+            recorder.end_audio(event.item_id)
+        elif event.type == "audio_interrupted":
+            # Cut off mid-sentence; the next session records it again
+            recorder.abandoned = True
+        if recorder.abandoned:
+            self.greeting_recorder = None
+
+    def save_recorded_greeting(self):
+        """Cache the recorded greeting once its transcript is known"""
+        recorder = self.greeting_recorder
+        item = self.current_transcript.get(recorder.item_id)
+        if item is None:
+            return
+        self.greeting_recorder = None
+        greeting = Greeting(item["content"], bytes(recorder.audio))
+        self.greeting_task = asyncio.create_task(
+            self.store_greeting(recorder.key, greeting)
+        )
+
+    async def store_greeting(self, key: str, greeting: Greeting):
+        try:
+            await sync_to_async(self.greeting_store.put, thread_sensitive=False)(
+                key, greeting
+            )
+            logger.info(f"Cached greeting {key}")
+        except Exception as e:
+            logger.error(f"Error caching greeting {key}: {e}")
+
+    @database_sync_to_async
+    def claim_session(self):
+        """
+        Make this consumer the only one to meter and settle the session.
+
+        False once the session is settled, so a replayed handoff token
+        cannot start it again, or while another consumer holds it.
+        """
+        from .models import RoleplaySession
+
+        return bool(
+            RoleplaySession.objects.filter(
+                id=self.session_id, settled_at__isnull=True, claimed_by=""
+            ).update(claimed_by=self.channel_name)
+        )
+
+    @property
+    def credits_deducted(self):
+        return self.billable.charged if self.billable else 0
+
+    def start_billing(self):
+        """Have the process billing ticker meter this session by the second"""
+        self.billable = BillableSession(
+            self.channel_name,
+            self.scope["user"].id,
+            self.roleplay_bot.id,
+            self.billing_rates,
+            creator_id=self.bot_creator.id if self.bot_creator else None,
+            sharer_id=self.bot_shared_by.id if self.bot_shared_by else None,
+            share_id=self.share_data.id if self.share_data else None,
+            session_id=self.roleplay_session.id,
+            budget=self.billing_budget,
+        )
+        self.billing = get_billing_ticker()
+        self.billing.register(self.billable)
+
+    async def settle_billing(self, status="disconnected"):
+        """Stop metering and charge the metered seconds, once, closing the session"""
+        if not self.billing or self.billing_settled:
+            return
+        self.billing_settled = True
+        self.billing.unregister(self.billable)
+        try:
+            charged = await database_sync_to_async(settle_session)(
+                self.billable.state(), status
+            )
+            await cache.adelete(meter_cache_key(self.billable.session_id))
         except Exception as e:
-            logger.error(f"Error in credit deduction loop: {e}")
-            
+            # The checkpoint stays behind for the sweep to settle
+            logger.error(f"Error settling roleplay session {self.session_id}: {e}")
+            return
+        if charged is None:
+            # Only the claim holder meters a session, and it settles once
+            logger.error(
+                f"Roleplay session {self.session_id} lost its claim; "
+                f"{self.billable.seconds()} metered seconds were not charged"
+            )
+        else:
+            self.billable.charged = charged
+
+    async def billing_insufficient(self, event):
+        """Channel layer message from the billing ticker: the budget ran out"""
+        if self.connected and not self.roleplay_ended:
+            await self.handle_insufficient_credits()
+
+    async def billing_expired(self, event):
+        """Channel layer message from the billing ticker: the session ran its maximum length"""
+        if self.connected and not self.roleplay_ended:
+            await self.send_message(
+                {
+                    "type": "session_expired",
+                    "message": "This roleplay session has reached its maximum length and will end.",
+                    "credits_used": self.credits_deducted,
+                }
+            )
+            await self.handle_end_roleplay()
+
     async def handle_insufficient_credits(self):
         """Handle case when user runs out of credits"""
-        await self.send(text_data=json.dumps({
-            "type": "insufficient_credits",
-            "message": "You have run out of credits. The roleplay session will end.",
-            "credits_used": self.credits_deducted
-        }))
+        await self.send_message(
+            {
+                "type": "insufficient_credits",
+                "message": "You have run out of credits. The roleplay session will end.",
+                "credits_used": self.credits_deducted,
+            }
+        )
         
         # End the roleplay session
         await self.handle_end_roleplay()
         
-    @database_sync_to_async
-    def deduct_user_credit(self):
-        """Deduct one credit from user and return success status"""
-        from django.db import transaction
-        try:
-            with transaction.atomic():
-                from .models import Profile, CreditShare
-                
-                user = Profile.objects.select_for_update().get(user=self.scope["user"])
-                user_shared = self.bot_shared_by
-                user_created = self.bot_creator
-                
-                # Assuming you have a credits field on User model or a related UserProfile
-                # Adjust this based on your actual credit system implementation
-                if hasattr(user, 'credits') and user.credits >= 10:
-                    user.credits -= 10
-                    user.save(update_fields=['credits'])
-                    self.credits_deducted += 10
-                    logger.info(f"Deducted 10 credit from user {user.user.username}. Remaining: {user.credits}")
-                    if self.bot_shared_by:
-                        CreditShare.objects.create(
-                            credit=1,
-                            share=self.share_data,
-                            bot=self.roleplay_bot,
-                            credited_to=self.bot_shared_by,
-                            credited_from=user.user,
-                            credit_reason="referral_share",
-                        )
-                        logger.info(f"1 credited to {self.bot_shared_by.username} for shared bot usage.")
-                        CreditShare.objects.create(
-                            credit=2,
-                            share=self.share_data,
-                            bot=self.roleplay_bot,
-                            credited_to=self.bot_creator,
-                            credited_from=user.user,
-                            credit_reason="creator_share",
-                        )
-                        logger.info(f"2 credited to {self.bot_creator.username} for bot usage.")
-                    else:
-                        CreditShare.objects.create(
-                            credit=3,
-                            share=self.share_data,
-                            bot=self.roleplay_bot,
-                            credited_to=self.bot_creator,
-                            credited_from=user.user,
-                            credit_reason="creator_share",
-                        )
-                        logger.info(f"3 credited to {self.bot_creator.username} for bot usage.")
-                    return True
-                else:
-                    logger.warning(f"User {user.user.username} has insufficient credits")
-                    return False
-                
-        except Exception as e:
-            logger.error(f"Error deducting credit: {e}")
+    async def load_handoff_context(self) -> bool:
+        """Load the session from the handoff token minted by RolePlaySessionView
+
+        Needs one primary key lookup, which re-checks that the bot is still
+        active and reads its prompt only when that has dropped out of the
+        cache. Returns False to fall back to load_roleplay_context(). The token
+        does not say whether the session is still open: claim_session()
+        checks that before anything is metered.
+        """
+        from django.contrib.auth.models import User
+        from .models import RolePlayBots, RolePlayShare, RoleplaySession
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        token = query.get("handoff", [None])[0]
+        user = self.scope["user"]
+        if not token or not user.is_authenticated:
             return False
+        handoff = read_handoff_token(token, self.session_id, user.id)
+        if handoff is None:
+            logger.warning(
+                f"Invalid handoff token for roleplay session {self.session_id}"
+            )
+            return False
+
+        bot = handoff["bot"]
+        cached_prompt = await cache.aget(prompt_cache_key(bot["prompt_hash"]))
+        system_prompt = await self.load_bot_prompt(bot["id"], cached_prompt)
+        if system_prompt is None or prompt_hash(system_prompt) != bot["prompt_hash"]:
+            # The bot was deactivated or edited since the page was rendered
+            return False
+
+        # Unsaved stand-ins carrying just what the consumer reads and the
+        # primary keys its writes need
+        creator = (
+            User(id=handoff["creator"][0], username=handoff["creator"][1])
+            if handoff["creator"]
+            else None
+        )
+        self.roleplay_bot = RolePlayBots(
+            id=bot["id"],
+            name=bot["name"],
+            description=bot["description"],
+            voice=bot["voice"],
+            system_prompt=system_prompt,
+            custom_configuration=bot["custom_configuration"],
+            created_by=creator,
+        )
+        self.roleplay_session = RoleplaySession(
+            id=self.session_id, user_id=user.id, bot_id=bot["id"]
+        )
+        # The row exists; saves must UPDATE it rather than try an INSERT
+        self.roleplay_session._state.adding = False
+        self.bot_creator = creator
+        if handoff["sharer"]:
+            self.bot_shared_by = User(
+                id=handoff["sharer"][0], username=handoff["sharer"][1]
+            )
+            self.share_data = RolePlayShare(
+                id=handoff["share"], bot_id=bot["id"], shared_by=self.bot_shared_by
+            )
+        self.billing_rates = handoff["rates"]
+        self.billing_budget = handoff.get("credits")
+        return True
+
+    @database_sync_to_async
+    def load_bot_prompt(self, bot_id, cached_prompt=None):
+        """The prompt of the bot if it is still active, else None"""
+        from .models import RolePlayBots
+
+        bots = RolePlayBots.objects.filter(id=bot_id, is_active=True)
+        if cached_prompt is not None:
+            return cached_prompt if bots.exists() else None
+        prompt = bots.values_list("system_prompt", flat=True).first()
+        if prompt is not None:
+            cache.set(
+                prompt_cache_key(prompt_hash(prompt)), prompt, PROMPT_CACHE_TIMEOUT
+            )
+        return prompt
 
     @database_sync_to_async
     def load_roleplay_context(self):
         """Load roleplay bot and create session record"""
-        from .models import RolePlayBots, RoleplaySession, MyInvitedRolePlayShare
+        from .models import (
+            MyInvitedRolePlayShare,
+            Profile,
+            RolePlayBots,
+            RoleplaySession,
+        )
 
         try:
             # Load the roleplay bot
         
             # Create a new roleplay session record
-            self.roleplay_session = RoleplaySession.objects.get(
-                id=self.session_id,
-            )
+            # A settled session has been charged for; it cannot resume
+            self.roleplay_session = RoleplaySession.objects.defer(
+                *RoleplaySession.LARGE_FIELDS
+            ).get(id=self.session_id, settled_at__isnull=True)
             self.roleplay_bot = RolePlayBots.objects.get(id=self.roleplay_session.bot.id, is_active=True)
             self.bot_creator = self.roleplay_bot.created_by
             invited_data = MyInvitedRolePlayShare.objects.filter(bot=self.roleplay_bot, invited_to=self.scope["user"]).first()
             self.share_data = invited_data.share if invited_data else None
             if invited_data:
                 self.bot_shared_by = invited_data.share.shared_by
+            self.billing_rates = roleplay_billing_rates(self.bot_shared_by is not None)
+            self.billing_budget = (
+                Profile.objects.filter(user=self.scope["user"])
+                .values_list("credits", flat=True)
+                .first()
+                or 0
+            )
             return True
         except RolePlayBots.DoesNotExist:
-            logger.error(f"Roleplay bot {self.roleplay_bot.id} not found or inactive")
+            logger.error(
+                f"Roleplay bot {self.roleplay_session.bot_id} not found or inactive"
+            )
             return False
         except Exception as e:
             logger.error(f"Error loading roleplay context: {e}")
@@ -546,120 +1298,112 @@ class RoleplayConsumer(VoiceAgentConsumer):
                 content_parts.append(transcript_text)
 
         if content_parts:
-            full_content = " ".join(content_parts)
-            timestamp = timezone.now().strftime("%H:%M:%S")
-
-            # Use character name for assistant role
-            role_display = self.roleplay_bot.name if role == "assistant" else "USER"
-
-            return {
-                "timestamp": timestamp,
-                "role": role,
-                "role_display": role_display,
-                "content": full_content,
-                "item_id": getattr(history_item, "item_id", None),
-            }
+            return self.format_turn(
+                getattr(history_item, "item_id", None), role, " ".join(content_parts)
+            )
 
         return None
 
-    def update_transcript(self, history):
-        """Update transcript with new history items, avoiding duplicates"""
-        if not history:
-            return
+    def format_turn(self, item_id, role, content):
+        """Format one turn of the conversation into transcript format"""
+        timestamp = timezone.now().strftime("%H:%M:%S")
 
-        # Process only new items beyond what we've already processed
-        new_items = history[self.last_processed_item_count :]
-
-        for history_item in new_items:
-            # Skip in-progress items to avoid partial transcripts
-            if hasattr(history_item, "status") and history_item.status == "in_progress":
-                continue
-
-            formatted_item = self.format_history_item(history_item)
-            if formatted_item:
-                # Check if this item is already in our transcript (by item_id)
-                item_id = formatted_item.get("item_id")
-                if item_id:
-                    # Remove any existing item with same ID (for updates)
-                    self.current_transcript = [
-                        item
-                        for item in self.current_transcript
-                        if item.get("item_id") != item_id
-                    ]
-
-                self.current_transcript.append(formatted_item)
-
-        # Update the count of processed items
-        completed_items = [
-            item
-            for item in history
-            if not (hasattr(item, "status") and item.status == "in_progress")
-        ]
-        self.last_processed_item_count = len(completed_items)
+        # Use character name for assistant role
+        role_display = self.roleplay_bot.name if role == "assistant" else "USER"
+
+        return {
+            "timestamp": timestamp,
+            "role": role,
+            "role_display": role_display,
+            "content": content,
+            "item_id": item_id,
+        }
+
+    def checkpoint_turn(self, seq, item_id, role, text):
+        """Queue a stored or removed turn for the session's transcript segments"""
+        if self.roleplay_session:
+            get_transcript_checkpointer().append(
+                self.roleplay_session.id, seq, item_id, role, text
+            )
+
+    def ingest_transcript_event(self, model_event):
+        """Apply an item event to the transcript; returns whether a turn changed"""
+        return self.transcript_ingestor.ingest(model_event)
+
+    def reconcile_transcript(self, history):
+        """Fold in a history snapshot if one is due; returns whether a turn changed"""
+        now = time.monotonic()
+        if (
+            not history
+            or now - self.transcript_reconciled_at < self.transcript_reconcile_s
+        ):
+            return False
+        self.transcript_reconciled_at = now
+        return self.transcript_ingestor.reconcile(history)
+
+    async def send_transcript_update(self):
+        """Send the latest turns to the client for real-time display"""
+        await self.send_message(
+            {
+                "type": "roleplay_transcript_update",
+                "bot_name": self.roleplay_bot.name,
+                "transcript_length": len(self.current_transcript),
+                "latest_items": self.current_transcript.latest(2),
+            },
+            OutboundQueue.TRANSCRIPT,
+        )
 
     def generate_formatted_transcript(self):
         """Generate a formatted transcript string"""
-        if not self.current_transcript:
-            return "No conversation transcript available."
-
-        formatted_lines = []
-        formatted_lines.append(f"=== ROLEPLAY SESSION: {self.roleplay_bot.name} ===")
-        formatted_lines.append(f"Scenario: {self.roleplay_bot.description}")
-        formatted_lines.append(
-            f"Started: {self.session_start_time.strftime('%Y-%m-%d %H:%M:%S') if self.session_start_time else 'Unknown'}"
+        return render_transcript(
+            self.roleplay_bot, self.session_start_time, self.current_transcript
         )
-        formatted_lines.append("=" * 50)
-        formatted_lines.append("")
-
-        for item in self.current_transcript:
-            formatted_lines.append(f"[{item['timestamp']}] {item['role_display']}:")
-            formatted_lines.append(f"{item['content']}")
-            formatted_lines.append("")
-
-        formatted_lines.append("=" * 50)
-        formatted_lines.append("=== END OF ROLEPLAY SESSION ===")
-        return "\n".join(formatted_lines)
 
     async def _handle_session_event(self, event: RealtimeSessionEvent):
         """Override to handle transcript updates and roleplay-specific events"""
         try:
-            # Handle history updates for transcript
-            if event.type == "history_updated":
-                if hasattr(event, "history") and event.history:
-                    self.update_transcript(event.history)
-
-                    # Send transcript update to client for real-time display
-                    latest_items = (
-                        self.current_transcript[-2:]
-                        if len(self.current_transcript) >= 2
-                        else self.current_transcript
-                    )
-                    await self.send(
-                        text_data=json.dumps(
-                            {
-                                "type": "roleplay_transcript_update",
-                                "bot_name": self.roleplay_bot.name,
-                                "transcript_length": len(self.current_transcript),
-                                "latest_items": latest_items,
-                            }
-                        )
-                    )
-
+            if self.greeting_recorder:
+                await self.record_greeting(event)
+
+            # The transcript follows the model's item events; the history
+            # snapshots only reconcile it now and then
+            changed = False
+            if event.type == "raw_model_event":
+                changed = self.ingest_transcript_event(event.data)
+            elif event.type == "history_updated":
+                changed = self.reconcile_transcript(getattr(event, "history", None))
+            if changed:
+                await self.send_transcript_update()
+            if self.greeting_recorder and self.greeting_recorder.complete:
+                self.save_recorded_greeting()
+
+            if event.type in ["history_updated", "history_added"]:
                 return  # Don't pass to parent to avoid noise
 
             # Handle all other events normally, but with roleplay context
             if event.type == "agent_start":
-                await self.send(
-                    text_data=json.dumps(
-                        {
-                            "type": "roleplay_start",
-                            "bot_name": self.roleplay_bot.name,
-                            "scenario": self.roleplay_bot.description,
-                        }
-                    )
+                await self.send_message(
+                    {
+                        "type": "roleplay_start",
+                        "bot_name": self.roleplay_bot.name,
+                        "scenario": self.roleplay_bot.description,
+                    }
                 )
                 return
 
+            if event.type == "raw_model_event" and self.greeting_ends_at:
+                raw = getattr(event.data, "data", None)
+                if (
+                    isinstance(raw, dict)
+                    and raw.get("type") == "input_audio_buffer.speech_started"
+                    and time.monotonic() < self.greeting_ends_at
+                ):
+                    # The user talked over the cached greeting, which upstream
+                    # never played and so will not interrupt
+                    self.greeting_ends_at = None
+                    self.clear_audio_output()
+                    await self.send_message({"type": "audio_interrupted"})
+
             # Handle other events normally
             await super()._handle_session_event(event)
 
@@ -676,34 +1420,31 @@ class RoleplayConsumer(VoiceAgentConsumer):
         elif message_type == "get_roleplay_transcript":
             # Allow client to request current transcript
             transcript = self.generate_formatted_transcript()
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "current_roleplay_transcript",
-                        "bot_name": self.roleplay_bot.name,
-                        "transcript": transcript,
-                    }
-                )
+            await self.send_message(
+                {
+                    "type": "current_roleplay_transcript",
+                    "bot_name": self.roleplay_bot.name,
+                    "transcript": transcript,
+                },
+                OutboundQueue.TRANSCRIPT,
             )
         elif message_type == "get_roleplay_info":
             # Send current roleplay session info
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "roleplay_info",
-                        "bot": {
-                            "id": self.roleplay_bot.id,
-                            "name": self.roleplay_bot.name,
-                            "description": self.roleplay_bot.description,
-                            "scenario": self.roleplay_bot.description,
-                        },
-                        "session_duration": (
-                            str(timezone.now() - self.session_start_time)
-                            if self.session_start_time
-                            else "Unknown"
-                        ),
-                    }
-                )
+            await self.send_message(
+                {
+                    "type": "roleplay_info",
+                    "bot": {
+                        "id": self.roleplay_bot.id,
+                        "name": self.roleplay_bot.name,
+                        "description": self.roleplay_bot.description,
+                        "scenario": self.roleplay_bot.description,
+                    },
+                    "session_duration": (
+                        str(timezone.now() - self.session_start_time)
+                        if self.session_start_time
+                        else "Unknown"
+                    ),
+                }
             )
         else:
             await super().handle_message(data)
@@ -711,8 +1452,7 @@ class RoleplayConsumer(VoiceAgentConsumer):
     async def handle_end_roleplay(self):
         """Handle roleplay completion and save transcript"""
         if self.roleplay_session:
-            # Generate final transcript
-            final_transcript = self.generate_formatted_transcript()
+            await self.settle_billing("completed")
 
             # Calculate session duration
             duration_seconds = 0
@@ -721,25 +1461,35 @@ class RoleplayConsumer(VoiceAgentConsumer):
                 duration_seconds = int(duration.total_seconds())
 
             # Save transcript and duration to database
-            await self.save_roleplay_session_data(final_transcript, duration_seconds)
+            await self.save_roleplay_session_data(
+                await self.final_transcript(), duration_seconds
+            )
 
             # Update session status
             await self.update_session_status("completed")
             self.roleplay_ended = True
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "roleplay_complete",
-                        "message": f"Roleplay with {self.roleplay_bot.name} completed successfully",
-                        "bot_name": self.roleplay_bot.name,
-                        "transcript_saved": True,
-                        "transcript_length": len(self.current_transcript),
-                        "duration_seconds": duration_seconds,
-                        "credits_used": self.credits_deducted
-                    }
-                )
+            await self.send_message(
+                {
+                    "type": "roleplay_complete",
+                    "message": f"Roleplay with {self.roleplay_bot.name} completed successfully",
+                    "bot_name": self.roleplay_bot.name,
+                    "transcript_saved": True,
+                    "transcript_length": len(self.current_transcript),
+                    "duration_seconds": duration_seconds,
+                    "credits_used": self.credits_deducted,
+                }
             )
 
+    async def final_transcript(self):
+        """
+        The transcript text to store when the session ends: None once the
+        last turns are in its segments, which it is assembled from when
+        read, or the whole text if they could not be written.
+        """
+        if await get_transcript_checkpointer().flush():
+            return None
+        return self.generate_formatted_transcript()
+
     @database_sync_to_async
     def save_roleplay_session_data(self, transcript, duration_seconds):
         """Save transcript and session data to RoleplaySession"""
@@ -747,11 +1497,17 @@ class RoleplayConsumer(VoiceAgentConsumer):
             # Refresh the session from DB to avoid stale data
             self.roleplay_session.refresh_from_db()
 
-            # Save transcript and duration
-            self.roleplay_session.transcript = transcript
+            # Save duration, and the transcript if its segments fell short
             self.roleplay_session.duration_seconds = duration_seconds
-            self.roleplay_session.credits_used = self.credits_deducted
-            self.roleplay_session.save(update_fields=["transcript", "duration_seconds","credits_used"])
+            # credits_used is written when the session is settled
+            update_fields = ["duration_seconds"]
+            if transcript is not None:
+                self.roleplay_session.transcript = transcript
+                update_fields.append("transcript")
+            if getattr(settings, "VOICE_AGENT_STORE_LATENCY", False):
+                self.roleplay_session.latency_metrics = self.latency.as_dict()
+                update_fields.append("latency_metrics")
+            self.roleplay_session.save(update_fields=update_fields)
 
             logger.info(
                 f"Roleplay session data saved for bot {self.roleplay_bot.name}, session {self.roleplay_session.id}"
@@ -774,17 +1530,22 @@ class RoleplayConsumer(VoiceAgentConsumer):
 
     async def disconnect(self, close_code):
         """Override disconnect to save transcript if roleplay was in progress"""
+        await self.settle_billing()
+        for task in (self.context_task, self.greeting_task):
+            if task and not task.done():
+                task.cancel()
+
         # If roleplay was in progress but not formally ended, still save transcript
         if self.roleplay_session and self.current_transcript:
-            final_transcript = self.generate_formatted_transcript()
-
             # Calculate duration
             duration_seconds = 0
             if self.session_start_time:
                 duration = timezone.now() - self.session_start_time
                 duration_seconds = int(duration.total_seconds())
 
-            await self.save_roleplay_session_data(final_transcript, duration_seconds)
+            await self.save_roleplay_session_data(
+                await self.final_transcript(), duration_seconds
+            )
 
             # Update status to indicate unexpected disconnect
             await self.update_session_status("disconnected")
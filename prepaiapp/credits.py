@@ -0,0 +1,77 @@
+# pylint: disable=all
+"""Credit balance changes: a conditional UPDATE on Profile.credits plus its ledger entry."""
+
+from django.db import transaction
+from django.db.models import F
+
+from .balances import balance_changed
+from .models import CreditLedgerEntry, Profile
+
+
+def deduct_credits(user_id, amount, kind, reference=""):
+    """
+    Take amount credits from a user if the balance covers it.
+
+    One UPDATE ... WHERE credits >= amount, so concurrent deductions can
+    neither lose updates nor overdraw the balance, and no lock is held
+    beyond the statement itself. The ledger entry is written in the same
+    transaction. Returns whether the credits were taken.
+    """
+    with transaction.atomic(savepoint=False):
+        taken = bool(
+            Profile.objects.filter(user_id=user_id, credits__gte=amount).update(
+                credits=F("credits") - amount
+            )
+        )
+        if taken:
+            record_entry(user_id, -amount, kind, reference)
+            balance_changed(user_id, -amount)
+    return taken
+
+
+def add_credits(user_id, amount, kind, reference=""):
+    """Give a user amount credits; returns False if they have no profile"""
+    with transaction.atomic(savepoint=False):
+        added = bool(
+            Profile.objects.filter(user_id=user_id).update(
+                credits=F("credits") + amount
+            )
+        )
+        if added:
+            record_entry(user_id, amount, kind, reference)
+            balance_changed(user_id, amount)
+    return added
+
+
+def take_credits(user_id, amount, kind, reference=""):
+    """
+    Take amount credits, or as much of it as the balance covers.
+
+    For charges already incurred, such as a settled session. The common
+    case is the conditional UPDATE of deduct_credits(); only a balance
+    too low for it is read, under lock, to take what is left. Returns the
+    credits taken.
+    """
+    if amount <= 0:
+        return 0
+    with transaction.atomic(savepoint=False):
+        if deduct_credits(user_id, amount, kind, reference):
+            return amount
+        balance = (
+            Profile.objects.select_for_update()
+            .filter(user_id=user_id)
+            .values_list("credits", flat=True)
+            .first()
+        )
+        taken = min(amount, max(balance or 0, 0))
+        if taken:
+            Profile.objects.filter(user_id=user_id).update(credits=F("credits") - taken)
+            record_entry(user_id, -taken, kind, reference)
+            balance_changed(user_id, -taken)
+    return taken
+
+
+def record_entry(user_id, amount, kind, reference=""):
+    return CreditLedgerEntry.objects.create(
+        user_id=user_id, amount=amount, kind=kind, reference=str(reference or "")
+    )
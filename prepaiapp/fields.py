@@ -0,0 +1,55 @@
+# pylint: disable=all
+"""Model fields that store large text values compressed."""
+
+import base64
+import zlib
+
+from django.db import models
+
+# A compressed value is this marker followed by the base64 of a version
+# byte and the compressed UTF-8. Text never starts with it: a value that
+# does is always compressed, so anything unmarked is stored as is, which
+# includes every row written before compression
+COMPRESSED_MARKER = "\x01"
+COMPRESSION_ZLIB = 1
+# Shorter values are not worth the marker and base64 overhead
+MIN_COMPRESSED_LENGTH = 256
+
+
+def is_compressed(value):
+    return value.startswith(COMPRESSED_MARKER)
+
+
+def compress_text(text):
+    """The stored form of a text value"""
+    if len(text) < MIN_COMPRESSED_LENGTH and not is_compressed(text):
+        return text
+    payload = bytes([COMPRESSION_ZLIB]) + zlib.compress(text.encode("utf-8"))
+    return COMPRESSED_MARKER + base64.b64encode(payload).decode("ascii")
+
+
+def decompress_text(value):
+    """A text value from its stored form"""
+    if not is_compressed(value):
+        return value
+    payload = base64.b64decode(value[len(COMPRESSED_MARKER) :])
+    if payload[0] != COMPRESSION_ZLIB:
+        raise ValueError(f"Unknown compressed field version {payload[0]}")
+    return zlib.decompress(payload[1:]).decode("utf-8")
+
+
+class CompressedTextField(models.TextField):
+    """A TextField stored zlib-compressed once it is long enough"""
+
+    description = "Compressed text"
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_text(value)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return value
+        return compress_text(value)
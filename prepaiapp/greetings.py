@@ -0,0 +1,191 @@
+# pylint: disable=all
+"""Cached opening greetings for roleplay bots."""
+
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Stored blob: version, transcript length, UTF-8 transcript, then the raw
+# audio in the session format named by the key (PCM16 or G.711)
+GREETING_BLOB_VERSION = 1
+GREETING_BLOB_HEADER = struct.Struct("<BI")
+
+
+def prompt_hash(system_prompt):
+    return hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+
+
+def greeting_key(bot_id, voice, system_prompt, audio_format):
+    """Cache key covering everything that changes how a bot's greeting sounds"""
+    return f"{bot_id}/{voice}-{prompt_hash(system_prompt)}.{audio_format}"
+
+
+class Greeting:
+    def __init__(self, transcript, audio):
+        self.transcript = transcript
+        self.audio = audio
+
+    def pack(self):
+        transcript = self.transcript.encode("utf-8")
+        return (
+            GREETING_BLOB_HEADER.pack(GREETING_BLOB_VERSION, len(transcript))
+            + transcript
+            + self.audio
+        )
+
+    @classmethod
+    def unpack(cls, blob):
+        """Parse a stored blob; None if it was written by another version"""
+        if len(blob) < GREETING_BLOB_HEADER.size:
+            return None
+        version, length = GREETING_BLOB_HEADER.unpack_from(blob)
+        if version != GREETING_BLOB_VERSION:
+            return None
+        start = GREETING_BLOB_HEADER.size
+        transcript = bytes(blob[start : start + length]).decode("utf-8")
+        return cls(transcript, bytes(blob[start + length :]))
+
+
+class GreetingRecorder:
+    """
+    Collects the audio of the first assistant item of a session.
+
+    A recording that outgrows max_bytes is abandoned rather than cached.
+    """
+
+    def __init__(self, key, max_bytes):
+        self.key = key
+        self.max_bytes = max_bytes
+        self.item_id = None
+        self.audio = bytearray()
+        self.complete = False
+        self.abandoned = False
+
+    def add_audio(self, item_id, data):
+        if self.item_id is None:
+            self.item_id = item_id
+        if item_id != self.item_id or self.complete or self.abandoned:
+            return
+        if len(self.audio) + len(data) > self.max_bytes:
+            self.abandoned = True
+            self.audio = bytearray()
+            return
+        self.audio += data
+
+    def end_audio(self, item_id):
+        if item_id == self.item_id and self.audio:
+            self.complete = True
+
+
+class LocalGreetingStore:
+    """Greetings as files under a directory, one subdirectory per bot"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def get(self, key):
+        try:
+            return Greeting.unpack((self.directory / key).read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, greeting):
+        path = self.directory / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write aside and rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(greeting.pack())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def delete_bot(self, bot_id):
+        shutil.rmtree(self.directory / str(bot_id), ignore_errors=True)
+
+
+class S3GreetingStore:
+    """Greetings as objects under a prefix of the media bucket"""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            region_name=settings.AWS_S3_REGION_NAME,
+        )
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return Greeting.unpack(response["Body"].read())
+
+    def put(self, key, greeting):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=greeting.pack(),
+            ContentType="application/octet-stream",
+        )
+
+    def delete_bot(self, bot_id):
+        paginator = self.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{bot_id}/")
+        for page in pages:
+            keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if keys:
+                self.client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True}
+                )
+
+
+_stores = {}
+
+
+def get_greeting_store():
+    """The configured greeting store, or None when VOICE_AGENT_GREETING_CACHE is off"""
+    backend = getattr(settings, "VOICE_AGENT_GREETING_CACHE", "")
+    if backend == "local":
+        location = str(settings.VOICE_AGENT_GREETING_DIR)
+    elif backend == "s3":
+        location = settings.VOICE_AGENT_GREETING_S3_PREFIX
+    else:
+        return None
+
+    store = _stores.get((backend, location))
+    if store is None:
+        if backend == "local":
+            store = LocalGreetingStore(location)
+        else:
+            store = S3GreetingStore(settings.AWS_STORAGE_BUCKET_NAME, location)
+        _stores[(backend, location)] = store
+    return store
+
+
+def invalidate_greetings(bot_id):
+    """Drop every cached greeting of a bot, whatever voice or prompt it was for"""
+    store = get_greeting_store()
+    if store is None:
+        return
+    try:
+        store.delete_bot(bot_id)
+    except Exception as e:
+        logger.error(f"Error invalidating greetings for bot {bot_id}: {e}")
@@ -0,0 +1,82 @@
+# pylint: disable=all
+"""Signed hand-off of a roleplay session from the page view to its consumer."""
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
+
+from .greetings import prompt_hash
+
+HANDOFF_SALT = "prepaiapp.roleplay.handoff"
+# Prompts are content-addressed, so a cached one never goes stale
+PROMPT_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def prompt_cache_key(system_prompt_hash):
+    return f"roleplay-prompt:{system_prompt_hash}"
+
+
+def roleplay_billing_rates(shared):
+    """Credits charged per minute and how they are shared out"""
+    if shared:
+        return {"per_minute": 10, "creator": 2, "sharer": 1}
+    return {"per_minute": 10, "creator": 3, "sharer": 0}
+
+
+def mint_handoff_token(session, share=None):
+    """
+    Sign what RoleplayConsumer needs to start a session without the DB.
+
+    The prompt itself goes to the cache under its hash rather than into the
+    token, which ends up in the WebSocket URL.
+    """
+    bot = session.bot
+    creator = bot.created_by
+    try:
+        credits = session.user.profile.credits
+    except ObjectDoesNotExist:
+        credits = 0
+    shared_by = share.shared_by if share else None
+    system_prompt_hash = prompt_hash(bot.system_prompt)
+    cache.set(
+        prompt_cache_key(system_prompt_hash), bot.system_prompt, PROMPT_CACHE_TIMEOUT
+    )
+    return signing.dumps(
+        {
+            "session": str(session.id),
+            "user": session.user_id,
+            "bot": {
+                "id": str(bot.id),
+                "name": bot.name,
+                "description": bot.description,
+                "voice": bot.voice,
+                "prompt_hash": system_prompt_hash,
+                "custom_configuration": bot.custom_configuration or {},
+            },
+            "creator": [creator.id, creator.username] if creator else None,
+            "sharer": [shared_by.id, shared_by.username] if shared_by else None,
+            "share": str(share.id) if share else None,
+            "rates": roleplay_billing_rates(shared_by is not None),
+            # The metering budget; settlement never takes more than the
+            # balance at the time, so a stale one cannot overdraw it
+            "credits": credits,
+        },
+        salt=HANDOFF_SALT,
+        compress=True,
+    )
+
+
+def read_handoff_token(token, session_id, user_id):
+    """The token's payload, or None if it is invalid, expired or not for this session"""
+    try:
+        handoff = signing.loads(
+            token,
+            salt=HANDOFF_SALT,
+            max_age=getattr(settings, "VOICE_AGENT_HANDOFF_MAX_AGE", 300),
+        )
+    except signing.BadSignature:
+        return None
+    if handoff.get("session") != str(session_id) or handoff.get("user") != user_id:
+        return None
+    return handoff
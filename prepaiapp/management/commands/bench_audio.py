@@ -0,0 +1,243 @@
+# pylint: disable=all
+"""
+CPU benchmarks for the voice agent audio pipeline.
+
+    python manage.py bench_audio --stage resample
+    python manage.py bench_audio --stage codec
+    python manage.py bench_audio --stage alloc
+"""
+
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from prepaiapp.audio import (
+    AUDIO_FORMATS,
+    AUDIO_FRAME_HEADER,
+    AUDIO_FRAME_HEADER_SIZE,
+    AUDIO_FRAME_INPUT,
+    AUDIO_FRAME_VERSION,
+    AudioConverter,
+    AudioFrameCoalescer,
+    AudioResampler,
+    audio_format_bytes_per_second,
+    audio_format_rate,
+    g711_decode,
+    g711_encode,
+    pack_output_audio_frame,
+    unpack_input_audio_frame,
+)
+from prepaiapp.streams import InboundAudioBuffer
+from prepaiapp.consumers import SAMPLE_RATE
+
+# (sample rate, channels) pairs commonly produced by browsers
+RESAMPLE_CASES = [(16000, 1), (44100, 1), (48000, 1), (48000, 2)]
+
+
+def synthetic_pcm16(sample_rate, channels, seconds):
+    """Speech-like test signal: a few harmonics plus noise"""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    signal = sum(
+        np.sin(2 * np.pi * f * t) / i for i, f in enumerate((180, 360, 900, 2400), 1)
+    )
+    signal = 6000 * signal + rng.normal(0, 300, len(t))
+    signal = np.repeat(signal[:, None], channels, axis=1)
+    return np.clip(signal, -32768, 32767).astype(np.int16).tobytes()
+
+
+def chunked(data, chunk_bytes):
+    return [data[i : i + chunk_bytes] for i in range(0, len(data), chunk_bytes)]
+
+
+def measure_allocations(step, items):
+    """
+    Run step over items, once under tracemalloc and once for timing.
+
+    Returns (bytes, elapsed): the peak transient allocation of every call
+    summed, and the CPU time of the untraced pass.
+    """
+    allocated = 0
+    tracemalloc.start()
+    for item in items:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        step(item)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    start = time.process_time()
+    for item in items:
+        step(item)
+    return allocated, time.process_time() - start
+
+
+class CopyingAudioPath:
+    """The audio path as it was before it moved to memoryviews, for comparison"""
+
+    def __init__(self, frame_bytes, bytes_per_second, buffer_ms, chunk_bytes):
+        self.frame_bytes = frame_bytes
+        self.chunk_bytes = chunk_bytes
+        self.buffer = bytearray()
+        self.ring = InboundAudioBuffer(
+            int(bytes_per_second * buffer_ms / 1000), bytes_per_second
+        )
+
+    def outbound(self, delta):
+        self.buffer += delta
+        while len(self.buffer) >= self.frame_bytes:
+            data = bytes(self.buffer[: self.frame_bytes])
+            del self.buffer[: self.frame_bytes]
+            AUDIO_FRAME_HEADER.pack(1, 1, 0, 0, 0) + bytes(data)
+
+    def inbound(self, frame):
+        self.ring.write(bytes(frame[AUDIO_FRAME_HEADER_SIZE:]), 0)
+        while self.ring.size >= self.chunk_bytes:
+            start = self.ring.start
+            bytes(self.ring.buffer[start : start + self.chunk_bytes])
+            self.ring.read(self.chunk_bytes)
+
+
+class Command(BaseCommand):
+    help = "Measure CPU cost of the audio pipeline stages per second of audio"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stage",
+            choices=["resample", "codec", "alloc"],
+            default="resample",
+            help="Pipeline stage to benchmark",
+        )
+        parser.add_argument(
+            "--seconds",
+            type=float,
+            default=60,
+            help="Seconds of synthetic audio to process per case",
+        )
+        parser.add_argument(
+            "--chunk-ms",
+            type=int,
+            default=170,
+            help="Client frame size in ms (a 4096-sample ScriptProcessor is ~170ms)",
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"bench_{options['stage']}")(options)
+
+    def report(self, label, elapsed, seconds):
+        per_second_us = elapsed / seconds * 1e6
+        self.stdout.write(
+            f"{label:<28} {per_second_us:9.1f} us/s audio   "
+            f"~{seconds / elapsed:8.0f} sessions/core"
+        )
+
+    def bench_resample(self, options):
+        seconds = options["seconds"]
+        self.stdout.write(
+            f"Resampling to {SAMPLE_RATE}Hz mono, {seconds:g}s per case, "
+            f"{options['chunk_ms']}ms chunks"
+        )
+        for sample_rate, channels in RESAMPLE_CASES:
+            data = synthetic_pcm16(sample_rate, channels, seconds)
+            chunk_bytes = int(sample_rate * options["chunk_ms"] / 1000) * 2 * channels
+            chunks = chunked(data, chunk_bytes)
+            resampler = AudioResampler(sample_rate, SAMPLE_RATE, channels)
+
+            start = time.process_time()
+            for chunk in chunks:
+                resampler.process(chunk)
+            elapsed = time.process_time() - start
+            self.report(f"{sample_rate}Hz {channels}ch", elapsed, seconds)
+
+    def bench_codec(self, options):
+        seconds = options["seconds"]
+        self.stdout.write("Wire size per minute of mono audio, one direction")
+        for audio_format in AUDIO_FORMATS:
+            per_minute = audio_format_bytes_per_second(audio_format) * 60
+            self.stdout.write(
+                f"{audio_format:<28} {per_minute / 1024:9.0f} KiB binary   "
+                f"{per_minute * 4 / 3 / 1024:9.0f} KiB base64 JSON"
+            )
+
+        self.stdout.write(f"\nCodec CPU, {seconds:g}s per case")
+        for audio_format in AUDIO_FORMATS[1:]:
+            rate = audio_format_rate(audio_format)
+            chunk_bytes = int(rate * options["chunk_ms"] / 1000) * 2
+            chunks = chunked(synthetic_pcm16(rate, 1, seconds), chunk_bytes)
+
+            start = time.process_time()
+            encoded = [g711_encode(chunk, audio_format) for chunk in chunks]
+            self.report(f"{audio_format} encode", time.process_time() - start, seconds)
+
+            start = time.process_time()
+            for chunk in encoded:
+                g711_decode(chunk, audio_format)
+            self.report(f"{audio_format} decode", time.process_time() - start, seconds)
+
+            # What VOICE_AGENT_SESSION_G711 = False costs on the output path
+            pcm = chunked(
+                synthetic_pcm16(SAMPLE_RATE, 1, seconds),
+                int(SAMPLE_RATE * options["chunk_ms"] / 1000) * 2,
+            )
+            converter = AudioConverter("pcm16", SAMPLE_RATE, 1, audio_format, rate)
+            start = time.process_time()
+            for chunk in pcm:
+                converter.process(chunk)
+            self.report(
+                f"{audio_format} transcode", time.process_time() - start, seconds
+            )
+
+    def bench_alloc(self, options):
+        seconds = options["seconds"]
+        bytes_per_second = audio_format_bytes_per_second("pcm16")
+        frame_bytes = bytes_per_second * 60 // 1000
+        chunk_bytes = bytes_per_second * 100 // 1000
+        rng = np.random.default_rng(0)
+
+        # Assistant audio arrives in irregular deltas
+        audio = synthetic_pcm16(SAMPLE_RATE, 1, seconds)
+        deltas, offset = [], 0
+        while offset < len(audio):
+            size = int(rng.integers(1200, 4800)) * 2
+            deltas.append(audio[offset : offset + size])
+            offset += size
+        # Client audio arrives in framed ScriptProcessor-sized chunks
+        client_bytes = int(SAMPLE_RATE * options["chunk_ms"] / 1000) * 2
+        uplink = [
+            AUDIO_FRAME_HEADER.pack(AUDIO_FRAME_VERSION, AUDIO_FRAME_INPUT, 0, seq, 0)
+            + chunk
+            for seq, chunk in enumerate(chunked(audio, client_bytes))
+        ]
+
+        coalescer = AudioFrameCoalescer(frame_bytes)
+        ring = InboundAudioBuffer(bytes_per_second * 2, bytes_per_second)
+
+        def outbound(delta):
+            for frame in coalescer.push("item", 0, delta, 0):
+                pack_output_audio_frame(0, 0, 0, frame.data)
+
+        def inbound(frame):
+            ring.write(unpack_input_audio_frame(frame)[2], 0)
+            while ring.size >= chunk_bytes:
+                ring.read(chunk_bytes)
+
+        copying = CopyingAudioPath(frame_bytes, bytes_per_second, 2000, chunk_bytes)
+        self.stdout.write(
+            f"Transient allocations per second of {SAMPLE_RATE}Hz PCM16 "
+            f"({bytes_per_second / 1024:.0f} KiB/s payload), {seconds:g}s"
+        )
+        cases = [
+            ("outbound, copying", copying.outbound, deltas),
+            ("outbound, memoryview", outbound, deltas),
+            ("inbound, copying", copying.inbound, uplink),
+            ("inbound, memoryview", inbound, uplink),
+        ]
+        for label, step, items in cases:
+            allocated, elapsed = measure_allocations(step, items)
+            self.stdout.write(
+                f"{label:<28} {allocated / seconds / 1024:9.0f} KiB/s   "
+                f"{allocated / len(audio):5.2f} bytes per payload byte   "
+                f"{elapsed / seconds * 1e6:7.1f} us/s"
+            )
@@ -0,0 +1,116 @@
+# pylint: disable=all
+"""
+Concurrency benchmark for credit deductions against the configured database.
+
+    python manage.py bench_credits --threads 16 --ops 200
+
+Every strategy hammers one throwaway profile from many threads. The
+balance starts high enough for every deduction to succeed, so any
+difference between the expected and final balance is lost updates.
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from prepaiapp.credits import deduct_credits
+from prepaiapp.models import Profile
+
+
+def read_modify_write(user_id, amount):
+    """What Profile.deduct_credits and the views used to do"""
+    profile = Profile.objects.get(user_id=user_id)
+    if profile.credits >= amount:
+        profile.credits -= amount
+        profile.save(update_fields=["credits"])
+        return True
+    return False
+
+
+def select_for_update(user_id, amount):
+    """What the per-connection billing loop used to do"""
+    with transaction.atomic():
+        profile = Profile.objects.select_for_update().get(user_id=user_id)
+        if profile.credits >= amount:
+            profile.credits -= amount
+            profile.save(update_fields=["credits"])
+            return True
+        return False
+
+
+def conditional_update(user_id, amount):
+    """What prepaiapp.credits does, ledger entry included"""
+    return deduct_credits(user_id, amount, "session_charge")
+
+
+STRATEGIES = {
+    "read-modify-write": read_modify_write,
+    "select-for-update": select_for_update,
+    "conditional-update": conditional_update,
+}
+
+
+class Command(BaseCommand):
+    help = "Compare credit deduction strategies under concurrent load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument(
+            "--ops", type=int, default=200, help="Deductions per thread"
+        )
+        parser.add_argument("--amount", type=int, default=10)
+        parser.add_argument(
+            "--strategy",
+            choices=list(STRATEGIES),
+            action="append",
+            help="Strategy to run (repeatable; default all)",
+        )
+
+    def handle(self, *args, **options):
+        threads, ops, amount = options["threads"], options["ops"], options["amount"]
+        user = User.objects.create_user(f"bench-credits-{uuid.uuid4().hex[:12]}")
+        try:
+            profile = Profile.objects.create(user=user)
+            self.stdout.write(
+                f"{threads} threads x {ops} deductions of {amount} on one profile "
+                f"({connection.vendor})"
+            )
+            for name in options["strategy"] or STRATEGIES:
+                self.run_strategy(name, profile, threads, ops, amount)
+        finally:
+            user.delete()
+
+    def run_strategy(self, name, profile, threads, ops, amount):
+        deduct = STRATEGIES[name]
+        total = threads * ops
+        start_balance = total * amount
+        Profile.objects.filter(pk=profile.pk).update(credits=start_balance)
+
+        def worker(_):
+            errors = 0
+            try:
+                for _ in range(ops):
+                    try:
+                        deduct(profile.user_id, amount)
+                    except Exception:
+                        errors += 1
+            finally:
+                connection.close()
+            return errors
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            errors = sum(pool.map(worker, range(threads)))
+        elapsed = time.perf_counter() - start
+
+        final = Profile.objects.get(pk=profile.pk).credits
+        # Every successful deduction should be reflected in the balance
+        lost = (final - (start_balance - (total - errors) * amount)) // amount
+        self.stdout.write(
+            f"{name:<20} {total / elapsed:9.0f} ops/s   "
+            f"lost updates {lost:6d}   errors {errors:5d}"
+        )
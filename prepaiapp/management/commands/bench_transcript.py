@@ -0,0 +1,203 @@
+# pylint: disable=all
+"""
+CPU benchmark for roleplay transcript maintenance over a long session.
+
+    python manage.py bench_transcript --turns 2000 --block 250
+
+Replays a synthetic session as the realtime SDK reports it: for every
+turn the user's item gets its transcript and the assistant's item
+streams its reply and completes. Each step comes with the model events
+behind it and the history_updated snapshot that follows. Only the
+transcript update is timed, per block of turns, so a flat column means
+linear scaling and a growing one quadratic.
+"""
+
+import gc
+import time
+
+from agents.realtime.items import (
+    AssistantAudio,
+    AssistantMessageItem,
+    InputAudio,
+    UserMessageItem,
+)
+from agents.realtime.model_events import (
+    RealtimeModelInputAudioTranscriptionCompletedEvent,
+    RealtimeModelItemUpdatedEvent,
+    RealtimeModelTranscriptDeltaEvent,
+)
+from django.core.management.base import BaseCommand
+
+from prepaiapp.consumers import RoleplayConsumer
+from prepaiapp.models import RolePlayBots
+from prepaiapp.transcripts import TranscriptIngestor, TranscriptStore
+
+
+class RescanningTranscript:
+    """RoleplayConsumer.update_transcript as it was before TranscriptStore, for comparison"""
+
+    def __init__(self, consumer, reconcile_every):
+        self.format_item = consumer.format_history_item
+        self.transcript = []
+        self.last_processed_item_count = 0
+
+    def update(self, turn, events, history):
+        new_items = history[self.last_processed_item_count :]
+        for history_item in new_items:
+            if hasattr(history_item, "status") and history_item.status == "in_progress":
+                continue
+            formatted_item = self.format_item(history_item)
+            if formatted_item:
+                item_id = formatted_item.get("item_id")
+                if item_id:
+                    self.transcript = [
+                        item
+                        for item in self.transcript
+                        if item.get("item_id") != item_id
+                    ]
+                self.transcript.append(formatted_item)
+        completed_items = [
+            item
+            for item in history
+            if not (hasattr(item, "status") and item.status == "in_progress")
+        ]
+        self.last_processed_item_count = len(completed_items)
+
+
+def synthetic_session(turns):
+    """Yield (turn, model events, history snapshot) for every step of a session"""
+    history = []
+    for turn in range(turns):
+        user_id, assistant_id = f"item_user_{turn}", f"item_assistant_{turn}"
+        # The user's audio is committed, and transcribed a moment later
+        user = UserMessageItem(item_id=user_id, content=[InputAudio()])
+        transcript = f"User sentence number {turn}."
+        history = history + [
+            UserMessageItem(
+                item_id=user_id, content=[InputAudio(transcript=transcript)]
+            )
+        ]
+        yield turn, [
+            RealtimeModelItemUpdatedEvent(item=user),
+            RealtimeModelInputAudioTranscriptionCompletedEvent(
+                item_id=user_id, transcript=transcript
+            ),
+        ], history
+        # The reply streams in and completes a few seconds on
+        reply = f"Assistant reply number {turn}."
+        events = [
+            RealtimeModelItemUpdatedEvent(
+                item=AssistantMessageItem(
+                    item_id=assistant_id,
+                    status="in_progress",
+                    content=[AssistantAudio()],
+                )
+            )
+        ]
+        events += [
+            RealtimeModelTranscriptDeltaEvent(
+                item_id=assistant_id, delta=f"{word} ", response_id=f"response_{turn}"
+            )
+            for word in reply.split()
+        ]
+        completed = AssistantMessageItem(
+            item_id=assistant_id,
+            status="completed",
+            content=[AssistantAudio(transcript=reply)],
+        )
+        events.append(RealtimeModelItemUpdatedEvent(item=completed))
+        history = history + [completed]
+        yield turn, events, history
+
+
+class DeltaTranscript(TranscriptIngestor):
+    """RoleplayConsumer's transcript: item events, with a snapshot reconcile now and then"""
+
+    def __init__(self, consumer, reconcile_every):
+        super().__init__(TranscriptStore(), consumer.format_turn)
+        self.transcript = self.store
+        self.reconcile_every = reconcile_every
+        self.reconciled_turn = 0
+
+    def update(self, turn, events, history):
+        for event in events:
+            self.ingest(event)
+        if self.reconcile_every and turn - self.reconciled_turn >= self.reconcile_every:
+            self.reconciled_turn = turn
+            self.reconcile(history)
+
+
+STRATEGIES = {
+    "rescanning": RescanningTranscript,
+    "delta": DeltaTranscript,
+}
+
+
+class Command(BaseCommand):
+    help = "Compare transcript update strategies over a long synthetic session"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=2000)
+        parser.add_argument("--block", type=int, default=250)
+        parser.add_argument(
+            "--reconcile-every",
+            type=int,
+            default=0,
+            help=(
+                "Turns between history snapshot reconciles (default 0, never). "
+                "The consumer reconciles on a timer, every "
+                "VOICE_AGENT_TRANSCRIPT_RECONCILE_S seconds, rather than per "
+                "turn; set this to measure what each reconcile costs"
+            ),
+        )
+        parser.add_argument(
+            "--strategy",
+            choices=list(STRATEGIES),
+            action="append",
+            help="Strategy to run (repeatable; default all)",
+        )
+
+    def handle(self, *args, **options):
+        turns, block = options["turns"], options["block"]
+        consumer = RoleplayConsumer()
+        consumer.roleplay_bot = RolePlayBots(name="Coach")
+        strategies = {
+            name: STRATEGIES[name](consumer, options["reconcile_every"])
+            for name in options["strategy"] or STRATEGIES
+        }
+        elapsed = {name: [0.0] * -(-turns // block) for name in strategies}
+
+        # Each strategy replays the session on its own, so one's garbage
+        # does not slow the other down
+        for name, strategy in strategies.items():
+            # The session's items pile up and would trigger collections that
+            # land in whichever update happens to be running
+            gc.collect()
+            gc.disable()
+            try:
+                for turn, events, history in synthetic_session(turns):
+                    start = time.perf_counter()
+                    strategy.update(turn, events, history)
+                    elapsed[name][turn // block] += time.perf_counter() - start
+            finally:
+                gc.enable()
+
+        self.stdout.write(
+            f"{'turns':>11}  " + "  ".join(f"{name:>12}" for name in strategies)
+        )
+        for index in range(-(-turns // block)):
+            first = index * block
+            last = min(first + block, turns)
+            self.stdout.write(
+                f"{first:>5}-{last:<5}  "
+                + "  ".join(
+                    f"{elapsed[name][index] * 1000:10.1f}ms" for name in strategies
+                )
+            )
+        self.stdout.write(
+            "turns kept: "
+            + ", ".join(
+                f"{name} {len(strategy.transcript)}"
+                for name, strategy in strategies.items()
+            )
+        )
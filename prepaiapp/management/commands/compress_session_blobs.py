@@ -0,0 +1,73 @@
+# pylint: disable=all
+"""
+Compress the transcripts stored before they were compressed.
+
+    python manage.py compress_session_blobs [--chunk-size 200]
+
+Rows are walked in primary key order, a chunk at a time, resuming from the
+last key seen. Each chunk is read and rewritten under row locks, so a
+session saved meanwhile is not overwritten with what was read before.
+Values already compressed, or too short to be, are left alone, so the
+command can be run again until it reports nothing left.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.db.models.functions import Cast
+
+from prepaiapp.models import InterviewSession, RoleplaySession
+
+
+class Command(BaseCommand):
+    help = "Compress session transcripts written uncompressed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        for model in (RoleplaySession, InterviewSession):
+            checked, compressed = self.compress(model, options["chunk_size"])
+            self.stdout.write(
+                f"{model.__name__}: {checked} rows checked, {compressed} compressed"
+            )
+
+    def compress(self, model, chunk_size):
+        fields = [model._meta.get_field(name) for name in model.COMPRESSED_FIELDS]
+        # The stored text, bypassing the fields' decompression
+        raw = {
+            f"raw_{field.name}": Cast(field.name, models.TextField())
+            for field in fields
+        }
+        last_pk = None
+        checked = compressed = 0
+        while True:
+            with transaction.atomic():
+                rows = model.objects.select_for_update().order_by("pk")
+                if last_pk is not None:
+                    rows = rows.filter(pk__gt=last_pk)
+                rows = list(rows.annotate(**raw).values_list("pk", *raw)[:chunk_size])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                checked += len(rows)
+
+                sessions = []
+                for pk, *stored in rows:
+                    session = model(pk=pk)
+                    changed = False
+                    for field, text in zip(fields, stored):
+                        value = (
+                            None
+                            if text is None
+                            else field.from_db_value(text, None, connection)
+                        )
+                        setattr(session, field.attname, value)
+                        changed = changed or field.get_prep_value(value) != text
+                    if changed:
+                        sessions.append(session)
+                model.objects.bulk_update(sessions, [field.name for field in fields])
+                compressed += len(sessions)
+            if self.verbosity > 1:
+                self.stdout.write(f"{model.__name__}: checked up to {last_pk}")
+        return checked, compressed
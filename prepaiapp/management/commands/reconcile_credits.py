@@ -0,0 +1,142 @@
+# pylint: disable=all
+"""
+Check every Profile.credits against the sum of its user's ledger entries.
+
+    python manage.py reconcile_credits --open       # once, when the ledger ships
+    python manage.py reconcile_credits [--fix]
+
+Profiles are walked in user_id order, a chunk at a time, resuming from the
+last user_id seen (keyset pagination) so each chunk is an index range scan
+however many users there are. --open records an opening balance entry for
+every profile whose ledger has none, covering credits granted before the
+ledger existed. --fix resets drifted balances to their ledger sum; a
+profile without an opening balance is only reported, since its ledger does
+not cover what it had before, unless --open is given too.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from prepaiapp.balances import forget_balances
+from prepaiapp.models import CreditLedgerEntry, Profile
+
+
+def ledger_totals(user_ids):
+    """{user_id: (ledger sum, whether it has an opening balance)}"""
+    return {
+        row["user_id"]: (row["total"], row["opened"] > 0)
+        for row in CreditLedgerEntry.objects.filter(user_id__in=user_ids)
+        .order_by()
+        .values("user_id")
+        .annotate(
+            total=Sum("amount"),
+            opened=Count("id", filter=Q(kind="opening_balance")),
+        )
+    }
+
+
+class Command(BaseCommand):
+    help = "Reconcile materialized credit balances with the credit ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--start-after",
+            type=int,
+            default=0,
+            help="Resume after this user_id",
+        )
+        parser.add_argument(
+            "--open",
+            action="store_true",
+            help="Record opening balances for profiles without one",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Reset drifted balances to their ledger sum",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        last_user_id = options["start_after"]
+        checked = drifted = opened = fixed = skipped = 0
+        while True:
+            balances = dict(
+                Profile.objects.filter(user_id__gt=last_user_id)
+                .order_by("user_id")
+                .values_list("user_id", "credits")[:chunk_size]
+            )
+            if not balances:
+                break
+            last_user_id = max(balances)
+            checked += len(balances)
+
+            totals = ledger_totals(list(balances))
+            drift = [
+                user_id
+                for user_id, credits in balances.items()
+                if credits != totals.get(user_id, (0, False))[0]
+            ]
+            drifted += len(drift)
+            if drift and (options["open"] or options["fix"]):
+                chunk_opened, chunk_fixed, chunk_skipped = self.repair(drift, options)
+                opened += chunk_opened
+                fixed += chunk_fixed
+                skipped += chunk_skipped
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Checked up to user {last_user_id}")
+
+        self.stdout.write(
+            f"{checked} profiles checked, {drifted} drifted, "
+            f"{opened} opened, {fixed} fixed, "
+            f"{skipped} skipped without an opening balance"
+        )
+
+    def repair(self, user_ids, options):
+        """Re-check drifted profiles under lock and open or fix them"""
+        opened = []
+        fixed = []
+        skipped = 0
+        with transaction.atomic():
+            # Every balance change locks its profile row, so with the rows
+            # locked the ledger sums cannot move under us
+            profiles = list(
+                Profile.objects.select_for_update()
+                .filter(user_id__in=user_ids)
+                .order_by("user_id")
+            )
+            totals = ledger_totals(user_ids)
+            for profile in profiles:
+                total, has_opening = totals.get(profile.user_id, (0, False))
+                if profile.credits == total:
+                    continue
+                if options["open"] and not has_opening:
+                    opened.append(
+                        CreditLedgerEntry(
+                            user_id=profile.user_id,
+                            amount=profile.credits - total,
+                            kind="opening_balance",
+                        )
+                    )
+                elif options["fix"] and not has_opening:
+                    # Resetting it to its ledger sum would wipe the credits
+                    # it had before the ledger
+                    self.stdout.write(
+                        f"User {profile.user_id}: balance {profile.credits}, "
+                        f"ledger {total} without an opening balance; skipped, "
+                        f"run with --open to record one"
+                    )
+                    skipped += 1
+                elif options["fix"]:
+                    self.stdout.write(
+                        f"User {profile.user_id}: balance {profile.credits}, "
+                        f"ledger {total}"
+                    )
+                    profile.credits = total
+                    fixed.append(profile)
+            CreditLedgerEntry.objects.bulk_create(opened)
+            Profile.objects.bulk_update(fixed, ["credits"])
+        forget_balances([profile.user_id for profile in fixed])
+        return len(opened), len(fixed), skipped
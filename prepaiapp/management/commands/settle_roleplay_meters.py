@@ -0,0 +1,51 @@
+# pylint: disable=all
+"""
+Settle roleplay sessions that were metered but never settled.
+
+    python manage.py settle_roleplay_meters
+
+Meant for cron. Consumers settle their own sessions when they end; this
+picks up the ones whose process died first, from the meter checkpoints
+they left in the cache, which must therefore be shared between processes
+(REDIS_URL): it refuses to run on a per-process cache, where it would see
+no checkpoints at all.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from prepaiapp.billing import meters_are_shared, sweep_unsettled_sessions
+
+
+class Command(BaseCommand):
+    help = "Settle roleplay sessions abandoned without settlement"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=getattr(settings, "VOICE_AGENT_METER_STALE", 120),
+            help="Seconds without a checkpoint before a session counts as abandoned",
+        )
+        parser.add_argument(
+            "--max-session",
+            type=int,
+            default=getattr(settings, "VOICE_AGENT_MAX_SESSION_S", 10800),
+            help="Longest a session can run; older ones without a checkpoint are closed",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not meters_are_shared():
+            raise CommandError(
+                "The default cache is local to each process, so the meter "
+                "checkpoints of live sessions are not visible here; configure "
+                "a shared cache (REDIS_URL) before settling sessions"
+            )
+        settled, closed = sweep_unsettled_sessions(
+            options["stale_after"], options["chunk_size"], options["max_session"]
+        )
+        self.stdout.write(
+            f"{settled} sessions settled from checkpoints, "
+            f"{closed} closed with nothing metered"
+        )
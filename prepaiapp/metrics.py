@@ -0,0 +1,156 @@
+# pylint: disable=all
+"""Per-process latency histograms for the voice agent consumers."""
+
+import threading
+import time
+from bisect import bisect_left
+
+# Latencies tracked for every voice connection:
+#   connect        connect() entered -> WebSocket accepted
+#   session_ready  accepted -> realtime session ready
+#   first_audio    accepted -> first assistant audio
+#   turn           upstream end-of-speech -> first assistant audio of the reply
+VOICE_LATENCY_METRICS = ("connect", "session_ready", "first_audio", "turn")
+
+
+def _round_ms(ms):
+    return None if ms is None else round(ms, 1)
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of latencies in milliseconds"""
+
+    BUCKETS_MS = (
+        10,
+        25,
+        50,
+        100,
+        200,
+        300,
+        500,
+        750,
+        1000,
+        1500,
+        2000,
+        3000,
+        5000,
+        10000,
+        30000,
+    )
+
+    def __init__(self):
+        # The last bucket counts everything above BUCKETS_MS[-1]
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+
+    def observe(self, ms):
+        self.counts[bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.min_ms = ms if self.min_ms is None else min(self.min_ms, ms)
+        self.max_ms = ms if self.max_ms is None else max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if index < len(self.BUCKETS_MS):
+                    return min(self.BUCKETS_MS[index], self.max_ms)
+                break
+        return self.max_ms
+
+    def as_dict(self):
+        labels = [f"le_{bound}" for bound in self.BUCKETS_MS] + ["inf"]
+        return {
+            "count": self.count,
+            "avg_ms": _round_ms(self.total_ms / self.count) if self.count else None,
+            "min_ms": _round_ms(self.min_ms),
+            "max_ms": _round_ms(self.max_ms),
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+_lock = threading.Lock()
+_started_at = time.time()
+_histograms = {name: LatencyHistogram() for name in VOICE_LATENCY_METRICS}
+
+
+def record_latency(name, ms):
+    with _lock:
+        _histograms[name].observe(ms)
+
+
+def latency_snapshot():
+    """Aggregates for this process since it started"""
+    with _lock:
+        metrics = {name: hist.as_dict() for name, hist in _histograms.items()}
+    return {"since": _started_at, "metrics": metrics}
+
+
+class VoiceLatencyTracker:
+    """
+    Monotonic timestamps for one voice connection.
+
+    Each mark_* call records into the per-process histograms as well, so a
+    connection that never finishes still contributes what it measured.
+    """
+
+    def __init__(self):
+        self.connect_started_at = time.monotonic()
+        self.accepted_at = None
+        self.connect_ms = None
+        self.session_ready_ms = None
+        self.first_audio_ms = None
+        self.speech_stopped_at = None
+        self.turns_ms = []
+
+    def _elapsed_ms(self, since):
+        return (time.monotonic() - since) * 1000
+
+    def mark_accepted(self):
+        self.accepted_at = time.monotonic()
+        self.connect_ms = self._elapsed_ms(self.connect_started_at)
+        record_latency("connect", self.connect_ms)
+
+    def mark_session_ready(self):
+        if self.accepted_at is None or self.session_ready_ms is not None:
+            return
+        self.session_ready_ms = self._elapsed_ms(self.accepted_at)
+        record_latency("session_ready", self.session_ready_ms)
+
+    def mark_speech_stopped(self):
+        self.speech_stopped_at = time.monotonic()
+
+    def mark_audio(self):
+        """Assistant audio arrived from the realtime session"""
+        if self.first_audio_ms is None and self.accepted_at is not None:
+            self.first_audio_ms = self._elapsed_ms(self.accepted_at)
+            record_latency("first_audio", self.first_audio_ms)
+        if self.speech_stopped_at is not None:
+            turn_ms = self._elapsed_ms(self.speech_stopped_at)
+            self.speech_stopped_at = None
+            self.turns_ms.append(turn_ms)
+            record_latency("turn", turn_ms)
+
+    def as_dict(self):
+        turns = self.turns_ms
+        return {
+            "connect_ms": _round_ms(self.connect_ms),
+            "session_ready_ms": _round_ms(self.session_ready_ms),
+            "first_audio_ms": _round_ms(self.first_audio_ms),
+            "turns": len(turns),
+            "turn_avg_ms": _round_ms(sum(turns) / len(turns)) if turns else None,
+            "turn_max_ms": _round_ms(max(turns)) if turns else None,
+            "turns_ms": [round(ms) for ms in turns],
+        }
@@ -8,6 +8,8 @@ from django.utils.text import slugify
 from datetime import timedelta
 import uuid
 
+from .fields import CompressedTextField
+
 
 class InterviewTemplate(models.Model):
     """
@@ -66,6 +68,10 @@ class InterviewSession(models.Model):
         ("abandoned", "Abandoned"),
         ("disconnected", "Disconnected"),
     ]
+    # Blobs deferred wherever they are not displayed; the JSON ones stay
+    # jsonb, which Postgres compresses itself, and only text is compressed
+    LARGE_FIELDS = ("transcript", "turns", "feedback")
+    COMPRESSED_FIELDS = ("transcript",)
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     template = models.ForeignKey(InterviewTemplate, on_delete=models.CASCADE)
@@ -75,7 +81,10 @@ class InterviewSession(models.Model):
         max_length=20, choices=STATUS_CHOICES, default="in_progress"
     )
     feedback = models.JSONField(blank=True, default=dict)
-    transcript = models.TextField(blank=True)
+    # Text transcript of sessions recorded before turns were stored
+    transcript = CompressedTextField(blank=True)
+    # Transcript turns, each {"role", "content", "spoken_at"}
+    turns = models.JSONField(blank=True, default=list)
 
     # Timestamps
     started_at = models.DateTimeField(auto_now_add=True)
@@ -87,6 +96,20 @@ class InterviewSession(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.template.title}"
 
+    def conversation_turns(self):
+        """Transcript turns for display, with spoken_at parsed"""
+        from .transcripts import display_turns
+
+        return display_turns(self.turns)
+
+    def transcript_text(self):
+        """The transcript as text, rendered from its turns when not stored"""
+        if self.transcript:
+            return self.transcript
+        from .transcripts import render_interview_transcript
+
+        return render_interview_transcript(self.turns)
+
 
 class EarlyAccessEmail(models.Model):
     email = models.EmailField(unique=True)
@@ -113,16 +136,19 @@ class Profile(models.Model):
     def has_credit(self, required=10):
         return self.credits >= required
 
-    def deduct_credits(self, used=10):
-        if self.credits >= used:
+    def deduct_credits(self, used=10, kind="session_charge", reference=""):
+        from .credits import deduct_credits
+
+        if deduct_credits(self.user_id, used, kind, reference):
             self.credits -= used
-            self.save()
             return True
         return False
 
-    def add_minutes(self, minutes):
+    def add_minutes(self, minutes, kind="grant", reference=""):
+        from .credits import add_credits
+
+        add_credits(self.user_id, minutes, kind, reference)
         self.credits += minutes
-        self.save()
 
 
 # models.py
@@ -339,6 +365,50 @@ class Transaction(models.Model):
         return f"{self.user.username} - {self.transaction_id} - {self.status}"
 
 
+class CreditLedgerEntry(models.Model):
+    """
+    One change to a user's credit balance. Rows are only ever inserted, in
+    the same transaction as the Profile.credits update they account for,
+    so a balance always equals the sum of its user's entries.
+    """
+
+    KIND_CHOICES = [
+        ("grant", "Grant"),
+        ("purchase", "Purchase"),
+        ("session_charge", "Session Charge"),
+        ("bot_creation", "Bot Creation"),
+        ("opening_balance", "Opening Balance"),
+    ]
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="credit_ledger", db_index=False
+    )
+    # Signed: negative for charges and fees
+    amount = models.IntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # What the change was for: a payment, session, bot or share id
+    reference = models.CharField(max_length=100, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["user", "created_at"]),
+            models.Index(fields=["kind", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.amount:+d} {self.kind} for user {self.user_id}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Credit ledger entries are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Credit ledger entries are append-only")
+
+
 class RolePlayBots(models.Model):
     VOICE_CHOICES = [
     ("alloy", "Alloy (Male)"),
@@ -425,6 +495,11 @@ class RolePlayBots(models.Model):
 
 
 class RoleplaySession(models.Model):
+    # Blobs deferred wherever they are not displayed; the JSON ones stay
+    # jsonb, which Postgres compresses itself, and only text is compressed
+    LARGE_FIELDS = ("transcript", "feedback")
+    COMPRESSED_FIELDS = ("transcript",)
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     bot = models.ForeignKey(RolePlayBots, on_delete=models.CASCADE)
@@ -436,20 +511,86 @@ class RoleplaySession(models.Model):
             ("disconnected", "Disconnected"),
         ],
     )
-    transcript = models.TextField(blank=True)
+    transcript = CompressedTextField(blank=True)
     feedback = models.JSONField(blank=True, default=dict)
     duration_seconds = models.IntegerField(default=0)
     credits_used = models.PositiveIntegerField(default=0)
+    # Metered seconds charged when the session was settled
+    billed_seconds = models.PositiveIntegerField(default=0)
+    settled_at = models.DateTimeField(null=True, blank=True)
+    # Channel name of the one consumer allowed to meter and settle it
+    claimed_by = models.CharField(max_length=100, blank=True, default="")
+    latency_metrics = models.JSONField(
+        blank=True, default=dict, help_text="Connect and turn latencies in ms"
+    )
     started_at = models.DateTimeField()
     completed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["-started_at"]
+        indexes = [
+            # What the crash-recovery sweep scans
+            models.Index(
+                fields=["started_at"],
+                name="roleplay_unsettled_idx",
+                condition=models.Q(settled_at__isnull=True),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.bot.name}"
 
+    def transcript_text(self):
+        """The transcript as text, assembled from its segments when not stored"""
+        if self.transcript:
+            return self.transcript
+        from .transcripts import render_transcript, segment_turns
+
+        return render_transcript(
+            self.bot,
+            self.started_at,
+            segment_turns(self.bot, self.segments.order_by("seq", "id")),
+        )
+
+
+class TranscriptSegment(models.Model):
+    """
+    One turn of a roleplay session's transcript, appended while the session
+    runs. Rows are only ever inserted: a turn corrected later, or deleted,
+    gets a newer row with the same seq, empty text marking a deletion, and
+    the last row of each seq is the one that counts.
+    """
+
+    session = models.ForeignKey(
+        RoleplaySession,
+        on_delete=models.CASCADE,
+        related_name="segments",
+        db_index=False,
+    )
+    # Position of the turn in the conversation
+    seq = models.PositiveIntegerField()
+    item_id = models.CharField(max_length=64, blank=True, default="")
+    role = models.CharField(max_length=20)
+    text = models.TextField(blank=True)
+    # When the turn was heard, and when this row was written
+    spoken_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["session", "seq", "id"]
+        indexes = [
+            models.Index(fields=["session", "seq"]),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} #{self.seq} {self.role}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Transcript segments are append-only")
+        super().save(*args, **kwargs)
+
 
 class RolePlayShare(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -495,6 +636,10 @@ class CreditShare(models.Model):
         RolePlayShare, on_delete=models.CASCADE, null=True, blank=True
     )
     bot = models.ForeignKey(RolePlayBots, on_delete=models.CASCADE)
+    # Roleplay session whose billed minutes accumulate on this row
+    session = models.ForeignKey(
+        RoleplaySession, on_delete=models.SET_NULL, null=True, blank=True
+    )
     credited_to = models.ForeignKey(User, on_delete=models.CASCADE, default=None)
     credited_from = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name="credited_from", default=None
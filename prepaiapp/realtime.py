@@ -0,0 +1,348 @@
+# pylint: disable=all
+"""Upstream realtime sessions for the voice agent consumers."""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from agents.realtime import RealtimeAgent, RealtimePlaybackTracker, RealtimeRunner
+from agents.realtime.model import RealtimeModel
+from agents.realtime.model_events import (
+    RealtimeModelConnectionStatusEvent,
+    RealtimeModelEndOfStreamEvent,
+)
+from agents.realtime.model_inputs import (
+    RealtimeModelSendAudio,
+    RealtimeModelSendSessionUpdate,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INSTRUCTIONS = (
+    "You are a helpful AI assistant. "
+    "Always respond strictly in English. "
+    "Do not translate, detect, or switch to any other language. "
+    "If the user speaks in another language, politely respond in English only."
+)
+
+
+def default_agent():
+    return RealtimeAgent(name="Assistant", instructions=DEFAULT_INSTRUCTIONS, tools=[])
+
+
+def realtime_model_settings(audio_format="pcm16", voice="alloy"):
+    """Session settings every voice connection starts from"""
+    return {
+        "voice": voice,
+        "input_audio_format": audio_format,
+        "output_audio_format": audio_format,
+        "turn_detection": {
+            "type": "semantic_vad",
+            "interrupt_response": True,
+            "create_response": True,
+        },
+        "input_audio_transcription": {"model": "whisper-1"},
+        "output_audio_transcription": {"model": "whisper-1"},
+    }
+
+
+class LocalRealtimeModel(RealtimeModel):
+    """
+    Offline stand-in for the OpenAI realtime backend.
+
+    Accepts every event and never answers; tests drive it with emit(). Set
+    VOICE_AGENT_REALTIME_BACKEND = "local" to run the consumers without an
+    API key.
+    """
+
+    # Simulated handshake time in seconds
+    connect_delay = 0.0
+
+    def __init__(self):
+        self.listeners = []
+        self.settings = {}
+        self.sent = []
+        self.audio_bytes = 0
+        self.connected = False
+
+    async def connect(self, options):
+        await asyncio.sleep(self.connect_delay)
+        self.settings = dict(options.get("initial_model_settings") or {})
+        self.connected = True
+        await self.emit(RealtimeModelConnectionStatusEvent(status="connected"))
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    async def send_event(self, event):
+        self.sent.append(event)
+        if isinstance(event, RealtimeModelSendSessionUpdate):
+            self.settings = dict(event.session_settings)
+        elif isinstance(event, RealtimeModelSendAudio):
+            self.audio_bytes += len(event.audio)
+
+    async def emit(self, event):
+        """Deliver a model event to the session, as the server would"""
+        for listener in list(self.listeners):
+            await listener.on_event(event)
+
+    async def end_stream(self):
+        """Simulate the server dropping the connection"""
+        self.connected = False
+        await self.emit(RealtimeModelEndOfStreamEvent())
+
+    async def close(self):
+        self.connected = False
+
+
+def create_realtime_model():
+    """Model for a new upstream session; None means the SDK default"""
+    if getattr(settings, "VOICE_AGENT_REALTIME_BACKEND", "openai") == "local":
+        return LocalRealtimeModel()
+    return None
+
+
+class PooledSession:
+    """
+    An entered, idle realtime session waiting in the pool.
+
+    Used as an async context manager in place of the session itself; leaving
+    it closes the session, since a used session is never pooled again.
+    """
+
+    def __init__(self, session, agent, model_settings, playback_tracker):
+        self.session = session
+        self.agent = agent
+        self.model_settings = model_settings
+        self.playback_tracker = playback_tracker
+        self.created_at = time.monotonic()
+        self.closed = False
+        self.watcher = None
+
+    def age(self, now):
+        return now - self.created_at
+
+    async def __aenter__(self):
+        return self.session
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+
+class RealtimeSessionPool:
+    """
+    Per-process pool of pre-connected, idle upstream realtime sessions.
+
+    checkout() never waits: it hands out the oldest live session or reports a
+    miss so the caller connects cold. A maintenance task tops the pool back
+    up to size and closes sessions older than ttl, which the server would
+    otherwise time out under us.
+    """
+
+    # Longest wait between maintenance passes and after failed connects
+    maintenance_interval = 5.0
+    max_retry_delay = 60.0
+
+    def __init__(self, size, ttl, model_factory=create_realtime_model):
+        self.size = size
+        self.ttl = ttl
+        self.model_factory = model_factory
+        self.idle = deque()
+        self.connecting = 0
+        self.wakeup = asyncio.Event()
+        self.maintenance_task = None
+        self.stopping = False
+        self.tasks = set()
+        # The event loop this pool's sessions and tasks belong to
+        self.loop = None
+        self.consecutive_failures = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.failed = 0
+
+    def start(self):
+        if self.stopping:
+            return
+        if self.maintenance_task is None or self.maintenance_task.done():
+            self.maintenance_task = asyncio.create_task(self._maintain())
+
+    async def stop(self):
+        self.stopping = True
+        if self.maintenance_task:
+            # Cancelling alone can be lost if wait_for() is woken at the same time
+            self.wakeup.set()
+            self.maintenance_task.cancel()
+            try:
+                await self.maintenance_task
+            except asyncio.CancelledError:
+                pass
+        while self.idle:
+            await self._close(self.idle.popleft())
+        for task in list(self.tasks):
+            task.cancel()
+
+    def checkout(self):
+        """Take an idle session, or None on a miss"""
+        self.start()
+        now = time.monotonic()
+        pooled = None
+        while self.idle:
+            candidate = self.idle.popleft()
+            candidate.watcher.cancel()
+            if candidate.closed or candidate.age(now) >= self.ttl:
+                self._evict(candidate)
+                continue
+            pooled = candidate
+            break
+        if pooled:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.wakeup.set()
+        return pooled
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": self.size,
+            "ttl_s": self.ttl,
+            "idle": len(self.idle),
+            "connecting": self.connecting,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else None,
+            "evicted": self.evicted,
+            "failed": self.failed,
+        }
+
+    async def _maintain(self):
+        try:
+            while not self.stopping:
+                now = time.monotonic()
+                for pooled in [p for p in self.idle if p.age(now) >= self.ttl]:
+                    self.idle.remove(pooled)
+                    pooled.watcher.cancel()
+                    self._evict(pooled)
+
+                for _ in range(self.size - len(self.idle) - self.connecting):
+                    self.connecting += 1
+                    self._spawn(self._open())
+
+                if self.consecutive_failures:
+                    delay = min(2**self.consecutive_failures, self.max_retry_delay)
+                    await asyncio.sleep(delay)
+                    continue
+                timeout = self.maintenance_interval
+                if self.idle:
+                    oldest = self.ttl - self.idle[0].age(time.monotonic())
+                    timeout = max(0, min(timeout, oldest))
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error in realtime session pool: {e}")
+
+    async def _open(self):
+        try:
+            agent = default_agent()
+            model_settings = realtime_model_settings()
+            playback_tracker = RealtimePlaybackTracker()
+            runner = RealtimeRunner(agent, model=self.model_factory())
+            session = await runner.run(
+                model_config={
+                    "playback_tracker": playback_tracker,
+                    "initial_model_settings": dict(model_settings),
+                }
+            )
+            await session.enter()
+        except Exception as e:
+            self.failed += 1
+            self.consecutive_failures += 1
+            logger.warning(f"Could not open pooled realtime session: {e}")
+            return
+        finally:
+            self.connecting -= 1
+
+        self.consecutive_failures = 0
+        if self.stopping:
+            await session.close()
+            return
+        pooled = PooledSession(session, agent, model_settings, playback_tracker)
+        pooled.watcher = asyncio.create_task(self._watch(pooled))
+        self.idle.append(pooled)
+        # Let maintenance schedule this session's expiry
+        self.wakeup.set()
+
+    async def _watch(self, pooled):
+        """Drain an idle session's events, evicting it if upstream goes away"""
+        try:
+            async for event in pooled.session:
+                if event.type == "error":
+                    logger.warning(f"Pooled realtime session error: {event.error}")
+                    break
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            logger.warning(f"Pooled realtime session failed: {e}")
+        pooled.closed = True
+        if pooled in self.idle:
+            self.idle.remove(pooled)
+            self._evict(pooled)
+            self.wakeup.set()
+
+    def _evict(self, pooled):
+        self.evicted += 1
+        self._spawn(self._close(pooled))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _close(self, pooled):
+        if pooled.watcher and not pooled.watcher.done():
+            pooled.watcher.cancel()
+        pooled.closed = True
+        try:
+            await pooled.session.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled realtime session: {e}")
+
+
+_pool = None
+
+
+def get_session_pool():
+    """
+    The process-wide pool, or None when VOICE_AGENT_POOL_SIZE is 0.
+
+    A pool belongs to the event loop it was created on; a new loop (as in
+    tests) gets a fresh one.
+    """
+    global _pool
+    size = getattr(settings, "VOICE_AGENT_POOL_SIZE", 0)
+    if size <= 0:
+        return None
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.loop is not loop:
+        _pool = RealtimeSessionPool(
+            size, getattr(settings, "VOICE_AGENT_POOL_TTL", 300)
+        )
+        _pool.loop = loop
+    return _pool
+
+
+def session_pool_stats():
+    return _pool.stats() if _pool else None
@@ -0,0 +1,207 @@
+# pylint: disable=all
+"""Per-connection stream plumbing for the voice agent consumers."""
+
+import asyncio
+from collections import deque
+
+
+class OutboundQueue:
+    """
+    Bounded outbound queue with priority lanes.
+
+    Control and transcript messages are never dropped. Audio frames share the
+    audio lane with the stream markers (e.g. audio_end) that must stay ordered
+    behind them; only frames are ever shed, oldest first, once more than
+    max_audio_ms of audio is waiting.
+    """
+
+    CONTROL = 0
+    TRANSCRIPT = 1
+    AUDIO = 2
+
+    def __init__(self, bytes_per_second, max_audio_ms):
+        self.bytes_per_second = bytes_per_second
+        self.max_audio_bytes = int(bytes_per_second * max_audio_ms / 1000)
+        self.lanes = (deque(), deque(), deque())
+        self.wakeup = asyncio.Event()
+        self.audio_bytes = 0
+        self.max_depth = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def put(self, message, priority=CONTROL):
+        """Queue a text message; AUDIO priority keeps it ordered with the audio"""
+        self.lanes[priority].append(message)
+        self._added()
+
+    def put_audio(self, frame, queued_at):
+        """Queue an audio frame, shedding the oldest frames past the cap"""
+        self.lanes[self.AUDIO].append((queued_at, frame))
+        self.audio_bytes += len(frame.data)
+        while self.audio_bytes > self.max_audio_bytes and self._shed_oldest_audio():
+            pass
+        self._added()
+
+    def pop_message(self):
+        """Pop the next control or transcript message, if any"""
+        for lane in self.lanes[: self.AUDIO]:
+            if lane:
+                return lane.popleft()
+        return None
+
+    def audio_head(self):
+        """Next audio lane entry: a marker string or a (queued_at, frame) pair"""
+        lane = self.lanes[self.AUDIO]
+        return lane[0] if lane else None
+
+    def pop_audio(self):
+        entry = self.lanes[self.AUDIO].popleft()
+        if not isinstance(entry, str):
+            self.audio_bytes -= len(entry[1].data)
+        return entry
+
+    def drop_audio_head(self):
+        """Skip the frame at the head of the audio lane as stale"""
+        entry = self.pop_audio()
+        self._count_drop(entry[1])
+        return entry
+
+    def clear_audio(self):
+        self.lanes[self.AUDIO].clear()
+        self.audio_bytes = 0
+
+    async def wait(self, timeout=None):
+        """Wait until something is queued; returns False on timeout"""
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def notify(self):
+        self.wakeup.set()
+
+    @property
+    def queued_audio_ms(self):
+        return self.audio_bytes * 1000 / self.bytes_per_second
+
+    @property
+    def dropped_ms(self):
+        return self.dropped_bytes * 1000 / self.bytes_per_second
+
+    def stats(self):
+        return {
+            "depth": len(self),
+            "max_depth": self.max_depth,
+            "queued_audio_ms": round(self.queued_audio_ms),
+            "dropped_frames": self.dropped_frames,
+            "dropped_ms": round(self.dropped_ms),
+        }
+
+    def _added(self):
+        self.max_depth = max(self.max_depth, len(self))
+        self.wakeup.set()
+
+    def _shed_oldest_audio(self):
+        lane = self.lanes[self.AUDIO]
+        for index, entry in enumerate(lane):
+            if not isinstance(entry, str):
+                del lane[index]
+                self.audio_bytes -= len(entry[1].data)
+                self._count_drop(entry[1])
+                return True
+        return False
+
+    def _count_drop(self, frame):
+        self.dropped_frames += 1
+        self.dropped_bytes += len(frame.data)
+
+
+class InboundAudioBuffer:
+    """
+    Fixed-capacity ring buffer for client audio on its way upstream.
+
+    Writes never block: when the buffer is full the oldest audio is dropped
+    so the pump always forwards the most recent speech.
+    """
+
+    def __init__(self, capacity_bytes, bytes_per_second):
+        self.capacity = capacity_bytes & ~1
+        self.bytes_per_second = bytes_per_second
+        self.buffer = bytearray(self.capacity)
+        self.start = 0
+        self.size = 0
+        self.pending_since = None
+        self.data_ready = asyncio.Event()
+        self.received_bytes = 0
+        self.dropped_bytes = 0
+
+    def write(self, data, now):
+        """Append audio, overwriting the oldest bytes on overflow"""
+        data = memoryview(data)
+        self.received_bytes += len(data)
+        if len(data) > self.capacity:
+            self.dropped_bytes += len(data) - self.capacity
+            data = data[len(data) - self.capacity :]
+
+        overflow = self.size + len(data) - self.capacity
+        if overflow > 0:
+            # Keep PCM16 sample alignment when dropping
+            self._drop(overflow + (overflow & 1))
+
+        end = (self.start + self.size) % self.capacity
+        first = min(len(data), self.capacity - end)
+        self.buffer[end : end + first] = data[:first]
+        self.buffer[: len(data) - first] = data[first:]
+        if not self.size:
+            self.pending_since = now
+        self.size += len(data)
+        self.data_ready.set()
+
+    def read(self, max_bytes):
+        """Remove and return up to max_bytes of the oldest buffered audio"""
+        count = min(self.size, max_bytes)
+        first = min(count, self.capacity - self.start)
+        view = memoryview(self.buffer)
+        if count > first:
+            # Wrapped around the end of the ring
+            chunk = bytearray(count)
+            chunk[:first] = view[self.start :]
+            chunk[first:] = view[: count - first]
+        else:
+            chunk = bytes(view[self.start : self.start + count])
+        self.start = (self.start + count) % self.capacity
+        self.size -= count
+        if not self.size:
+            self.pending_since = None
+        return chunk
+
+    async def wait(self, timeout=None):
+        """Wait for new audio; returns False on timeout"""
+        self.data_ready.clear()
+        try:
+            await asyncio.wait_for(self.data_ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @property
+    def dropped_ms(self):
+        return self.dropped_bytes * 1000 / self.bytes_per_second
+
+    def stats(self):
+        return {
+            "buffered_ms": round(self.size * 1000 / self.bytes_per_second),
+            "received_ms": round(self.received_bytes * 1000 / self.bytes_per_second),
+            "dropped_ms": round(self.dropped_ms),
+        }
+
+    def _drop(self, count):
+        count = min(count, self.size)
+        self.start = (self.start + count) % self.capacity
+        self.size -= count
+        self.dropped_bytes += count
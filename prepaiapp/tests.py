@@ -1,3 +1,1586 @@
-from django.test import TestCase
+import asyncio
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import time as time_of_day, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import redis
+from agents.realtime.items import (
+    AssistantAudio,
+    AssistantMessageItem,
+    InputAudio,
+    UserMessageItem,
+)
+from agents.realtime.model_events import (
+    RealtimeModelAudioDoneEvent,
+    RealtimeModelAudioEvent,
+    RealtimeModelInputAudioTranscriptionCompletedEvent,
+    RealtimeModelItemDeletedEvent,
+    RealtimeModelItemUpdatedEvent,
+    RealtimeModelTranscriptDeltaEvent,
+)
+from agents.realtime.model_inputs import RealtimeModelSendRawMessage
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Cast
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import balances
+from .audio import (
+    AUDIO_FRAME_HEADER,
+    AUDIO_FRAME_HEADER_SIZE,
+    AUDIO_FRAME_INPUT,
+    AUDIO_FRAME_VERSION,
+    RESAMPLER_TAPS,
+    AudioFrame,
+    AudioFrameCoalescer,
+    AudioResampler,
+    EnergyVAD,
+    UplinkAudioStats,
+    g711_decode,
+    g711_encode,
+    pack_output_audio_frame,
+    unpack_input_audio_frame,
+)
+from .balances import (
+    INSUFFICIENT,
+    LocalBalanceCache,
+    RedisBalanceCache,
+    get_balance,
+    get_balance_cache,
+)
+from .billing import (
+    BillableSession,
+    BillingTicker,
+    meter_cache_key,
+    settle_session,
+    sweep_unsettled_sessions,
+)
+from .consumers import RoleplayConsumer
+from .credits import add_credits, deduct_credits
+from .fields import is_compressed
+from .greetings import Greeting, get_greeting_store, greeting_key
+from .handoff import mint_handoff_token
+from .metrics import LatencyHistogram
+from .models import (
+    CreditLedgerEntry,
+    CreditShare,
+    InterviewSession,
+    InterviewTemplate,
+    Profile,
+    RolePlayBots,
+    RoleplaySession,
+    TranscriptSegment,
+)
+from .realtime import LocalRealtimeModel, RealtimeSessionPool, get_session_pool
+from .routing import websocket_urlpatterns
+from .streams import InboundAudioBuffer, OutboundQueue
+from .transcripts import (
+    TranscriptCheckpointer,
+    TranscriptIngestor,
+    TranscriptStore,
+    display_turns,
+    interview_turn,
+    parse_transcript_text,
+    render_interview_transcript,
+)
+
+
+class AudioFrameTests(SimpleTestCase):
+    def test_output_frame_is_a_header_and_the_payload(self):
+        audio = b"\x01\x02\x03\x04"
+        frame = pack_output_audio_frame(7, 1, 2**32 + 5, audio)
+
+        self.assertEqual(AUDIO_FRAME_HEADER_SIZE, 12)
+        self.assertEqual(
+            frame[:AUDIO_FRAME_HEADER_SIZE],
+            bytes([1, 1, 1, 0, 7, 0, 0, 0, 5, 0, 0, 0]),
+        )
+        self.assertEqual(frame[AUDIO_FRAME_HEADER_SIZE:], audio)
+
+    def test_input_frame_payload_is_a_view_past_the_header(self):
+        frame = (
+            AUDIO_FRAME_HEADER.pack(AUDIO_FRAME_VERSION, AUDIO_FRAME_INPUT, 0, 9, 1234)
+            + b"\x10\x00\x20\x00"
+        )
+        seq, capture_ms, payload = unpack_input_audio_frame(frame)
+
+        self.assertEqual((seq, capture_ms), (9, 1234))
+        self.assertIsInstance(payload, memoryview)
+        self.assertEqual(payload.tobytes(), b"\x10\x00\x20\x00")
+
+    def test_malformed_input_frames_are_rejected(self):
+        with self.assertRaisesMessage(ValueError, "too short"):
+            unpack_input_audio_frame(b"\x01\x02")
+        output_frame = pack_output_audio_frame(0, 0, 0, b"\x00\x00")
+        with self.assertRaisesMessage(ValueError, "Unsupported"):
+            unpack_input_audio_frame(output_frame)
+
+
+class UplinkAudioStatsTests(SimpleTestCase):
+    def test_counts_lost_and_late_frames_and_queueing_delay(self):
+        stats = UplinkAudioStats()
+        self.assertTrue(stats.observe(0, 1000, 1050))
+        self.assertTrue(stats.observe(1, 1020, 1090))
+        # Frame 2 is missing...
+        self.assertTrue(stats.observe(3, 1060, 1110))
+        self.assertEqual(stats.lost_frames, 1)
+        # ...and turns up late, after frame 3 was forwarded
+        self.assertFalse(stats.observe(2, 1040, 1200))
+
+        self.assertEqual(
+            stats.as_dict(),
+            {
+                "frames": 3,
+                "lost_frames": 0,
+                "late_frames": 1,
+                "last_delay_ms": 0,
+                "max_delay_ms": 20,
+                "avg_delay_ms": 6.7,
+            },
+        )
+
+    def test_sequence_numbers_wrap_around(self):
+        stats = UplinkAudioStats()
+        stats.observe(0xFFFFFFFF, 0, 10)
+        self.assertTrue(stats.observe(0, 20, 30))
+        self.assertEqual((stats.lost_frames, stats.late_frames), (0, 0))
+
+
+class AudioFrameCoalescerTests(SimpleTestCase):
+    def frames(self, frames):
+        return [
+            (frame.item_id, frame.content_index, bytes(frame.data)) for frame in frames
+        ]
+
+    def test_deltas_are_cut_into_frames_within_an_item(self):
+        coalescer = AudioFrameCoalescer(4)
+        self.assertEqual(coalescer.push("a", 0, b"12", now=1), [])
+        self.assertEqual(coalescer.pending_since, 1)
+        self.assertEqual(
+            self.frames(coalescer.push("a", 0, b"345678", now=2)),
+            [("a", 0, b"1234"), ("a", 0, b"5678")],
+        )
+        self.assertIsNone(coalescer.pending_since)
+
+        coalescer.push("a", 0, b"9", now=3)
+        # A new item flushes the previous one's remainder as a short frame
+        self.assertEqual(
+            self.frames(coalescer.push("b", 0, b"abcd", now=4)),
+            [("a", 0, b"9"), ("b", 0, b"abcd")],
+        )
+        self.assertIsNone(coalescer.flush())
+
+        coalescer.push("b", 1, b"xy", now=5)
+        self.assertEqual(self.frames([coalescer.flush()]), [("b", 1, b"xy")])
+
+    def test_whole_frames_are_views_and_straddling_frames_own_their_buffer(self):
+        coalescer = AudioFrameCoalescer(4)
+        delta = bytearray(b"12345678ab")
+        whole = coalescer.push("a", 0, delta, now=1)
+        self.assertEqual(len(whole), 2)
+        self.assertIs(whole[0].data.obj, delta)
+
+        straddling = coalescer.push("a", 0, b"cd", now=2)[0]
+        coalescer.push("a", 0, b"efgh", now=3)
+        coalescer.push("a", 0, b"zz", now=4)
+        # Later deltas go to a new buffer, not over a frame already handed off
+        self.assertEqual(bytes(straddling.data), b"abcd")
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def frame(self, data):
+        return AudioFrame("item", 0, data)
+
+    def audio_lane(self, queue):
+        entries = []
+        while queue.audio_head() is not None:
+            entry = queue.pop_audio()
+            entries.append(entry if isinstance(entry, str) else bytes(entry[1].data))
+        return entries
+
+    def test_messages_jump_the_audio_in_priority_order(self):
+        queue = OutboundQueue(bytes_per_second=1000, max_audio_ms=100)
+        queue.put_audio(self.frame(b"aaaa"), queued_at=0)
+        queue.put("transcript", OutboundQueue.TRANSCRIPT)
+        queue.put("control")
+        queue.put("audio_end", OutboundQueue.AUDIO)
+
+        self.assertEqual(queue.pop_message(), "control")
+        self.assertEqual(queue.pop_message(), "transcript")
+        self.assertIsNone(queue.pop_message())
+        # Markers stay behind the audio they follow
+        self.assertEqual(self.audio_lane(queue), [b"aaaa", "audio_end"])
+        self.assertEqual(queue.stats()["max_depth"], 4)
+
+    def test_oldest_frames_are_shed_past_the_cap_but_never_markers(self):
+        queue = OutboundQueue(bytes_per_second=1000, max_audio_ms=10)
+        queue.put_audio(self.frame(b"1111"), queued_at=0)
+        queue.put("audio_end", OutboundQueue.AUDIO)
+        queue.put_audio(self.frame(b"2222"), queued_at=1)
+        self.assertEqual(queue.dropped_frames, 0)
+        queue.put_audio(self.frame(b"3333"), queued_at=2)
+
+        self.assertEqual((queue.dropped_frames, queue.dropped_ms), (1, 4))
+        self.assertEqual(queue.queued_audio_ms, 8)
+        self.assertEqual(self.audio_lane(queue), ["audio_end", b"2222", b"3333"])
+        self.assertEqual(queue.audio_bytes, 0)
+
+    def test_stale_head_frames_count_as_dropped(self):
+        queue = OutboundQueue(bytes_per_second=1000, max_audio_ms=100)
+        queue.put_audio(self.frame(b"1111"), queued_at=0)
+        queue.put_audio(self.frame(b"2222"), queued_at=1)
+        queue.drop_audio_head()
+
+        self.assertEqual(queue.stats()["dropped_frames"], 1)
+        self.assertEqual(self.audio_lane(queue), [b"2222"])
+
+
+class InboundAudioBufferTests(SimpleTestCase):
+    def test_reads_wrap_around_the_end_of_the_ring(self):
+        buffer = InboundAudioBuffer(capacity_bytes=8, bytes_per_second=1000)
+        buffer.write(b"abcdef", now=1)
+        self.assertEqual(buffer.pending_since, 1)
+        self.assertEqual(bytes(buffer.read(4)), b"abcd")
+
+        buffer.write(b"ghij", now=2)
+        self.assertEqual(bytes(buffer.buffer), b"ijcdefgh")
+        self.assertEqual(bytes(buffer.read(100)), b"efghij")
+        self.assertIsNone(buffer.pending_since)
+        self.assertEqual(bytes(buffer.read(100)), b"")
+        self.assertEqual(buffer.dropped_bytes, 0)
+
+    def test_overflow_drops_the_oldest_whole_samples(self):
+        buffer = InboundAudioBuffer(capacity_bytes=9, bytes_per_second=1000)
+        self.assertEqual(buffer.capacity, 8)
+        buffer.write(b"12345678", now=1)
+        buffer.write(b"abc", now=2)
+
+        # Three bytes over, rounded up to two samples
+        self.assertEqual(buffer.dropped_bytes, 4)
+        self.assertEqual(bytes(buffer.read(100)), b"5678abc")
+
+    def test_writes_larger_than_the_ring_keep_their_newest_audio(self):
+        buffer = InboundAudioBuffer(capacity_bytes=8, bytes_per_second=1000)
+        buffer.write(b"xx", now=1)
+        buffer.write(b"0123456789", now=2)
+
+        self.assertEqual(bytes(buffer.read(100)), b"23456789")
+        self.assertEqual(
+            buffer.stats(), {"buffered_ms": 0, "received_ms": 12, "dropped_ms": 4}
+        )
+
+
+def sine(rate, seconds, delay=0.0, frequency=440, level=8000):
+    """A sine tone as PCM16 samples, delayed by delay input samples"""
+    t = (np.arange(int(rate * seconds)) - delay) / rate
+    return np.rint(level * np.sin(2 * np.pi * frequency * t)).astype(np.int16)
+
+
+class AudioResamplerTests(SimpleTestCase):
+    def test_output_length_and_phase_at_8k_and_24k(self):
+        for src_rate, dst_rate in ((8000, 24000), (24000, 8000)):
+            with self.subTest(src_rate=src_rate, dst_rate=dst_rate):
+                resampler = AudioResampler(src_rate, dst_rate)
+                out = np.frombuffer(
+                    resampler.process(sine(src_rate, 0.1).tobytes()), np.int16
+                )
+                self.assertEqual(len(out), dst_rate // 10)
+
+                # The filter delays its input by half its length
+                up = resampler.up
+                delay = (up * RESAMPLER_TAPS - 1) / 2 / up * dst_rate / src_rate
+                expected = sine(dst_rate, 0.1, delay)
+                settled = slice(RESAMPLER_TAPS * max(up, resampler.down), None)
+                error = np.abs(out[settled].astype(int) - expected[settled])
+                self.assertLessEqual(error.max(), 2)
+
+    def test_chunks_convert_the_same_as_the_whole(self):
+        audio = sine(8000, 0.1).tobytes()
+        whole = AudioResampler(8000, 24000).process(audio)
+
+        resampler = AudioResampler(8000, 24000)
+        chunks = []
+        offset = 0
+        # Odd sizes split samples across chunks
+        for size in (7, 300, 1, 1001, 64) * 10:
+            chunks.append(resampler.process(audio[offset : offset + size]))
+            offset += size
+        self.assertEqual(b"".join(chunks), whole)
+
+    def test_stereo_is_downmixed_and_matching_rates_pass_through(self):
+        mono = sine(24000, 0.01)
+        stereo = np.repeat(mono, 2)
+        self.assertEqual(
+            AudioResampler(24000, 24000, channels=2).process(stereo.tobytes()),
+            mono.tobytes(),
+        )
+
+        audio = mono.tobytes()
+        self.assertIs(AudioResampler(24000, 24000).process(audio), audio)
+
+
+class G711Tests(SimpleTestCase):
+    pcm = np.array(
+        [0, 1, -1, 100, -100, 1000, -1000, 8000, -8000, 32767, -32768], np.int16
+    )
+    # Codes and decoded samples from the ITU G.711 reference implementation
+    reference = {
+        "g711_ulaw": (
+            "ffff7ef272ce4ea0208000",
+            [0, 0, -8, 104, -104, 988, -988, 7932, -7932, 32124, -32124],
+        ),
+        "g711_alaw": (
+            "d5d555d353fa7a8a0aaa2a",
+            [8, 8, -8, 104, -104, 1008, -1008, 8064, -8064, 32256, -32256],
+        ),
+    }
+
+    def test_encode_and_decode_match_the_reference(self):
+        for audio_format, (codes, decoded) in self.reference.items():
+            with self.subTest(audio_format=audio_format):
+                encoded = g711_encode(self.pcm.tobytes(), audio_format)
+                self.assertEqual(encoded.hex(), codes)
+                self.assertEqual(
+                    np.frombuffer(
+                        g711_decode(encoded, audio_format), np.int16
+                    ).tolist(),
+                    decoded,
+                )
+
+    def test_every_code_round_trips(self):
+        codes = bytes(range(256))
+        for audio_format in self.reference:
+            with self.subTest(audio_format=audio_format):
+                round_trip = g711_encode(g711_decode(codes, audio_format), audio_format)
+                differing = [
+                    (code, again)
+                    for code, again in zip(codes, round_trip)
+                    if code != again
+                ]
+                # Mu-law has two zeros; negative zero encodes as positive
+                expected = [(0x7F, 0xFF)] if audio_format == "g711_ulaw" else []
+                self.assertEqual(differing, expected)
+
+    def test_unknown_formats_are_rejected(self):
+        with self.assertRaisesMessage(ValueError, "Not a G.711 format"):
+            g711_encode(b"\x00\x00", "pcm16")
+
+
+class EnergyVADTests(SimpleTestCase):
+    # 20ms frames of 24kHz PCM16
+    frame_bytes = 960
+
+    def setUp(self):
+        self.vad = EnergyVAD(hangover_ms=40, preroll_ms=60)
+
+    def silence(self, frames):
+        return bytes(self.frame_bytes * frames)
+
+    def speech(self, frames):
+        return sine(24000, 0.02 * frames).tobytes()
+
+    def test_speech_is_forwarded_with_its_preroll_and_hangover(self):
+        self.assertEqual(len(self.vad.process(self.silence(5))), 0)
+
+        out = self.vad.process(self.speech(1))
+        # The last three silent frames go out ahead of the speech
+        self.assertEqual(len(out), 4 * self.frame_bytes)
+        self.assertEqual(bytes(out[: 3 * self.frame_bytes]), self.silence(3))
+
+        out = self.vad.process(self.speech(2))
+        # Mid-utterance audio is passed on without copying
+        self.assertIsInstance(out, memoryview)
+        self.assertEqual(len(out), 2 * self.frame_bytes)
+
+        out = self.vad.process(self.silence(3))
+        self.assertEqual(len(out), 2 * self.frame_bytes)
+        self.assertFalse(self.vad.active)
+        self.assertEqual(self.vad.stats(), {"forwarded_ms": 160, "suppressed_ms": 60})
+
+    def test_partial_frames_wait_for_the_rest(self):
+        audio = self.speech(1)
+        self.assertEqual(len(self.vad.process(audio[:500])), 0)
+        self.assertEqual(bytes(self.vad.process(audio[500:])), audio)
+
+    def test_loud_noise_is_not_speech(self):
+        noise = np.random.default_rng(0).normal(0, 8000, 480 * 4)
+        noise = np.clip(noise, -32768, 32767).astype(np.int16)
+        self.assertEqual(len(self.vad.process(noise.tobytes())), 0)
+
+    def test_configuration(self):
+        self.assertIsNone(EnergyVAD.from_config(None))
+        self.assertIsNone(EnergyVAD.from_config({"threshold_db": -30}))
+
+        vad = EnergyVAD.from_config(
+            {"enabled": True, "hangover_ms": "400"}, audio_format="g711_ulaw"
+        )
+        self.assertEqual((vad.hangover_frames, vad.frame_bytes), (20, 160))
+
+        with self.assertLogs("prepaiapp.audio", "ERROR"):
+            self.assertIsNone(EnergyVAD.from_config({"enabled": True, "frame_ms": 0}))
+
+
+class LatencyHistogramTests(SimpleTestCase):
+    def test_quantiles_are_bucket_upper_bounds(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        for ms in [5] * 50 + [80] * 40 + [400] * 9 + [40000]:
+            histogram.observe(ms)
+
+        self.assertEqual(histogram.percentile(0.5), 10)
+        self.assertEqual(histogram.percentile(0.9), 100)
+        self.assertEqual(histogram.percentile(0.99), 500)
+        # Past the last bucket only the maximum is known
+        self.assertEqual(histogram.percentile(1), 40000)
+
+        stats = histogram.as_dict()
+        self.assertEqual((stats["count"], stats["min_ms"]), (100, 5))
+        self.assertEqual(stats["avg_ms"], 470.5)
+        self.assertEqual(
+            (stats["buckets"]["le_10"], stats["buckets"]["le_100"]), (50, 40)
+        )
+        self.assertEqual(stats["buckets"]["inf"], 1)
+
+    def test_quantiles_never_exceed_the_maximum(self):
+        histogram = LatencyHistogram()
+        histogram.observe(120)
+        histogram.observe(130)
+        self.assertEqual(histogram.percentile(0.5), 130)
+
+
+class FakeRealtimeModel:
+    def __init__(self):
+        self.events = []
+
+    async def send_event(self, event):
+        self.events.append(event)
+
+
+class FakeRealtimeSession:
+    """Realtime session that takes a while to connect and then stays idle"""
+
+    connect_delay = 0.2
+
+    def __init__(self):
+        self.model = FakeRealtimeModel()
+        self.agent = None
+        self.closed = asyncio.Event()
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.connect_delay)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed.set()
+
+    async def update_agent(self, agent):
+        self.agent = agent
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self.closed.wait()
+        raise StopAsyncIteration
+
+
+class FakeRealtimeRunner:
+    sessions = []
+
+    def __init__(self, agent, model=None):
+        self.agent = agent
+
+    async def run(self, model_config=None):
+        session = FakeRealtimeSession()
+        self.sessions.append(session)
+        return session
+
+
+class RoleplayConnectTests(TransactionTestCase):
+    connections = 101
+    # Longest any single callback may hold the event loop
+    max_blocking_ms = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user("roleplayer", password="x")
+        self.bot = RolePlayBots.objects.create(
+            name="Coach", system_prompt="You are a coach.", voice="coral"
+        )
+        self.sessions = [
+            RoleplaySession.objects.create(
+                user=self.user,
+                bot=self.bot,
+                status="in_progress",
+                started_at=timezone.now(),
+            )
+            for _ in range(self.connections)
+        ]
+        FakeRealtimeRunner.sessions = []
+
+    async def receive_until(self, communicator, message_type):
+        messages = []
+        while not messages or messages[-1]["type"] != message_type:
+            messages.append(await communicator.receive_json_from(timeout=10))
+        return messages
+
+    async def open_connection(self, session):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/roleplay/{session.id}/"
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        messages = await self.receive_until(communicator, "session_ready")
+        return communicator, [message.get("stage") for message in messages]
+
+    def track_loop_blocking(self):
+        """Patch the event loop to record its longest single callback in ms"""
+        run = asyncio.Handle._run
+        longest = [0.0]
+
+        def timed_run(handle):
+            start = time.perf_counter()
+            run(handle)
+            longest[0] = max(longest[0], (time.perf_counter() - start) * 1000)
+
+        return mock.patch.object(asyncio.Handle, "_run", timed_run), longest
+
+    @mock.patch("prepaiapp.consumers.RealtimeRunner", FakeRealtimeRunner)
+    async def test_concurrent_connects_do_not_block_event_loop(self):
+        # Leave one-off costs such as the first DB connection out of it
+        communicator, _ = await self.open_connection(self.sessions[0])
+        await communicator.disconnect()
+
+        patch, longest_callback_ms = self.track_loop_blocking()
+        with patch:
+            results = await asyncio.gather(
+                *(self.open_connection(session) for session in self.sessions[1:])
+            )
+
+        for communicator, stages in results:
+            self.assertEqual(stages[0], "accepted")
+            self.assertIn("context_loaded", stages)
+            await communicator.disconnect()
+
+        self.assertLess(longest_callback_ms[0], self.max_blocking_ms)
+        self.assertEqual(len(FakeRealtimeRunner.sessions), self.connections)
+        for session in FakeRealtimeRunner.sessions:
+            # The bot and its voice replace the placeholder agent before audio
+            self.assertEqual(session.agent.name, "Coach")
+            self.assertEqual(session.model.events[0].session_settings["voice"], "coral")
+
+
+class HandoffTokenTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("roleplayer", password="x")
+        creator = User.objects.create_user("creator", password="x")
+        self.bot = RolePlayBots.objects.create(
+            name="Coach",
+            system_prompt="You are a coach.",
+            voice="coral",
+            created_by=creator,
+        )
+        self.session = RoleplaySession.objects.create(
+            user=self.user,
+            bot=self.bot,
+            status="in_progress",
+            started_at=timezone.now(),
+        )
+        FakeRealtimeRunner.sessions = []
+
+    async def connect(self, token):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f"/ws/roleplay/{self.session.id}/?handoff={token}",
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        while (await communicator.receive_json_from(timeout=10))[
+            "type"
+        ] != "session_ready":
+            pass
+        await communicator.disconnect()
+        return FakeRealtimeRunner.sessions[-1]
+
+    @mock.patch("prepaiapp.consumers.RealtimeRunner", FakeRealtimeRunner)
+    async def test_valid_token_starts_session_without_loading_context(self):
+        token = await database_sync_to_async(mint_handoff_token)(self.session)
+        with mock.patch.object(RoleplayConsumer, "load_roleplay_context") as load:
+            session = await self.connect(token)
+
+        load.assert_not_called()
+        self.assertEqual(session.agent.name, "Coach")
+        self.assertEqual(session.agent.instructions, "You are a coach.")
+        self.assertEqual(session.model.events[0].session_settings["voice"], "coral")
+
+    @mock.patch("prepaiapp.consumers.RealtimeRunner", FakeRealtimeRunner)
+    async def test_tampered_token_falls_back_to_loading_context(self):
+        token = await database_sync_to_async(mint_handoff_token)(self.session)
+        with self.assertLogs("prepaiapp.consumers", "WARNING") as logs:
+            session = await self.connect(token[:-2] + "xx")
+
+        self.assertIn("Invalid handoff token", logs.output[0])
+        # Loaded from the DB instead
+        self.assertEqual(session.agent.name, "Coach")
+
+    @mock.patch("prepaiapp.consumers.RealtimeRunner", FakeRealtimeRunner)
+    async def test_token_does_not_serve_a_bot_deactivated_since_minting(self):
+        token = await database_sync_to_async(mint_handoff_token)(self.session)
+        await database_sync_to_async(
+            RolePlayBots.objects.filter(id=self.bot.id).update
+        )(is_active=False)
+
+        await self.refused(token)
+        # Never configured as the bot
+        self.assertNotIn(
+            "Coach",
+            [
+                getattr(session.agent, "name", None)
+                for session in FakeRealtimeRunner.sessions
+            ],
+        )
+
+    @mock.patch("prepaiapp.consumers.RealtimeRunner", FakeRealtimeRunner)
+    async def test_token_cannot_start_a_settled_or_claimed_session_again(self):
+        await database_sync_to_async(Profile.objects.create)(
+            user=self.user, credits=999
+        )
+        token = await database_sync_to_async(mint_handoff_token)(self.session)
+        await self.connect(token)
+        await database_sync_to_async(self.session.refresh_from_db)()
+        self.assertIsNotNone(self.session.settled_at)
+        # Closed along with settlement, though nothing was said
+        self.assertEqual(self.session.status, "disconnected")
+
+        # Replaying the token after settlement
+        with self.assertLogs("prepaiapp.consumers", "WARNING") as logs:
+            await self.refused(token)
+        self.assertIn("settled or live elsewhere", logs.output[0])
+
+        # Or while another consumer holds an open session
+        other = await database_sync_to_async(RoleplaySession.objects.create)(
+            user=self.user,
+            bot=self.bot,
+            status="in_progress",
+            started_at=timezone.now(),
+            claimed_by="specific.other",
+        )
+        self.session = other
+        token = await database_sync_to_async(mint_handoff_token)(other)
+        with self.assertLogs("prepaiapp.consumers", "WARNING"):
+            await self.refused(token)
+
+    async def refused(self, token):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f"/ws/roleplay/{self.session.id}/?handoff={token}",
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        # Closed without the session ever becoming ready
+        while True:
+            output = await communicator.receive_output(timeout=10)
+            if output["type"] == "websocket.close":
+                break
+            self.assertNotIn("session_ready", output.get("text", ""))
+        await communicator.wait()
+
+
+class CreditsTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("buyer", password="x")
+        Profile.objects.create(user=self.user, credits=100)
+
+    def balance(self):
+        return Profile.objects.get(user=self.user).credits
+
+    def test_deduct_only_when_balance_covers_it(self):
+        self.assertTrue(deduct_credits(self.user.id, 60, "session_charge"))
+        self.assertFalse(deduct_credits(self.user.id, 60, "session_charge"))
+        self.assertEqual(self.balance(), 40)
+        self.assertTrue(add_credits(self.user.id, 20, "purchase", "pay_1"))
+        self.assertEqual(self.balance(), 60)
+        # Only the changes that happened are on the ledger
+        self.assertEqual(
+            sorted(
+                CreditLedgerEntry.objects.values_list("kind", "amount", "reference")
+            ),
+            [("purchase", 20, "pay_1"), ("session_charge", -60, "")],
+        )
+
+    def test_concurrent_deductions_never_lose_updates_or_overdraw(self):
+        def deduct_repeatedly(_):
+            try:
+                return [
+                    deduct_credits(self.user.id, 10, "session_charge") for _ in range(5)
+                ]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = sum(pool.map(deduct_repeatedly, range(8)), [])
+
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(CreditLedgerEntry.objects.count(), 10)
+
+    def drain(self):
+        """Spend the balance elsewhere, as a concurrent request would"""
+        Profile.objects.filter(user=self.user).update(credits=0)
+
+    def test_sessions_do_not_start_when_the_balance_drops_after_the_check(self):
+        bot = RolePlayBots.objects.create(
+            name="Coach",
+            system_prompt="You are a coach.",
+            created_by=self.user,
+            custom_configuration={},
+        )
+        template = InterviewTemplate.objects.create(
+            title="Backend",
+            description="Backend interview",
+            role_type="software_engineer",
+            system_prompt="You are an interviewer.",
+        )
+
+        def get_balance_then_drain(user_id):
+            balance = get_balance(user_id)
+            self.drain()
+            return balance
+
+        def has_credit_then_drain(profile, required=10):
+            self.drain()
+            return True
+
+        self.client.force_login(self.user)
+        with mock.patch("prepaiapp.views.get_balance", get_balance_then_drain):
+            response = self.client.get(
+                reverse("start_roleplay", kwargs={"bot_id": bot.id})
+            )
+        self.assertRedirects(
+            response, reverse("purchase_credits"), fetch_redirect_response=False
+        )
+        with mock.patch.object(Profile, "has_credit", has_credit_then_drain):
+            response = self.client.get(
+                reverse("start_interview", kwargs={"template_id": template.id})
+            )
+        self.assertRedirects(
+            response, reverse("purchase_credits"), fetch_redirect_response=False
+        )
+
+        self.assertFalse(RoleplaySession.objects.exists())
+        self.assertFalse(InterviewSession.objects.exists())
+        self.assertFalse(CreditLedgerEntry.objects.exists())
+
+    def test_ledger_entries_are_append_only(self):
+        add_credits(self.user.id, 5, "grant")
+        entry = CreditLedgerEntry.objects.get()
+        entry.amount = 500
+        with self.assertRaises(ValueError):
+            entry.save()
+        with self.assertRaises(ValueError):
+            entry.delete()
+
+    def test_reconcile_opens_legacy_balances_and_fixes_drift(self):
+        users = [self.user] + [
+            User.objects.create_user(f"user{i}", password="x") for i in range(4)
+        ]
+        for user in users[1:]:
+            Profile.objects.create(user=user, credits=30)
+        # Balances predating the ledger get an opening entry
+        call_command(
+            "reconcile_credits", "--open", "--chunk-size", 2, stdout=StringIO()
+        )
+        self.assertEqual(
+            CreditLedgerEntry.objects.filter(kind="opening_balance").count(), 5
+        )
+
+        add_credits(users[1].id, 10, "grant")
+        # Drift: a balance changed without an entry
+        Profile.objects.filter(user=users[2]).update(credits=999)
+        out = StringIO()
+        call_command("reconcile_credits", "--chunk-size", 2, stdout=out)
+        self.assertIn("1 drifted", out.getvalue())
+        self.assertEqual(Profile.objects.get(user=users[2]).credits, 999)
+
+        call_command("reconcile_credits", "--fix", "--chunk-size", 2, stdout=out)
+        self.assertEqual(Profile.objects.get(user=users[2]).credits, 30)
+        self.assertEqual(Profile.objects.get(user=users[1]).credits, 40)
+
+    def test_fix_leaves_profiles_without_an_opening_balance(self):
+        legacy = User.objects.create_user("legacy", password="x")
+        Profile.objects.create(user=legacy, credits=50)
+        add_credits(legacy.id, 10, "grant")
+
+        # Its ledger only has the grant: --fix alone must not reset it to 10
+        out = StringIO()
+        call_command("reconcile_credits", "--fix", stdout=out)
+        self.assertIn(
+            f"User {legacy.id}: balance 60, ledger 10 without an opening balance",
+            out.getvalue(),
+        )
+        self.assertEqual(Profile.objects.get(user=legacy).credits, 60)
+
+        call_command("reconcile_credits", "--fix", "--open", stdout=StringIO())
+        self.assertEqual(Profile.objects.get(user=legacy).credits, 60)
+        self.assertEqual(
+            CreditLedgerEntry.objects.get(user=legacy, kind="opening_balance").amount,
+            50,
+        )
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(
+            settings.CREDIT_BALANCE_CACHE_URL, socket_connect_timeout=0.2
+        ).ping()
+    except redis.RedisError:
+        return False
+
+
+class BalanceCacheContract:
+    user_id = 987654321
+
+    def tearDown(self):
+        self.balances.forget(self.user_id)
+
+    def test_changes_are_guarded_and_never_rebuild_a_balance(self):
+        # Nothing cached: deltas are dropped rather than applied to zero
+        self.assertIsNone(self.balances.take(self.user_id, 5))
+        self.assertIsNone(self.balances.add(self.user_id, 5))
+        self.assertIsNone(self.balances.get(self.user_id))
+
+        generation = self.balances.generation(self.user_id)
+        self.balances.fill(self.user_id, 10, generation)
+        # A balance cached already is not overwritten by a later read
+        self.balances.fill(self.user_id, 99, generation)
+        self.assertEqual(self.balances.get(self.user_id), 10)
+
+        self.assertEqual(self.balances.take(self.user_id, 4), 6)
+        self.assertEqual(self.balances.take(self.user_id, 7), INSUFFICIENT)
+        self.assertEqual(self.balances.add(self.user_id, 4), 10)
+        self.balances.forget(self.user_id)
+        self.assertIsNone(self.balances.get(self.user_id))
+
+    def test_a_balance_read_before_a_change_is_not_cached_after_it(self):
+        # A reader misses and notes the generation before reading Postgres
+        generation = self.balances.generation(self.user_id)
+        # A deduction commits; nothing is cached for it to change
+        self.assertIsNone(self.balances.take(self.user_id, 30))
+        # The reader's balance predates the deduction
+        self.balances.fill(self.user_id, 100, generation)
+        self.assertIsNone(self.balances.get(self.user_id))
+
+        self.balances.fill(self.user_id, 70, self.balances.generation(self.user_id))
+        self.assertEqual(self.balances.get(self.user_id), 70)
+
+
+class LocalBalanceCacheTests(BalanceCacheContract, SimpleTestCase):
+    def setUp(self):
+        self.balances = LocalBalanceCache(ttl=60)
+
+
+@skipUnless(redis_available(), "no Redis at CREDIT_BALANCE_CACHE_URL")
+class RedisBalanceCacheTests(BalanceCacheContract, SimpleTestCase):
+    def setUp(self):
+        self.balances = RedisBalanceCache(settings.CREDIT_BALANCE_CACHE_URL, ttl=60)
+
+
+@override_settings(CREDIT_BALANCE_CACHE="local")
+class CachedBalanceTests(TransactionTestCase):
+    def setUp(self):
+        balances._caches.clear()
+        self.user = User.objects.create_user("cached", password="x")
+        Profile.objects.create(user=self.user, credits=100)
+
+    def test_balance_is_read_once_and_follows_committed_changes(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_balance(self.user.id), 100)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_balance(self.user.id), 100)
+
+        deduct_credits(self.user.id, 30, "session_charge")
+        add_credits(self.user.id, 5, "purchase")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_balance(self.user.id), 75)
+
+        with transaction.atomic():
+            deduct_credits(self.user.id, 10, "session_charge")
+            transaction.set_rollback(True)
+        self.assertEqual(get_balance(self.user.id), 75)
+
+    def test_deduction_committed_while_a_miss_reads_the_database(self):
+        balance_cache = get_balance_cache()
+        fill = balance_cache.fill
+
+        def deduct_then_fill(*args):
+            deduct_credits(self.user.id, 30, "session_charge")
+            fill(*args)
+
+        with mock.patch.object(balance_cache, "fill", deduct_then_fill):
+            self.assertEqual(get_balance(self.user.id), 100)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_balance(self.user.id), 70)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_balance(self.user.id), 70)
+
+    def test_stale_balance_that_cannot_cover_a_deduction_is_dropped(self):
+        get_balance(self.user.id)
+        get_balance_cache().take(self.user.id, 95)
+
+        deduct_credits(self.user.id, 50, "session_charge")
+        with self.assertNumQueries(1):
+            self.assertEqual(get_balance(self.user.id), 50)
+
+
+class BillingTickerTests(TransactionTestCase):
+    rates = {"per_minute": 10, "creator": 3, "sharer": 0}
+
+    def setUp(self):
+        self.creator = User.objects.create_user("creator", password="x")
+        self.bot = RolePlayBots.objects.create(
+            name="Coach", system_prompt="You are a coach.", created_by=self.creator
+        )
+
+    def billable(self, credits, channel_name="unused", started_ago=0):
+        user = User.objects.create_user(f"user{credits}", password="x")
+        Profile.objects.create(user=user, credits=credits)
+        session = RoleplaySession.objects.create(
+            bot=self.bot,
+            user=user,
+            status="in_progress",
+            started_at=timezone.now() - timedelta(seconds=started_ago),
+            claimed_by=channel_name,
+        )
+        return BillableSession(
+            channel_name,
+            user.id,
+            self.bot.id,
+            self.rates,
+            creator_id=self.creator.id,
+            session_id=session.id,
+            budget=credits,
+        )
+
+    def state(self, billable, seconds):
+        return {**billable.state(), "seconds": seconds}
+
+    def test_settles_metered_seconds_once(self):
+        billable = self.billable(100)
+
+        self.assertEqual(settle_session(self.state(billable, 90)), 15)
+        self.assertIsNone(settle_session(self.state(billable, 90)))
+
+        self.assertEqual(Profile.objects.get(user_id=billable.user_id).credits, 85)
+        session = RoleplaySession.objects.get(id=billable.session_id)
+        self.assertEqual((session.billed_seconds, session.credits_used), (90, 15))
+        self.assertIsNotNone(session.settled_at)
+        share = CreditShare.objects.get()
+        self.assertEqual((share.credited_to, share.credit), (self.creator, 4))
+        self.assertEqual(
+            list(CreditLedgerEntry.objects.values_list("amount", "kind", "reference")),
+            [(-15, "session_charge", str(billable.session_id))],
+        )
+
+    def test_settlement_takes_no_more_than_the_balance(self):
+        billable = self.billable(5)
+        self.assertEqual(settle_session(self.state(billable, 600)), 5)
+        self.assertEqual(Profile.objects.get(user_id=billable.user_id).credits, 0)
+
+    async def test_ticker_cuts_off_sessions_out_of_budget(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        rich = await database_sync_to_async(self.billable)(25)
+        poor = await database_sync_to_async(self.billable)(1, channel_name)
+        ticker = BillingTicker(tick=0.05, checkpoint_interval=60)
+        try:
+            ticker.register(rich)
+            await asyncio.sleep(0.2)
+            ticker.register(poor)
+            message = await asyncio.wait_for(channel_layer.receive(channel_name), 5)
+            checkpoint = await cache.aget(meter_cache_key(poor.session_id))
+        finally:
+            await ticker.stop()
+            await cache.aclear()
+
+        self.assertEqual(message, {"type": "billing.insufficient"})
+        # A second's worth of a 10 credit minute, rounded up
+        self.assertEqual(poor.seconds(), 1)
+        self.assertEqual(poor.accrued(), 1)
+        self.assertNotIn(poor, ticker.sessions)
+        self.assertIn(rich, ticker.sessions)
+        # Checkpointed on its first tick, without waiting out the interval
+        self.assertEqual(checkpoint["session"], str(poor.session_id))
+        self.assertEqual(ticker.checkpoints, 2)
+
+    async def test_ticker_ends_sessions_at_the_maximum_length(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        billable = await database_sync_to_async(self.billable)(1000, channel_name)
+        ticker = BillingTicker(tick=0.05, checkpoint_interval=60, max_seconds=1)
+        try:
+            ticker.register(billable)
+            message = await asyncio.wait_for(channel_layer.receive(channel_name), 5)
+        finally:
+            await ticker.stop()
+            await cache.aclear()
+
+        self.assertEqual(message, {"type": "billing.expired"})
+        self.assertEqual(billable.seconds(), 1)
+        self.assertNotIn(billable, ticker.sessions)
+
+    def test_sweep_settles_abandoned_sessions(self):
+        abandoned = self.billable(100, started_ago=600)
+        live = self.billable(50, started_ago=600)
+        never_metered = self.billable(20, started_ago=4000)
+        # Could still be live in a process whose checkpoint is missing
+        unmetered = self.billable(30, started_ago=600)
+        cache.set_many(
+            {
+                meter_cache_key(abandoned.session_id): {
+                    **self.state(abandoned, 120),
+                    "checkpointed_at": time.time() - 300,
+                },
+                meter_cache_key(live.session_id): self.state(live, 120),
+            }
+        )
+        try:
+            self.assertEqual(
+                sweep_unsettled_sessions(stale_after=120, max_session=3600), (1, 1)
+            )
+        finally:
+            cache.clear()
+
+        sessions = RoleplaySession.objects.in_bulk(
+            [
+                abandoned.session_id,
+                live.session_id,
+                never_metered.session_id,
+                unmetered.session_id,
+            ]
+        )
+        self.assertEqual(sessions[abandoned.session_id].credits_used, 20)
+        self.assertEqual(sessions[abandoned.session_id].status, "disconnected")
+        self.assertIsNone(sessions[live.session_id].settled_at)
+        self.assertIsNotNone(sessions[never_metered.session_id].settled_at)
+        self.assertEqual(sessions[never_metered.session_id].credits_used, 0)
+        self.assertEqual(sessions[never_metered.session_id].status, "disconnected")
+        self.assertIsNone(sessions[unmetered.session_id].settled_at)
+
+    def test_sweep_refuses_to_run_without_a_shared_cache(self):
+        never_metered = self.billable(20, started_ago=100000)
+        with self.assertRaisesMessage(CommandError, "REDIS_URL"):
+            call_command("settle_roleplay_meters", stdout=StringIO())
+        session = RoleplaySession.objects.get(id=never_metered.session_id)
+        self.assertIsNone(session.settled_at)
+
+    def test_settled_session_is_closed_and_not_resumed(self):
+        billable = self.billable(100)
+        self.assertEqual(settle_session(self.state(billable, 60), "completed"), 10)
+        session = RoleplaySession.objects.get(id=billable.session_id)
+        self.assertEqual(session.status, "completed")
+
+        # Even if something left it in progress, starting the bot again
+        # makes a new session rather than sending the user back to it
+        RoleplaySession.objects.filter(id=session.id).update(status="in_progress")
+        RolePlayBots.objects.filter(id=self.bot.id).update(custom_configuration={})
+        self.client.force_login(session.user)
+        response = self.client.get(
+            reverse("start_roleplay", kwargs={"bot_id": self.bot.id})
+        )
+        new_session = RoleplaySession.objects.exclude(id=session.id).get(
+            user=session.user
+        )
+        self.assertRedirects(
+            response,
+            reverse("roleplay_session", kwargs={"session_id": new_session.id}),
+            fetch_redirect_response=False,
+        )
+
+
+class TranscriptIngestorTests(SimpleTestCase):
+    def make_turn(self, item_id, role, text):
+        self.formatted += 1
+        return {"item_id": item_id, "content": text, "timestamp": self.formatted}
+
+    def setUp(self):
+        self.formatted = 0
+        self.store = TranscriptStore()
+        self.ingestor = TranscriptIngestor(self.store, self.make_turn)
+
+    def updated(self, item):
+        return self.ingestor.ingest(RealtimeModelItemUpdatedEvent(item=item))
+
+    def test_late_user_transcript_keeps_its_place(self):
+        self.assertFalse(
+            self.updated(UserMessageItem(item_id="user", content=[InputAudio()]))
+        )
+        self.assertFalse(
+            self.updated(
+                AssistantMessageItem(
+                    item_id="reply", status="in_progress", content=[AssistantAudio()]
+                )
+            )
+        )
+        self.assertTrue(
+            self.updated(
+                AssistantMessageItem(
+                    item_id="reply",
+                    status="completed",
+                    content=[AssistantAudio(transcript="Hello there.")],
+                )
+            )
+        )
+        self.assertTrue(
+            self.ingestor.ingest(
+                RealtimeModelInputAudioTranscriptionCompletedEvent(
+                    item_id="user", transcript="Hi."
+                )
+            )
+        )
+        self.assertEqual(
+            [turn["content"] for turn in self.store], ["Hi.", "Hello there."]
+        )
+
+    def test_reply_falls_back_to_its_transcript_deltas(self):
+        for delta in ["Good ", "morning."]:
+            self.ingestor.ingest(
+                RealtimeModelTranscriptDeltaEvent(
+                    item_id="reply", delta=delta, response_id="response"
+                )
+            )
+        self.updated(
+            AssistantMessageItem(
+                item_id="reply", status="completed", content=[AssistantAudio()]
+            )
+        )
+        self.assertEqual(self.store.get("reply")["content"], "Good morning.")
+        self.assertEqual(self.ingestor.deltas, {})
+
+    def test_unchanged_item_is_not_formatted_again_and_deleted_item_is_dropped(self):
+        reply = AssistantMessageItem(
+            item_id="reply",
+            status="completed",
+            content=[AssistantAudio(transcript="Done.")],
+        )
+        self.assertTrue(self.updated(reply))
+        self.assertFalse(self.updated(reply))
+        self.assertEqual(self.formatted, 1)
+
+        self.assertTrue(
+            self.ingestor.ingest(RealtimeModelItemDeletedEvent(item_id="reply"))
+        )
+        self.assertEqual(len(self.store), 0)
+
+    def test_reconcile_folds_in_what_the_events_missed(self):
+        self.updated(
+            UserMessageItem(item_id="user", content=[InputAudio(transcript="Hi.")])
+        )
+        first_timestamp = self.store.get("user")["timestamp"]
+        history = [
+            UserMessageItem(item_id="user", content=[InputAudio(transcript="Hi!")]),
+            AssistantMessageItem(
+                item_id="reply",
+                status="completed",
+                content=[AssistantAudio(transcript="Hello.")],
+            ),
+        ]
+        self.assertTrue(self.ingestor.reconcile(history))
+        self.assertEqual([turn["content"] for turn in self.store], ["Hi!", "Hello."])
+        # A corrected turn keeps the time it was first heard
+        self.assertEqual(self.store.get("user")["timestamp"], first_timestamp)
+        self.assertFalse(self.ingestor.reconcile(history))
+
+
+class TranscriptCheckpointerTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user("learner", password="x")
+        self.bot = RolePlayBots.objects.create(
+            name="Coach", description="Small talk", system_prompt="", created_by=user
+        )
+        self.session = RoleplaySession.objects.create(
+            bot=self.bot, user=user, status="in_progress", started_at=timezone.now()
+        )
+
+    def segment_count(self):
+        return TranscriptSegment.objects.filter(session=self.session).count()
+
+    async def test_full_batch_is_written_at_once_and_the_rest_on_flush(self):
+        checkpointer = TranscriptCheckpointer(interval=60, batch_size=2)
+        count = database_sync_to_async(self.segment_count)
+        try:
+            checkpointer.append(self.session.id, 0, "user", "user", "Hi.")
+            await asyncio.sleep(0.05)
+            # Waiting out the interval for the batch to fill
+            self.assertEqual(await count(), 0)
+
+            checkpointer.append(self.session.id, 1, "reply", "assistant", "Hello.")
+            deadline = time.monotonic() + 2
+            while await count() < 2:
+                self.assertLess(time.monotonic(), deadline, "timed out")
+                await asyncio.sleep(0.01)
+
+            checkpointer.append(self.session.id, 0, "user", "user", "Hi there.")
+            checkpointer.append(self.session.id, 2, "late", "assistant", "Oops.")
+            checkpointer.append(self.session.id, 2, "late", "assistant", "")
+            self.assertTrue(await checkpointer.flush())
+            self.assertEqual(await count(), 5)
+            self.assertEqual(
+                checkpointer.stats(),
+                {"pending": 0, "flushes": 3, "segments": 5, "failures": 0},
+            )
+        finally:
+            await checkpointer.stop()
+
+    def test_transcript_is_assembled_from_the_last_segment_of_each_turn(self):
+        spoken_at = timezone.now().replace(hour=10, minute=0, second=0)
+        for seq, role, text, seconds in [
+            (0, "user", "Hi.", 0),
+            (1, "assistant", "Hello.", 5),
+            (0, "user", "Hi there.", 9),
+            (2, "assistant", "Oops.", 12),
+            (2, "assistant", "", 13),
+        ]:
+            TranscriptSegment.objects.create(
+                session=self.session,
+                seq=seq,
+                role=role,
+                text=text,
+                spoken_at=spoken_at + timedelta(seconds=seconds),
+            )
+
+        lines = self.session.transcript_text().splitlines()
+        self.assertEqual(lines[0], "=== ROLEPLAY SESSION: Coach ===")
+        self.assertEqual(
+            lines[5:11],
+            ["[10:00:00] USER:", "Hi there.", "", "[10:00:05] Coach:", "Hello.", ""],
+        )
+        self.assertEqual(lines[-1], "=== END OF ROLEPLAY SESSION ===")
+
+        segment = TranscriptSegment.objects.first()
+        with self.assertRaises(ValueError):
+            segment.save()
+
+
+class InterviewTranscriptTests(SimpleTestCase):
+    def test_legacy_text_parses_into_the_turns_it_was_rendered_from(self):
+        spoken_at = timezone.now().replace(hour=14, minute=30, second=15)
+        turns = [
+            interview_turn("assistant", "Tell me about yourself.", spoken_at),
+            interview_turn(
+                "user", "I build things.", spoken_at + timedelta(seconds=30)
+            ),
+        ]
+        text = render_interview_transcript(turns)
+
+        parsed = parse_transcript_text(text)
+        self.assertEqual(
+            [(turn["role"], turn["content"]) for turn in parsed],
+            [("assistant", "Tell me about yourself."), ("user", "I build things.")],
+        )
+        self.assertEqual(
+            [turn["timestamp"] for turn in display_turns(parsed)],
+            [spoken_at.time().replace(microsecond=0), time_of_day(14, 30, 45)],
+        )
+        # Stored turns keep the full time they were spoken
+        self.assertEqual(display_turns(turns)[0]["timestamp"], spoken_at)
+        self.assertEqual(render_interview_transcript(parsed), text)
+
+
+class CompressedFieldTests(TransactionTestCase):
+    transcript = "USER:\nHow do I ask for a raise?\n\n" * 40
+
+    def setUp(self):
+        user = User.objects.create_user("learner", password="x")
+        bot = RolePlayBots.objects.create(
+            name="Coach", system_prompt="", created_by=user
+        )
+        self.session = RoleplaySession.objects.create(
+            bot=bot, user=user, status="completed", started_at=timezone.now()
+        )
+
+    def stored(self, name):
+        return (
+            RoleplaySession.objects.annotate(raw=Cast(name, models.TextField()))
+            .values_list("raw", flat=True)
+            .get(pk=self.session.pk)
+        )
+
+    def test_long_values_are_stored_compressed_and_read_back(self):
+        self.session.transcript = self.transcript
+        self.session.save()
+
+        self.assertTrue(is_compressed(self.stored("transcript")))
+        self.assertLess(len(self.stored("transcript")), len(self.transcript) // 4)
+        session = RoleplaySession.objects.get(pk=self.session.pk)
+        self.assertEqual(session.transcript, self.transcript)
+
+        # Short values are not worth compressing
+        RoleplaySession.objects.filter(pk=self.session.pk).update(transcript="Hi")
+        self.assertEqual(self.stored("transcript"), "Hi")
+
+    def test_json_columns_stay_queryable(self):
+        self.session.feedback = {"score": 80, "notes": ["Clear"] * 100}
+        self.session.save()
+        self.assertTrue(
+            RoleplaySession.objects.filter(
+                pk=self.session.pk, feedback__score=80
+            ).exists()
+        )
+
+    def test_command_compresses_rows_written_before_compression(self):
+        RoleplaySession.objects.filter(pk=self.session.pk).update(
+            transcript=Value(self.transcript, output_field=models.TextField()),
+        )
+        # Uncompressed rows read as they are
+        self.assertEqual(
+            RoleplaySession.objects.get(pk=self.session.pk).transcript, self.transcript
+        )
+
+        out = StringIO()
+        call_command("compress_session_blobs", chunk_size=1, stdout=out)
+        self.assertIn("RoleplaySession: 1 rows checked, 1 compressed", out.getvalue())
+        self.assertTrue(is_compressed(self.stored("transcript")))
+        self.assertEqual(
+            RoleplaySession.objects.get(pk=self.session.pk).transcript, self.transcript
+        )
+
+        out = StringIO()
+        call_command("compress_session_blobs", stdout=out)
+        self.assertIn("RoleplaySession: 1 rows checked, 0 compressed", out.getvalue())
+
+
+class RealtimeSessionPoolTests(SimpleTestCase):
+    async def wait_until(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            await asyncio.sleep(0.01)
+
+    @asynccontextmanager
+    async def filled_pool(self, size=2, ttl=60):
+        pool = RealtimeSessionPool(size, ttl, model_factory=LocalRealtimeModel)
+        pool.start()
+        try:
+            await self.wait_until(lambda: len(pool.idle) == size)
+            yield pool
+        finally:
+            await pool.stop()
+
+    async def test_checkout_hands_out_connected_sessions_and_refills(self):
+        async with self.filled_pool() as pool:
+            pooled = pool.checkout()
+
+            self.assertTrue(pooled.session.model.connected)
+            self.assertEqual(pool.stats()["hits"], 1)
+            self.assertEqual(pool.stats()["misses"], 0)
+            await self.wait_until(lambda: len(pool.idle) == 2)
+            self.assertNotIn(pooled, pool.idle)
+
+    async def test_checkout_misses_while_pool_is_empty(self):
+        pool = RealtimeSessionPool(1, 60, model_factory=LocalRealtimeModel)
+        try:
+            self.assertIsNone(pool.checkout())
+            self.assertEqual(pool.stats()["misses"], 1)
+            self.assertEqual(pool.stats()["hit_rate"], 0)
+        finally:
+            await pool.stop()
+
+    async def test_sessions_past_ttl_are_evicted(self):
+        async with self.filled_pool(size=1, ttl=0.2) as pool:
+            stale = pool.idle[0]
+
+            await self.wait_until(lambda: stale.closed)
+            self.assertGreaterEqual(pool.evicted, 1)
+            await self.wait_until(lambda: not stale.session.model.connected)
+            await self.wait_until(lambda: len(pool.idle) == 1)
+            self.assertLess(pool.idle[0].age(time.monotonic()), pool.ttl)
+
+    async def test_sessions_dropped_upstream_are_evicted(self):
+        async with self.filled_pool(size=1) as pool:
+            dropped = pool.idle[0]
+
+            await dropped.session.model.end_stream()
+            await self.wait_until(lambda: pool.evicted == 1)
+            self.assertTrue(dropped.closed)
+            await self.wait_until(lambda: len(pool.idle) == 1)
+            self.assertIsNot(pool.checkout(), dropped)
+
+    @override_settings(VOICE_AGENT_POOL_SIZE=1, VOICE_AGENT_REALTIME_BACKEND="local")
+    async def test_consumer_checks_out_and_reconfigures_pooled_session(self):
+        async def connect():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), "/ws/voice-agent/?codec=g711_ulaw"
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            while (await communicator.receive_json_from())["type"] != "session_ready":
+                pass
+            return communicator
+
+        # The first connection starts the pool and connects cold
+        first = await connect()
+        pool = get_session_pool()
+        try:
+            await self.wait_until(lambda: len(pool.idle) == 1)
+            model = pool.idle[0].session.model
+            self.assertEqual(model.settings["output_audio_format"], "pcm16")
+
+            second = await connect()
+            self.assertEqual(pool.stats()["hits"], 1)
+            self.assertEqual(pool.stats()["misses"], 1)
+            self.assertEqual(model.settings["input_audio_format"], "g711_ulaw")
+            self.assertEqual(model.settings["output_audio_format"], "g711_ulaw")
+            await first.disconnect()
+            await second.disconnect()
+        finally:
+            await pool.stop()
+
+
+@override_settings(VOICE_AGENT_GREETING_CACHE="local")
+class GreetingCacheTests(TransactionTestCase):
+    system_prompt = "You are a seasoned sales coach running a cold-call practice."
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        greeting_settings = override_settings(VOICE_AGENT_GREETING_DIR=directory)
+        greeting_settings.enable()
+        self.addCleanup(greeting_settings.disable)
+
+        self.user = User.objects.create_user("roleplayer", password="x")
+        self.bot = RolePlayBots.objects.create(
+            name="Coach",
+            system_prompt=self.system_prompt,
+            voice="coral",
+            created_by=self.user,
+        )
+        self.key = greeting_key(self.bot.id, "coral", self.system_prompt, "pcm16")
+        self.models = []
+
+    def create_model(self):
+        model = LocalRealtimeModel()
+        self.models.append(model)
+        return model
+
+    def raw_messages(self, model):
+        return [
+            event.message
+            for event in model.sent
+            if isinstance(event, RealtimeModelSendRawMessage)
+        ]
+
+    async def open_connection(self):
+        session = await database_sync_to_async(RoleplaySession.objects.create)(
+            user=self.user,
+            bot=self.bot,
+            status="in_progress",
+            started_at=timezone.now(),
+        )
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/roleplay/{session.id}/"
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        messages = []
+        while not messages or messages[-1]["type"] != "session_ready":
+            messages.append(await communicator.receive_json_from(timeout=10))
+        return communicator, messages
+
+    async def speak_greeting(self, model, transcript, audio):
+        item = AssistantMessageItem(
+            item_id="item_1", status="in_progress", content=[AssistantAudio()]
+        )
+        await model.emit(RealtimeModelItemUpdatedEvent(item=item))
+        for offset in range(0, len(audio), 4800):
+            await model.emit(
+                RealtimeModelAudioEvent(
+                    data=audio[offset : offset + 4800],
+                    response_id="resp_1",
+                    item_id="item_1",
+                    content_index=0,
+                )
+            )
+        await model.emit(RealtimeModelAudioDoneEvent(item_id="item_1", content_index=0))
+        item = AssistantMessageItem(
+            item_id="item_1",
+            status="completed",
+            content=[AssistantAudio(transcript=transcript)],
+        )
+        await model.emit(RealtimeModelItemUpdatedEvent(item=item))
+
+    @override_settings(VOICE_AGENT_REALTIME_BACKEND="local")
+    async def test_greeting_is_recorded_once_then_replayed_from_cache(self):
+        audio = bytes(range(256)) * 60
+        with mock.patch("prepaiapp.consumers.create_realtime_model", self.create_model):
+            first, _ = await self.open_connection()
+            # Nothing cached: the bot greets live and the greeting is kept
+            self.assertEqual(
+                self.raw_messages(self.models[0]), [{"type": "response.create"}]
+            )
+            await self.speak_greeting(self.models[0], "Hi, ready to practice?", audio)
+            store = get_greeting_store()
+            deadline = time.monotonic() + 2
+            while store.get(self.key) is None:
+                self.assertLess(time.monotonic(), deadline, "greeting not cached")
+                await asyncio.sleep(0.01)
+            await first.disconnect()
+
+            second, messages = await self.open_connection()
+            while not any(m.get("item_id") == "greeting" for m in messages):
+                messages.append(await second.receive_json_from(timeout=2))
+            await second.disconnect()
+
+        cached = store.get(self.key)
+        self.assertEqual(cached.transcript, "Hi, ready to practice?")
+        self.assertEqual(cached.audio, audio)
+        # Replayed locally; upstream is only told what was said
+        self.assertEqual(
+            self.raw_messages(self.models[1]),
+            [
+                {
+                    "type": "conversation.item.create",
+                    "other_data": {
+                        "item": {
+                            "id": "greeting",
+                            "type": "message",
+                            "role": "assistant",
+                            "content": [
+                                {"type": "output_text", "text": cached.transcript}
+                            ],
+                        }
+                    },
+                }
+            ],
+        )
+
+    def test_editing_prompt_or_voice_invalidates_cached_greeting(self):
+        store = get_greeting_store()
+        store.put(self.key, Greeting("Hello", b"\x00" * 480))
+        self.client.force_login(self.user)
+        url = reverse("edit-roleplay-bot", kwargs={"bot_id": self.bot.id})
+        form = {"name": "Coach", "system_prompt": self.system_prompt, "voice": "coral"}
+
+        self.client.post(url, {**form, "name": "Sales Coach"})
+        self.assertIsNotNone(store.get(self.key))
+
+        self.client.post(url, {**form, "voice": "sage"})
+        self.assertIsNone(store.get(self.key))
@@ -0,0 +1,424 @@
+# pylint: disable=all
+"""Roleplay transcripts maintained incrementally from realtime model events."""
+
+import asyncio
+import bisect
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_time
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptStore:
+    """
+    Transcript turns keyed by item_id, in conversation order.
+
+    Upserting a known item replaces its turn in place. A new one is
+    placed by its position in the conversation, which is nearly always
+    at the end, so both are O(1) in practice whatever the length.
+    """
+
+    def __init__(self):
+        self.turns = {}
+        # Conversation positions and item ids, sorted by position
+        self.positions = []
+        self.order = []
+
+    def upsert(self, item_id, position, turn):
+        """Store a turn; returns whether it is new"""
+        if item_id is None:
+            item_id = f"position:{position}"
+        if item_id in self.turns:
+            self.turns[item_id] = turn
+            return False
+        index = bisect.bisect(self.positions, position)
+        self.positions.insert(index, position)
+        self.order.insert(index, item_id)
+        self.turns[item_id] = turn
+        return True
+
+    def remove(self, item_id):
+        """Drop a turn; returns whether there was one"""
+        if self.turns.pop(item_id, None) is None:
+            return False
+        index = self.order.index(item_id)
+        del self.order[index]
+        del self.positions[index]
+        return True
+
+    def get(self, item_id):
+        return self.turns.get(item_id)
+
+    def latest(self, count):
+        return [self.turns[item_id] for item_id in self.order[-count:]]
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return (self.turns[item_id] for item_id in self.order)
+
+
+class TranscriptItem:
+    """What is known so far of one conversation item"""
+
+    def __init__(self, role, position):
+        self.role = role
+        self.position = position
+        self.status = None
+        # Text by content index
+        self.texts = {}
+        # The last history item applied; snapshots repeat unchanged ones
+        self.seen = None
+
+
+class TranscriptIngestor:
+    """
+    Maintains a TranscriptStore from item-level realtime model events.
+
+    Each event touches only its own item: item_updated adds or updates
+    it, input_audio_transcription_completed fills in what the user said,
+    transcript_delta accumulates the assistant's words in case its
+    completed item arrives without them, and item_deleted removes it. A
+    turn is stored once its item is complete and has text. Items are
+    placed in the order they were first seen. reconcile() folds in a full
+    history snapshot for anything the events missed, skipping the items
+    it has already applied as they are.
+    """
+
+    def __init__(self, store, make_turn, on_change=None):
+        self.store = store
+        # (item_id, role, text) -> turn
+        self.make_turn = make_turn
+        # Called with (position, item_id, role, text) for every turn stored
+        # or, with empty text, removed
+        self.on_change = on_change
+        self.items = {}
+        self.deltas = {}
+        self.next_position = 0
+
+    def ingest(self, event):
+        """Apply one model event; returns whether a turn was added or changed"""
+        kind = getattr(event, "type", None)
+        if kind == "item_updated":
+            return self.apply_item(event.item)
+        if kind == "input_audio_transcription_completed":
+            item = self.item(event.item_id, "user")
+            item.texts[0] = event.transcript
+            item.status = "completed"
+            return self.emit(event.item_id, item)
+        if kind == "transcript_delta":
+            self.deltas.setdefault(event.item_id, []).append(event.delta)
+            return False
+        if kind == "item_deleted":
+            item = self.items.pop(event.item_id, None)
+            self.deltas.pop(event.item_id, None)
+            if not self.store.remove(event.item_id):
+                return False
+            if self.on_change:
+                self.on_change(item.position, event.item_id, item.role, "")
+            return True
+        return False
+
+    def reconcile(self, history):
+        """Fold in a history snapshot; returns whether any turn changed"""
+        changed = False
+        for history_item in history:
+            changed = self.apply_item(history_item) or changed
+        return changed
+
+    def item(self, item_id, role):
+        item = self.items.get(item_id)
+        if item is None:
+            item = self.items[item_id] = TranscriptItem(role, self.next_position)
+            self.next_position += 1
+        return item
+
+    def apply_item(self, history_item):
+        if getattr(history_item, "type", None) != "message":
+            return False
+        item_id = history_item.item_id
+        item = self.item(item_id, history_item.role)
+        if item.seen is history_item:
+            return False
+        item.seen = history_item
+        status = getattr(history_item, "status", None)
+        if status:
+            item.status = status
+        for index, content in enumerate(history_item.content or []):
+            text = getattr(content, "transcript", None) or getattr(
+                content, "text", None
+            )
+            if text:
+                item.texts[index] = text
+        if not item.texts and item.status != "in_progress" and item_id in self.deltas:
+            item.texts[0] = "".join(self.deltas[item_id])
+        return self.emit(item_id, item)
+
+    def emit(self, item_id, item):
+        if item.status == "in_progress" or not item.texts:
+            return False
+        self.deltas.pop(item_id, None)
+        text = " ".join(item.texts[index] for index in sorted(item.texts))
+        existing = self.store.get(item_id)
+        if existing and existing["content"] == text:
+            return False
+        turn = self.make_turn(item_id, item.role, text)
+        if existing:
+            # Keep the time the turn was first heard
+            turn["timestamp"] = existing["timestamp"]
+        self.store.upsert(item_id, item.position, turn)
+        if self.on_change:
+            self.on_change(item.position, item_id, item.role, text)
+        return True
+
+
+class TranscriptCheckpointer:
+    """
+    Appends the turns of every session in this process to TranscriptSegment
+    as they complete, from one task.
+
+    Turns wait at most the flush interval and go out in inserts of at most
+    batch_size rows, so a session that dies with its process loses no more
+    than that interval of its transcript. A failed insert is retried on the
+    next flush.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.loop = None
+        self.flushes = 0
+        self.segments = 0
+        self.failures = 0
+
+    def append(self, session_id, seq, item_id, role, text):
+        self.pending.append(
+            {
+                "session_id": session_id,
+                "seq": seq,
+                "item_id": item_id or "",
+                "role": role,
+                "text": text,
+                "spoken_at": timezone.now(),
+            }
+        )
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    async def flush(self):
+        """Write every pending turn; returns whether all of them made it"""
+        async with self.lock:
+            while self.pending:
+                batch = self.pending[: self.batch_size]
+                try:
+                    await database_sync_to_async(write_segments)(batch)
+                except Exception as e:
+                    self.failures += 1
+                    logger.error(f"Error writing {len(batch)} transcript segments: {e}")
+                    return False
+                del self.pending[: len(batch)]
+                self.flushes += 1
+                self.segments += len(batch)
+            return True
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "segments": self.segments,
+            "failures": self.failures,
+        }
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                # Give the batch the interval to fill up, unless it already has
+                if len(self.pending) < self.batch_size:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                    except asyncio.TimeoutError:
+                        pass
+                await self.flush()
+                if self.pending:
+                    # Failed; try again after the interval
+                    await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            pass
+
+
+def write_segments(rows):
+    from .models import TranscriptSegment
+
+    TranscriptSegment.objects.bulk_create([TranscriptSegment(**row) for row in rows])
+
+
+_checkpointer = None
+
+
+def get_transcript_checkpointer():
+    """The process-wide transcript checkpointer for the running event loop"""
+    global _checkpointer
+    loop = asyncio.get_running_loop()
+    if _checkpointer is None or _checkpointer.loop is not loop:
+        _checkpointer = TranscriptCheckpointer(
+            getattr(settings, "VOICE_AGENT_TRANSCRIPT_FLUSH_S", 5),
+            getattr(settings, "VOICE_AGENT_TRANSCRIPT_BATCH", 100),
+        )
+        _checkpointer.loop = loop
+    return _checkpointer
+
+
+def segment_turns(bot, segments):
+    """Transcript turns from TranscriptSegment rows in (seq, id) order"""
+    latest = {}
+    for segment in segments:
+        first = latest.get(segment.seq)
+        # The last row of a seq has its text, the first when it was heard
+        latest[segment.seq] = (first[0] if first else segment.spoken_at, segment)
+    return [
+        {
+            "timestamp": spoken_at.strftime("%H:%M:%S"),
+            "role": segment.role,
+            "role_display": bot.name if segment.role == "assistant" else "USER",
+            "content": segment.text,
+            "item_id": segment.item_id or None,
+        }
+        for spoken_at, segment in latest.values()
+        if segment.text
+    ]
+
+
+def render_transcript(bot, started_at, turns):
+    """The human-readable text of a roleplay transcript"""
+    turns = list(turns)
+    if not turns:
+        return "No conversation transcript available."
+
+    formatted_lines = []
+    formatted_lines.append(f"=== ROLEPLAY SESSION: {bot.name} ===")
+    formatted_lines.append(f"Scenario: {bot.description}")
+    formatted_lines.append(
+        f"Started: {started_at.strftime('%Y-%m-%d %H:%M:%S') if started_at else 'Unknown'}"
+    )
+    formatted_lines.append("=" * 50)
+    formatted_lines.append("")
+
+    for item in turns:
+        formatted_lines.append(f"[{item['timestamp']}] {item['role_display']}:")
+        formatted_lines.append(f"{item['content']}")
+        formatted_lines.append("")
+
+    formatted_lines.append("=" * 50)
+    formatted_lines.append("=== END OF ROLEPLAY SESSION ===")
+    return "\n".join(formatted_lines)
+
+
+def interview_turn(role, content, spoken_at):
+    """One stored InterviewSession turn"""
+    return {"role": role, "content": content, "spoken_at": spoken_at.isoformat()}
+
+
+def parse_spoken_at(value):
+    """A stored turn's spoken_at as a datetime, or a bare time of day from legacy text"""
+    if not value:
+        return None
+    try:
+        return parse_datetime(value) or parse_time(value)
+    except ValueError:
+        return None
+
+
+def display_turns(turns):
+    """Stored interview turns for the results page, spoken_at parsed"""
+    return [
+        {
+            "role": turn["role"],
+            "content": turn["content"],
+            "timestamp": parse_spoken_at(turn.get("spoken_at")),
+        }
+        for turn in turns
+    ]
+
+
+def render_interview_transcript(turns):
+    """The human-readable text of an interview transcript"""
+    if not turns:
+        return "No transcript available."
+
+    formatted_lines = []
+    formatted_lines.append("=== INTERVIEW TRANSCRIPT ===\n")
+
+    for turn in display_turns(turns):
+        role_display = "INTERVIEWER" if turn["role"] == "assistant" else "CANDIDATE"
+        timestamp = turn["timestamp"].strftime("%H:%M:%S") if turn["timestamp"] else ""
+        formatted_lines.append(f"[{timestamp}] {role_display}:")
+        formatted_lines.append(f"{turn['content']}\n")
+
+    formatted_lines.append("=== END OF TRANSCRIPT ===")
+    return "\n".join(formatted_lines)
+
+
+def parse_transcript_text(transcript):
+    """
+    Stored interview turns recovered from a text transcript, for sessions
+    recorded before turns were stored; legacy text only has the time of day
+    """
+    turns = []
+    current_turn = None
+
+    for line in transcript.split("\n"):
+        line = line.strip()
+        if not line or line.startswith("==="):
+            continue
+
+        # A new speaker, like "[14:30:15] INTERVIEWER:" or "[14:30:45] CANDIDATE:"
+        if line.startswith("[") and "]" in line:
+            timestamp_end = line.index("]")
+            remainder = line[timestamp_end + 1 :].strip()
+            if ":" in remainder:
+                speaker, content = remainder.split(":", 1)
+                if current_turn:
+                    turns.append(current_turn)
+                current_turn = {
+                    "role": (
+                        "assistant" if "INTERVIEWER" in speaker.upper() else "user"
+                    ),
+                    "content": content.strip(),
+                    "spoken_at": line[1:timestamp_end],
+                }
+                continue
+
+        # Continuation of the current speaker's content
+        if current_turn:
+            if current_turn["content"]:
+                current_turn["content"] += " " + line
+            else:
+                current_turn["content"] = line
+
+    if current_turn:
+        turns.append(current_turn)
+    return turns
@@ -12,6 +12,7 @@ urlpatterns = [
     path("voice/", views.voice_agent_view, name="voice_agent"),
     path("health/", views.health_check, name="health_check"),
     path("status/", views.api_status, name="api_status"),
+    path("status/latency/", views.latency_metrics, name="latency_metrics"),
     path("topic/", views.topic, name="topic"),
     path("sub-topic/", views.sub_topic, name="sub_topic"),
     path("login/", views.LoginView.as_view(), name="login"),
@@ -32,8 +32,10 @@ from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
 from django.core.cache import cache
 from openai import OpenAI
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
 from django.db.models import Count, Q
 import hashlib
 import hmac
@@ -41,6 +43,14 @@ from decimal import Decimal
 import razorpay
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models import Q
+from .balances import get_balance
+from .billing import billing_stats
+from .credits import add_credits, deduct_credits
+from .greetings import invalidate_greetings
+from .handoff import mint_handoff_token
+from .metrics import latency_snapshot
+from .realtime import session_pool_stats
+from .transcripts import parse_transcript_text
 from .utils import upload_to_s3
 
 
@@ -139,20 +149,19 @@ class PaymentSuccessView(LoginRequiredMixin, View):
                 return redirect("purchase_credits")
 
             # Payment verified - update user credits
-            profile = Profile.objects.get(user=request.user)
-            profile.credits += credits
-            profile.save()
+            with transaction.atomic():
+                add_credits(request.user.id, credits, "purchase", razorpay_payment_id)
 
-            # Create transaction record
-            Transaction.objects.create(
-                user=request.user,
-                transaction_id=razorpay_payment_id,  # Now accepts string
-                order_id=razorpay_order_id,  # Store order ID
-                credits=credits,
-                amount=Decimal(price),
-                payment_method="razorpay",
-                status="success",
-            )
+                # Create transaction record
+                Transaction.objects.create(
+                    user=request.user,
+                    transaction_id=razorpay_payment_id,  # Now accepts string
+                    order_id=razorpay_order_id,  # Store order ID
+                    credits=credits,
+                    amount=Decimal(price),
+                    payment_method="razorpay",
+                    status="success",
+                )
 
             logger.info(
                 f"Payment successful for user {request.user.id}: {credits} credits added"
@@ -424,14 +433,19 @@ class EditRolePlayBotView(LoginRequiredMixin, View):
                 order = 0
 
             # Update bot
+            voice = voice if voice else "alloy"
+            greeting_changed = (bot.system_prompt, bot.voice) != (system_prompt, voice)
             bot.name = name
             bot.description = description if description else None
             bot.system_prompt = system_prompt
             bot.is_active = is_active
             bot.is_public = is_public
-            bot.voice = voice if voice else "alloy"
+            bot.voice = voice
 
             bot.save()
+            if greeting_changed:
+                # The cached greeting was spoken from the old prompt or voice
+                invalidate_greetings(bot.id)
 
             messages.success(request, f'"{bot.name}" has been updated successfully!')
             return redirect("my-roleplay-bots")
@@ -491,9 +505,8 @@ class CreateRolePlayBotView(LoginRequiredMixin, View):
     login_url = "/login/"
 
     def post(self, request):
-        profile = Profile.objects.get(user=request.user)
         credit_required_to_create_bot = 10
-        if profile.credits < credit_required_to_create_bot:
+        if get_balance(request.user.id) < credit_required_to_create_bot:
             messages.error(
                 request, f"Low credits- Required credit {credit_required_to_create_bot}"
             )
@@ -547,24 +560,36 @@ class CreateRolePlayBotView(LoginRequiredMixin, View):
             return redirect("create_roleplay_bot")
 
         try:
-            bot = RolePlayBots.objects.create(
-                name=name,
-                description=description,
-                avatar_url=avatar_url,
-                system_prompt=system_prompt,
-                feedback_prompt=feedback_prompt,
-                custom_configuration=custom_configuration,
-                created_by=request.user,
-                is_active=is_active,
-                is_public=is_public,
-                category=category,
-                voice=voice,
-            )
+            with transaction.atomic():
+                bot = RolePlayBots(
+                    name=name,
+                    description=description,
+                    avatar_url=avatar_url,
+                    system_prompt=system_prompt,
+                    feedback_prompt=feedback_prompt,
+                    custom_configuration=custom_configuration,
+                    created_by=request.user,
+                    is_active=is_active,
+                    is_public=is_public,
+                    category=category,
+                    voice=voice,
+                )
+                # The balance may have changed since the check above
+                if not deduct_credits(
+                    request.user.id,
+                    credit_required_to_create_bot,
+                    "bot_creation",
+                    bot.id,
+                ):
+                    messages.error(
+                        request,
+                        f"Low credits- Required credit {credit_required_to_create_bot}",
+                    )
+                    return redirect("purchase_credits")
+                bot.save(force_insert=True)
             messages.success(
                 request, f"Roleplay Bot '{bot.name}' created successfully!"
             )
-            profile.credits -= credit_required_to_create_bot
-            profile.save(update_fields=["credits"])
             return redirect("voice_roleplay")
         except Exception as e:
             logger.error(f"Error creating Roleplay Bot: {e}")
@@ -600,16 +625,30 @@ class RolePlaySessionView(LoginRequiredMixin, View):
         try:
             # Get the interview session
             session = get_object_or_404(
-                RoleplaySession, id=session_id, user=request.user
+                RoleplaySession.objects.select_related(
+                    "bot__created_by", "user__profile"
+                ).defer(*RoleplaySession.LARGE_FIELDS),
+                id=session_id,
+                user=request.user,
+            )
+            share_link = (
+                MyInvitedRolePlayShare.objects.select_related("share__shared_by")
+                .filter(bot=session.bot, invited_to=request.user)
+                .first()
             )
-            share_link = MyInvitedRolePlayShare.objects.filter(
-                bot=session.bot, invited_to=request.user
-            ).first()
+            share = share_link.share if share_link else None
             context = {
                 "session": session,
                 "bot": session.bot,
-                "invited_by": share_link.share.shared_by if share_link else None,
+                "invited_by": share.shared_by if share else None,
                 "creator": session.bot.created_by,
+                # Lets the consumer start the session without querying all
+                # this again; a settled session has been charged and is over
+                "handoff_token": (
+                    mint_handoff_token(session, share)
+                    if session.settled_at is None
+                    else ""
+                ),
             }
             return render(request, "roleplay_session.html", context)
 
@@ -629,34 +668,44 @@ class RolePlayStartView(LoginRequiredMixin, View):
         try:
             # Get the interview template
             role_play_bot = get_object_or_404(RolePlayBots, id=bot_id, is_active=True)
-            profile = Profile.objects.get(user=request.user)
-            if not profile.has_credit(
-                required=role_play_bot.custom_configuration.get(
-                    "required_minimum_credits", 10
-                )
-            ):
+            required_credits = role_play_bot.custom_configuration.get(
+                "required_minimum_credits", 10
+            )
+            if get_balance(request.user.id) < required_credits:
                 messages.error(request, "You don’t have enough credits. Please top up.")
                 return redirect("purchase_credits")  # redirect to your top-up page
             # Check if user has an ongoing session for this bot
-            ongoing_session = RoleplaySession.objects.filter(
-                user=request.user, bot=role_play_bot, status="in_progress"
-            ).first()
+            ongoing_session = (
+                RoleplaySession.objects.filter(
+                    user=request.user,
+                    bot=role_play_bot,
+                    status="in_progress",
+                    settled_at__isnull=True,
+                )
+                .defer(*RoleplaySession.LARGE_FIELDS)
+                .first()
+            )
 
             if ongoing_session:
                 # Redirect to existing session
                 return redirect("roleplay_session", session_id=ongoing_session.id)
-            profile.deduct_credits(
-                used=role_play_bot.custom_configuration.get(
-                    "required_minimum_credits", 10
+            with transaction.atomic():
+                # Create new interview session
+                session = RoleplaySession.objects.create(
+                    bot=role_play_bot,
+                    user=request.user,
+                    status="in_progress",
+                    started_at=timezone.now(),
                 )
-            )
-            # Create new interview session
-            session = RoleplaySession.objects.create(
-                bot=role_play_bot,
-                user=request.user,
-                status="in_progress",
-                started_at=timezone.now(),
-            )
+                # The balance may have changed since the check above
+                if not deduct_credits(
+                    request.user.id, required_credits, "session_charge", session.id
+                ):
+                    transaction.set_rollback(True)
+                    messages.error(
+                        request, "You don’t have enough credits. Please top up."
+                    )
+                    return redirect("purchase_credits")
             # Redirect to roleplay_session session page
             return redirect("roleplay_session", session_id=session.id)
 
@@ -849,17 +898,17 @@ class ProfileView(LoginRequiredMixin, View):
     login_url = "/login/"
 
     def get(self, request):
-        profile = Profile.objects.get(user=request.user)
         context = {
-            "profile": profile,
+            "credits": get_balance(request.user.id),
         }
         return render(request, "profile.html", context)
 
     def post(self, request):
         try:
             profile = Profile.objects.get(user=request.user)
-            # Update profile fields from form data
-            profile.save()
+            # Update profile fields from form data; credits only change
+            # through prepaiapp.credits
+            profile.save(update_fields=["configurations"])
 
             messages.success(request, "Profile updated successfully!")
             return redirect("profile")
@@ -968,9 +1017,8 @@ class PurchaseCredits(View):
             }
 
         if request.user.is_authenticated:
-            profile = Profile.objects.get(user=request.user)
             context = {
-                "current_credits": profile.credits,
+                "current_credits": get_balance(request.user.id),
                 "currency": currency,
                 "currency_symbol": currency_symbol,
                 "is_indian": is_indian,
@@ -996,9 +1044,11 @@ class InterviewHistoryView(LoginRequiredMixin, View):
 
     def get(self, request):
         # Get all sessions for the user
-        base_sessions = InterviewSession.objects.filter(
-            user=request.user
-        ).select_related("template")
+        base_sessions = (
+            InterviewSession.objects.filter(user=request.user)
+            .select_related("template")
+            .defer(*InterviewSession.LARGE_FIELDS)
+        )
 
         # Apply filters
         filtered_sessions = self.apply_filters(base_sessions, request.GET)
@@ -1100,9 +1150,13 @@ class InterviewResultView(LoginRequiredMixin, View):
                 InterviewSession, id=session_id, user=request.user
             )
             # Check if we have transcript to analyze
-            if not session.transcript:
+            if not session.turns and not session.transcript:
                 messages.warning(request, "Interview transcript not available yet.")
                 return redirect("interview_types")
+            if not session.turns:
+                # Recorded as text before turns were stored: parse it once
+                session.turns = parse_transcript_text(session.transcript)
+                session.save(update_fields=["turns"])
 
             # Check cache first to avoid re-analysis
             cache_key = f"interview_analysi_{session_id}"
@@ -1128,8 +1182,7 @@ class InterviewResultView(LoginRequiredMixin, View):
             # Calculate session duration
             session_duration = self.calculate_session_duration(session)
 
-            # Parse conversation history from transcript
-            conversation_history = self.parse_conversation_history(session.transcript)
+            conversation_history = session.conversation_turns()
 
             context = {
                 "session": session,
@@ -1200,7 +1253,7 @@ class InterviewResultView(LoginRequiredMixin, View):
 
         try:
             return self.get_fallback_analysis()  # Temporary fallback for testing
-            transcript = session.transcript
+            transcript = session.transcript_text()
             template = session.template
 
             # Create analysis prompt
@@ -1430,87 +1483,6 @@ Please ensure your response contains ONLY the JSON object with no additional for
         except:
             return 0
 
-    def parse_conversation_history(self, transcript):
-        """Parse transcript into conversation history for template"""
-        if not transcript:
-            return []
-
-        conversation_history = []
-        lines = transcript.split("\n")
-        current_item = None
-
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith("==="):
-                continue
-
-            # Check for speaker indicators
-            if line.startswith("[") and "]" in line:
-                # New speaker entry like "[14:30:15] INTERVIEWER:" or "[14:30:45] CANDIDATE:"
-                try:
-                    # Extract timestamp and speaker
-                    timestamp_end = line.index("]")
-                    timestamp_str = line[1:timestamp_end]
-                    remainder = line[timestamp_end + 1 :].strip()
-
-                    if ":" in remainder:
-                        speaker = remainder.split(":")[0].strip()
-                        content_start = remainder.index(":") + 1
-                        content = remainder[content_start:].strip()
-
-                        # Map speaker to role
-                        role = (
-                            "assistant" if "INTERVIEWER" in speaker.upper() else "user"
-                        )
-
-                        # Save previous item
-                        if current_item:
-                            conversation_history.append(current_item)
-
-                        # Create new item
-                        current_item = {
-                            "role": role,
-                            "content": content,
-                            "timestamp": self.parse_timestamp(timestamp_str),
-                        }
-
-                except (ValueError, IndexError):
-                    # If parsing fails, treat as continuation of current content
-                    if current_item:
-                        current_item["content"] += " " + line
-
-            else:
-                # Continuation of current speaker's content
-                if current_item:
-                    if current_item["content"]:
-                        current_item["content"] += " " + line
-                    else:
-                        current_item["content"] = line
-
-        # Add the last item
-        if current_item:
-            conversation_history.append(current_item)
-
-        return conversation_history
-
-    def parse_timestamp(self, timestamp_str):
-        """Parse timestamp string to datetime object"""
-
-        try:
-            # Parse time like "14:30:15"
-            time_parts = timestamp_str.split(":")
-            if len(time_parts) == 3:
-                hour, minute, second = map(int, time_parts)
-                return time(hour, minute, second)
-            elif len(time_parts) == 2:
-                hour, minute = map(int, time_parts)
-                return time(hour, minute, 0)
-        except:
-            pass
-
-        # Return current time as fallback
-        return datetime.now().time()
-
     def update_session_feedback(self, session, context):
         """
         Save the complete context data to session feedback field
@@ -1537,7 +1509,6 @@ Please ensure your response contains ONLY the JSON object with no additional for
                     "words_spoken": context.get("words_spoken", 0),
                     "avg_response_time": context.get("avg_response_time", 0),
                 },
-                "conversation_history": context.get("conversation_history", []),
                 "template_info": {
                     "title": session.template.title,
                     "role_type": session.template.get_role_type_display(),
@@ -1622,21 +1593,34 @@ class StartInterviewView(LoginRequiredMixin, View):
                 messages.error(request, "You don’t have enough credits. Please top up.")
                 return redirect("purchase_credits")  # redirect to your top-up page
             # Check if user has an ongoing session for this template
-            ongoing_session = InterviewSession.objects.filter(
-                user=request.user, template=template, status="in_progress"
-            ).first()
+            ongoing_session = (
+                InterviewSession.objects.filter(
+                    user=request.user, template=template, status="in_progress"
+                )
+                .defer(*InterviewSession.LARGE_FIELDS)
+                .first()
+            )
 
             if ongoing_session:
                 # Redirect to existing session
                 return redirect("interview_session", session_id=ongoing_session.id)
-            profile.deduct_credits(used=template.estimated_duration_minutes)
-            # Create new interview session
-            session = InterviewSession.objects.create(
-                template=template,
-                user=request.user,
-                status="in_progress",
-                started_at=timezone.now(),
-            )
+            with transaction.atomic():
+                # Create new interview session
+                session = InterviewSession.objects.create(
+                    template=template,
+                    user=request.user,
+                    status="in_progress",
+                    started_at=timezone.now(),
+                )
+                # The balance may have changed since the check above
+                if not profile.deduct_credits(
+                    used=template.estimated_duration_minutes, reference=session.id
+                ):
+                    transaction.set_rollback(True)
+                    messages.error(
+                        request, "You don’t have enough credits. Please top up."
+                    )
+                    return redirect("purchase_credits")
 
             # Redirect to interview session page
             return redirect("interview_session", session_id=session.id)
@@ -1857,7 +1841,9 @@ class SignupView(View):
         user = User.objects.create_user(
             username=username, email=email, password=password1
         )
-        Profile.objects.get_or_create(user=user, credits=50)
+        with transaction.atomic():
+            Profile.objects.get_or_create(user=user)
+            add_credits(user.id, 50, "grant", "signup")
         login(request, user)  # Auto login after signup
         share_id = self.request.POST.get("share_id")
         bot_id = None
@@ -1951,6 +1937,18 @@ def api_status(request):
     return JsonResponse({"websocket_url": "/ws/voice-agent/", "status": "ready"})
 
 
+@staff_member_required
+def latency_metrics(request):
+    """Voice latency histograms, session pool and billing stats for this process (staff only)"""
+    return JsonResponse(
+        {
+            **latency_snapshot(),
+            "session_pool": session_pool_stats(),
+            "billing": billing_stats(),
+        }
+    )
+
+
 class HomePage(View):
     """Renders the landing page."""
 
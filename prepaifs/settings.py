@@ -110,6 +110,75 @@ CHANNEL_LAYERS = {
         # },
     },
 }
+# Redis when REDIS_URL is set; the per-process default cache cannot carry
+# meter checkpoints across a crash
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+# Hot cache of credit balances: "" (off), "redis" or "local" (per process, for
+# development and tests). Postgres stays the record; cached balances follow its
+# committed changes and are re-read at least every CREDIT_BALANCE_CACHE_TTL seconds
+CREDIT_BALANCE_CACHE = os.getenv("CREDIT_BALANCE_CACHE", "")
+CREDIT_BALANCE_CACHE_URL = os.getenv(
+    "CREDIT_BALANCE_CACHE_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0")
+)
+CREDIT_BALANCE_CACHE_TTL = int(os.getenv("CREDIT_BALANCE_CACHE_TTL", 300))
+# Seconds to wait on the balance cache's Redis before falling back to Postgres
+CREDIT_BALANCE_CACHE_TIMEOUT = float(os.getenv("CREDIT_BALANCE_CACHE_TIMEOUT", 0.25))
+# Voice agent audio streaming (see prepaiapp.consumers.VoiceAgentConsumer)
+VOICE_AGENT_OUTPUT_FRAME_MS = int(os.getenv("VOICE_AGENT_OUTPUT_FRAME_MS", 60))
+VOICE_AGENT_OUTPUT_FLUSH_MS = int(os.getenv("VOICE_AGENT_OUTPUT_FLUSH_MS", 40))
+VOICE_AGENT_OUTPUT_LEAD_MS = int(os.getenv("VOICE_AGENT_OUTPUT_LEAD_MS", 300))
+VOICE_AGENT_OUTPUT_LATENCY_BUDGET_MS = int(
+    os.getenv("VOICE_AGENT_OUTPUT_LATENCY_BUDGET_MS", 500)
+)
+VOICE_AGENT_OUTPUT_MAX_QUEUE_MS = int(os.getenv("VOICE_AGENT_OUTPUT_MAX_QUEUE_MS", 60000))
+VOICE_AGENT_INPUT_CHUNK_MS = int(os.getenv("VOICE_AGENT_INPUT_CHUNK_MS", 100))
+VOICE_AGENT_INPUT_FLUSH_MS = int(os.getenv("VOICE_AGENT_INPUT_FLUSH_MS", 40))
+VOICE_AGENT_INPUT_BUFFER_MS = int(os.getenv("VOICE_AGENT_INPUT_BUFFER_MS", 2000))
+VOICE_AGENT_SESSION_G711 = os.getenv("VOICE_AGENT_SESSION_G711", "True") == "True"
+# Save per-connection latencies on RoleplaySession.latency_metrics
+VOICE_AGENT_STORE_LATENCY = os.getenv("VOICE_AGENT_STORE_LATENCY", "False") == "True"
+# Pre-connected upstream realtime sessions per process (0 disables the pool)
+VOICE_AGENT_POOL_SIZE = int(os.getenv("VOICE_AGENT_POOL_SIZE", 0))
+VOICE_AGENT_POOL_TTL = int(os.getenv("VOICE_AGENT_POOL_TTL", 300))
+# "openai", or "local" for an offline backend that never answers
+VOICE_AGENT_REALTIME_BACKEND = os.getenv("VOICE_AGENT_REALTIME_BACKEND", "openai")
+# Roleplay sessions are metered by the second and settled when they end. Every
+# BILLING_TICK seconds sessions out of credits are cut off, and every
+# METER_CHECKPOINT seconds their meters are saved to the cache; a session whose
+# checkpoint is METER_STALE seconds old is settled by settle_roleplay_meters.
+# No session runs longer than MAX_SESSION_S; one with no checkpoint at all is
+# closed by settle_roleplay_meters only once it is older than that
+VOICE_AGENT_BILLING_TICK = float(os.getenv("VOICE_AGENT_BILLING_TICK", 1))
+VOICE_AGENT_METER_CHECKPOINT = int(os.getenv("VOICE_AGENT_METER_CHECKPOINT", 15))
+VOICE_AGENT_METER_STALE = int(os.getenv("VOICE_AGENT_METER_STALE", 120))
+VOICE_AGENT_MAX_SESSION_S = int(os.getenv("VOICE_AGENT_MAX_SESSION_S", 10800))
+VOICE_AGENT_METER_CACHE_TTL = int(os.getenv("VOICE_AGENT_METER_CACHE_TTL", 86400))
+# Roleplay transcripts follow the model's item events; a full history snapshot
+# is folded in at most every TRANSCRIPT_RECONCILE_S seconds
+VOICE_AGENT_TRANSCRIPT_RECONCILE_S = float(
+    os.getenv("VOICE_AGENT_TRANSCRIPT_RECONCILE_S", 30)
+)
+# Completed turns are appended to TranscriptSegment within TRANSCRIPT_FLUSH_S
+# seconds, in inserts of at most TRANSCRIPT_BATCH rows
+VOICE_AGENT_TRANSCRIPT_FLUSH_S = float(os.getenv("VOICE_AGENT_TRANSCRIPT_FLUSH_S", 5))
+VOICE_AGENT_TRANSCRIPT_BATCH = int(os.getenv("VOICE_AGENT_TRANSCRIPT_BATCH", 100))
+# Seconds a roleplay page's signed session handoff token stays valid
+VOICE_AGENT_HANDOFF_MAX_AGE = int(os.getenv("VOICE_AGENT_HANDOFF_MAX_AGE", 300))
+# Where roleplay greetings are cached: "" (off), "local" or "s3"
+VOICE_AGENT_GREETING_CACHE = os.getenv("VOICE_AGENT_GREETING_CACHE", "")
+VOICE_AGENT_GREETING_DIR = os.getenv(
+    "VOICE_AGENT_GREETING_DIR", str(BASE_DIR / "greeting_cache")
+)
+VOICE_AGENT_GREETING_S3_PREFIX = os.getenv(
+    "VOICE_AGENT_GREETING_S3_PREFIX", "greeting-cache/"
+)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,